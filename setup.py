@@ -63,6 +63,7 @@ kdeDirs['iconActions'] = os.path.join(kdeDirs['icon'], 'hicolor', 'scalable', 'a
 
 app_files = [os.path.join('src', x) for x in os.listdir('src') if x.endswith('.py') or x.endswith('.ui')]
 app_files.append('src/kajonggui.rc')
+app_files.append('src/permutations.tbl')
 app_files.append('COPYING')
 app_files.append('COPYING.DOC')
 
@@ -96,6 +97,7 @@ class KmjBuild(build):
             os.chmod(binary, 0755 )
         call(['cp hisc-apps-kajongg.svgz kajongg.svgz'], shell=True)
         call(['cp hisc-action-games-kajongg-law.svgz games-kajongg-law.svgz'], shell=True)
+        call([sys.executable, 'src/permutations.py', 'src/permutations.tbl'])
         build.run(self)
 
 setup(name='Kajongg',
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2014 Wolfgang Rohdewald <wolfgang@rohdewald.de>
+
+Kajongg is free software you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+Score many hand strings for one ruleset without building a game
+for every hand.
+"""
+
+from array import array
+from itertools import groupby
+
+from game import PlayingGame
+from hand import Hand
+
+class Scores(object):
+    """the results of BulkScorer.score, one column per attribute.
+    Row idx belongs to the idx-th hand passed to score()"""
+
+    def __init__(self, size):
+        self.strings = [None] * size
+        self.won = array('b', [0]) * size
+        self.points = array('i', [0]) * size
+        self.doubles = array('i', [0]) * size
+        self.limits = array('d', [0.0]) * size
+        self.totals = array('i', [0]) * size
+        self.rules = [None] * size
+
+    def __len__(self):
+        return len(self.strings)
+
+    def row(self, idx):
+        """all columns for one hand"""
+        return (self.strings[idx], bool(self.won[idx]), self.points[idx], self.doubles[idx],
+            self.limits[idx], self.totals[idx], self.rules[idx])
+
+class BulkScorer(object):
+    """scores hand strings like Hand does for a player of a game.
+
+    A row is a hand string or a tuple (string, winds[, mayWin]). winds
+    has two letters, the wind of the player and the round wind, default
+    is 'ee'. The rows are evaluated grouped by winds, and identical rows
+    only once. All players share the HandCache, so a bigger
+    --handcache helps with big sets of similar hands."""
+
+    def __init__(self, ruleset):
+        self.ruleset = ruleset.load()
+        self.game = PlayingGame([], self.ruleset)
+        for idx, wind in enumerate('ESWN'):
+            self.game.players[idx].wind = wind
+
+    @staticmethod
+    def normalize(row):
+        """(string, winds, mayWin)"""
+        if isinstance(row, basestring):
+            return row, 'ee', True
+        if len(row) == 2:
+            return row[0], row[1], True
+        return tuple(row)
+
+    def __player(self, winds, mayWin):
+        """the scaffolding player for winds"""
+        player = self.game.players[winds[0].upper()]
+        player.mayWin = mayWin
+        self.game.winner = player
+        self.game.roundsFinished = 'eswn'.index(winds[1].lower())
+        return player
+
+    def score(self, rows):
+        """returns Scores for rows"""
+        rows = list(self.normalize(x) for x in rows)
+        result = Scores(len(rows))
+        order = sorted(range(len(rows)), key=lambda x: rows[x][1:] + rows[x][:1])
+        for (winds, mayWin), indices in groupby(order, key=lambda x: rows[x][1:]):
+            player = self.__player(winds, mayWin)
+            done = {}
+            for idx in indices:
+                string = rows[idx][0]
+                values = done.get(string)
+                if values is None:
+                    hand = Hand(player, string)
+                    score = hand.score
+                    values = done[string] = (bool(hand.won), score.points, score.doubles,
+                        score.limits, score.total(), tuple(x.rule.name for x in hand.usedRules or ()))
+                result.strings[idx] = string
+                (result.won[idx], result.points[idx], result.doubles[idx],
+                    result.limits[idx], result.totals[idx], result.rules[idx]) = values
+        return result
+
+    @staticmethod
+    def readRows(lines):
+        """rows from lines like 'winds<TAB>string' or only 'string'.
+        Empty lines and lines starting with # are ignored"""
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if '\t' in line:
+                winds, string = line.split('\t', 1)
+                yield string, winds
+            else:
+                yield line
@@ -21,9 +21,8 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 import datetime, weakref
 
 from twisted.spread import pb
-from twisted.internet.task import deferLater
 from twisted.internet.defer import Deferred, succeed
-from util import Duration
+from util import Duration, elapsedSince
 from log import logDebug, logException, logWarning, m18nc
 from message import Message
 from common import Internal, Debug, Options
@@ -33,6 +32,8 @@ from query import Query
 from move import Move
 from animation import animate
 from player import PlayingPlayer
+from timerwheel import TimerWheel
+from metrics import RobotSeconds
 
 import intelligence, altint
 
@@ -119,6 +120,7 @@ class Client(object, pb.Referenceable):
         self.tables = []
         self._table = None
         self.tableList = None
+        self.moveCodec = None
 
     @property
     def table(self):
@@ -294,7 +296,7 @@ class Client(object, pb.Referenceable):
                 return Message.NoClaim
         if delay < self.game.ruleset.claimTimeout * 0.95:
             # one of those slow humans is still thinking
-            return deferLater(Internal.reactor, delayStep, self.__delayAnswer, result, delay, delayStep)
+            return TimerWheel.default().deferLater(delayStep, self.__delayAnswer, result, delay, delayStep)
         if Debug.delayChow:
             self.game.debug('{} must chow now for {} because timeout is over'.format(
                 self.game.myself.name, self.game.lastDiscard.name()))
@@ -306,13 +308,15 @@ class Client(object, pb.Referenceable):
         delay = 0.0
         delayStep = 0.1
         myself = self.game.myself
+        start = datetime.datetime.now()
         myself.computeSayable(move, answers)
         result = myself.intelligence.selectAnswer(answers)
+        RobotSeconds.observe(elapsedSince(start))
         if result[0] == Message.Chow:
             if Debug.delayChow:
                 self.game.debug('{} waits to see if somebody says Pung or Kong before saying chow for {}'.format(
                     self.game.myself.name, self.game.lastDiscard.name()))
-            return deferLater(Internal.reactor, delayStep, self.__delayAnswer, result, delay, delayStep)
+            return TimerWheel.default().deferLater(delayStep, self.__delayAnswer, result, delay, delayStep)
         return succeed(result)
 
     def thatWasMe(self, player):
@@ -329,6 +333,11 @@ class Client(object, pb.Referenceable):
         else:
             return Message.jelly(value, value)
 
+    def remote_compactMove(self, payload):
+        """the server sends a move encoded by MoveCodec"""
+        playerName, command, kwargs = self.moveCodec.decode(payload)
+        return self.remote_move(playerName, command, **kwargs)
+
     def remote_move(self, playerName, command, *dummyArgs, **kwargs):
         """the server sends us info or a question and always wants us to answer"""
         if self.game:
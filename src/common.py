@@ -97,6 +97,7 @@ class Debug(object):
     neutral = False  # only neutral comparable debug output
     git = False
     ruleCache = False
+    handCache = False
     quit = False
 
     def __init__(self):
@@ -176,6 +177,7 @@ class Options(object):
     AI = 'Default'
     csv = None
     continueServer = False
+    handCacheSize = 20000 # entries in the HandCache
     fixed = False
 
     def __init__(self):
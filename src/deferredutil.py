@@ -30,6 +30,8 @@ from log import m18nE, logInfo, logDebug, logException
 from message import Message
 from common import Debug
 from move import Move
+from util import elapsedSince
+from metrics import Moves, AnswerSeconds
 
 class Request(object):
     """holds a Deferred and related attributes, used as part of a DeferredBlock"""
@@ -240,6 +242,7 @@ class DeferredBlock(object):
                 return
             else:
                 request.gotAnswer(result)
+                AnswerSeconds.observe(elapsedSince(request.startTime), (request.deferred.command, ))
                 if hasattr(request.user, 'pinged'):
                     # a Client (for robots) does not have it
                     request.user.pinged()
@@ -365,12 +368,14 @@ class DeferredBlock(object):
         assert receivers, 'DeferredBlock.tell(%s) has no receiver' % command
         self.__enrichMessage(self.table.game, about, command, kwargs)
         aboutName = about.name if about else None
+        Moves.inc((command.name, ))
         if self.table.running and len(receivers) in [1, 4]:
             # messages are either identical for all 4 players
             # or identical for 3 players and different for 1 player. And
             # we want to capture each message exactly once.
             self.table.game.appendMove(about, command, kwargs)
         localDeferreds = []
+        jellied = None
         for rec in self.__convertReceivers(receivers):
             isClient = rec.__class__.__name__.endswith('Client')
             if Debug.traffic and not isClient:
@@ -381,8 +386,14 @@ class DeferredBlock(object):
             if isClient:
                 defer = Deferred()
                 defer.addCallback(rec.remote_move, command, **kwargs)
+            elif rec.moveCodec:
+                defer = self.table.server.callRemote(rec, 'compactMove',
+                    rec.moveCodec.encode(aboutName, command, kwargs))
             else:
-                defer = self.table.server.callRemote(rec, 'move', aboutName, command.name, **kwargs)
+                if jellied is None:
+                    # the same for all remote receivers
+                    jellied = Message.jellyAll(('move', aboutName, command.name), kwargs)
+                defer = self.table.server.callRemoteJellied(rec, *jellied)
             if defer:
                 defer.command = command.name
                 defer.notifying = 'notifying' in kwargs
@@ -31,13 +31,14 @@ from twisted.internet.defer import succeed
 from util import stack, gitHead
 from log import logError, logWarning, logException, logDebug, m18n
 from common import WINDS, Internal, IntDict, Debug, Options
-from query import Query
+from query import Query, DBHandle
 from rule import Ruleset
 from tile import Tile, elements
 from sound import Voice
 from wall import Wall
 from move import Move
 from player import Players, Player, PlayingPlayer
+from hand import HandCache
 
 class CountingRandom(Random):
     """counts how often random() is called and prints debug info"""
@@ -196,7 +197,7 @@ class HandId(object):
         return 'HandId({})'.format(self.prompt())
 
     def __eq__(self, other):
-        return (self.roundsFinished, self.rotated, self.notRotated) == (
+        return other is not None and (self.roundsFinished, self.rotated, self.notRotated) == (
             other.roundsFinished, other.rotated, other.notRotated)
 
     def __lt__(self, other):
@@ -461,7 +462,7 @@ class Game(object):
     def _newGameId():
         """write a new entry in the game table
         and returns the game id of that new entry"""
-        return Query("insert into game(seed) values(0)").cursor.lastrowid
+        return Query("insert into game(seed) values(0)").lastrowid
 
     def saveStartTime(self):
         """save starttime for this game"""
@@ -469,8 +470,8 @@ class Game(object):
         args = list([starttime, self.seed, int(self.autoPlay), self.ruleset.rulesetId])
         args.extend([p.nameid for p in self.players])
         args.append(self.gameid)
-        Query("update game set starttime=?,seed=?,autoplay=?," \
-                "ruleset=?,p0=?,p1=?,p2=?,p3=? where id=?", tuple(args))
+        Internal.db.write([("update game set starttime=?,seed=?,autoplay=?," \
+                "ruleset=?,p0=?,p1=?,p2=?,p3=? where id=?", tuple(args))])
 
     def __useRuleset(self, ruleset):
         """use a copy of ruleset for this game, reusing an existing copy"""
@@ -521,41 +522,60 @@ class Game(object):
         self._setHandSeed()
 
     def saveHand(self):
-        """save hand to database, update score table and balance in status line"""
+        """save hand to database, update score table and balance in status line.
+        Returns a Deferred firing when the scores are written"""
         self.__payHand()
-        self._saveScores()
+        result = self._saveScores()
+        if Debug.handCache:
+            self.debug(HandCache.statistics())
         self.handctr += 1
         self.notRotated += 1
         self.roundHandCount += 1
         self.handDiscardCount = 0
+        return result
 
     def _saveScores(self):
         """save computed values to database, update score table and balance in status line"""
         scoretime = datetime.datetime.now().replace(microsecond=0).isoformat()
         logMessage = ''
+        statements = []
         for player in self.players:
             if player.hand:
                 manualrules = '||'.join(x.rule.name for x in player.hand.usedRules)
             else:
                 manualrules = m18n('Score computed manually')
-            Query("INSERT INTO SCORE "
-                "(game,hand,data,manualrules,player,scoretime,won,prevailing,wind,"
-                "points,payments, balance,rotated,notrotated) "
-                "VALUES(%d,%d,?,?,%d,'%s',%d,'%s','%s',%d,%d,%d,%d,%d)" % \
-                (self.gameid, self.handctr, player.nameid,
+            statements.append((DBHandle.statements['insertScore'],
+                (self.gameid, self.handctr, player.hand.string, manualrules, player.nameid,
                     scoretime, int(player == self.__winner),
                     WINDS[self.roundsFinished % 4], player.wind, player.handTotal,
-                    player.payment, player.balance, self.rotated, self.notRotated),
-                (player.hand.string, manualrules))
+                    player.payment, player.balance, self.rotated, self.notRotated)))
             logMessage += '{player:<12} {hand:>4} {total:>5} {won} | '.format(
                 player=str(player)[:12], hand=player.handTotal, total=player.balance,
                 won='WON' if player == self.winner else '   ')
+        # one hand is committed together or not at all
+        result = Internal.db.write(statements)
+        self._tagLimitHands()
+        if Debug.scores:
+            self.debug(logMessage)
+        return result
+
+    def eastWins(self):
+        """how often the current East player won as East in the current
+        prevailing wind, including the current hand if already saved"""
+        # the score of the current hand may still be queued in the writer
+        Internal.db.sync()
+        return int(Query("select count(1) from score "
+            "where game=%d and won=1 and wind='E' and player=%d "
+            "and prevailing='%s'" % \
+            (self.gameid, self.players['E'].nameid, WINDS[self.roundsFinished % 4])).records[0][0])
+
+    def _tagLimitHands(self):
+        """add a csv tag for every limit rule used in this hand"""
+        for player in self.players:
             for usedRule in player.hand.usedRules:
                 rule = usedRule.rule
                 if rule.score.limits:
                     self.addCsvTag(rule.name.replace(' ', ''))
-        if Debug.scores:
-            self.debug(logMessage)
 
     def maybeRotateWinds(self):
         """rules which make winds rotate"""
@@ -576,10 +596,12 @@ class Game(object):
             self.rotated = 0
             self.roundHandCount = 0
         if self.finished():
-            endtime = datetime.datetime.now().replace(microsecond=0).isoformat()
-            with Internal.db as transaction:
-                transaction.execute('UPDATE game set endtime = "%s" where id = %d' % \
-                    (endtime, self.gameid))
+            if self.gameid:
+                # a simulated game has no database record
+                endtime = datetime.datetime.now().replace(microsecond=0).isoformat()
+                Internal.db.write([('UPDATE game set endtime=? where id=?', (endtime, self.gameid))])
+                # the game is over, now everything about it must be in the database
+                Internal.db.sync()
         elif not self.belongsToPlayer():
             # the game server already told us the new placement and winds
             winds = [player.wind for player in self.players]
@@ -622,6 +644,7 @@ class Game(object):
     def loadFromDB(cls, gameid, client=None):
         """load game by game id and return a new Game instance"""
         Internal.logPrefix = 'S' if Internal.isServer else 'C'
+        Internal.db.sync()
         qGame = Query("select p0,p1,p2,p3,ruleset,seed from game where id = ?", (gameid,))
         if not qGame.records:
             return None
@@ -768,22 +791,26 @@ class PlayingGame(Game):
     def writeCsv(self):
         """write game summary to Options.csv"""
         if self.finished() and Options.csv:
-            gameWinner = max(self.players, key=lambda x: x.balance)
             writer = csv.writer(open(Options.csv, 'a'), delimiter=';')
-            if Debug.process and os.name != 'nt':
-                self.csvTags.append('MEM:%s' % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
-            if Options.rounds:
-                self.csvTags.append('ROUNDS:%s' % Options.rounds)
-            row = [self.ruleset.name, Options.AI, gitHead(), str(self.seed),
-                ','.join(self.csvTags)]
-            for player in sorted(self.players, key=lambda x: x.name):
-                row.append(player.name.encode('utf-8'))
-                row.append(player.balance)
-                row.append(player.wonCount)
-                row.append(1 if player == gameWinner else 0)
-            writer.writerow(row)
+            writer.writerow(self.csvRow())
             del writer
 
+    def csvRow(self, aiName=None):
+        """the game summary as written by writeCsv. aiName defaults to Options.AI"""
+        gameWinner = max(self.players, key=lambda x: x.balance)
+        if Debug.process and os.name != 'nt':
+            self.csvTags.append('MEM:%s' % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+        if Options.rounds:
+            self.csvTags.append('ROUNDS:%s' % Options.rounds)
+        row = [self.ruleset.name, aiName or Options.AI, gitHead(), str(self.seed),
+            ','.join(self.csvTags)]
+        for player in sorted(self.players, key=lambda x: x.name):
+            row.append(player.name.encode('utf-8'))
+            row.append(player.balance)
+            row.append(player.wonCount)
+            row.append(1 if player == gameWinner else 0)
+        return row
+
     def close(self):
         """log off from the server and return a Deferred"""
         Game.close(self)
@@ -855,7 +882,8 @@ class PlayingGame(Game):
         if self.shouldSave:
             if self.belongsToRobotPlayer():
                 assert False, 'shouldSave must not be True for robot player'
-            Game._saveScores(self)
+            return Game._saveScores(self)
+        return succeed(None)
 
     def nextPlayer(self, current=None):
         """returns the player after current or after activePlayer"""
@@ -909,7 +937,7 @@ class PlayingGame(Game):
         for player in self.players:
             assert player.hand.won == (player == self.winner), 'hand.won:%s winner:%s' % (
                 player.hand.won, player == self.winner)
-        Game.saveHand(self)
+        return Game.saveHand(self)
 
     def _mustExchangeSeats(self, pairs):
         """filter: which player pairs should really swap places?"""
@@ -999,3 +1027,39 @@ class PlayingGame(Game):
     def appendMove(self, player, command, kwargs):
         """append a Move object to self.moves"""
         self.moves.append(Move(player, command, kwargs))
+
+class ServerGame(PlayingGame):
+    """the central game instance on the server"""
+    # pylint: disable=too-many-arguments, too-many-public-methods
+    def __init__(self, names, ruleset, gameid=None, wantedGame=None,
+                client=None, playOpen=False, autoPlay=False):
+        PlayingGame.__init__(self, names, ruleset, gameid, wantedGame, client, playOpen, autoPlay)
+        self.shouldSave = True
+
+    def nameWallTiles(self):
+        """the game server knows all tiles: give the wall tiles their names"""
+        elementIter = iter(elements.all(self.ruleset))
+        wallSize = len(self.wall.tiles)
+        self.wall.tiles = []
+        for _ in range(wallSize):
+            self.wall.tiles.append(elementIter.next().concealed)
+
+    def throwDices(self):
+        """sets random living and kongBox
+        sets divideAt: an index for the wall break"""
+        self.wall.tiles.sort()
+        self.randomGenerator.shuffle(self.wall.tiles)
+        PlayingGame.throwDices(self)
+
+    def initHand(self):
+        """Happens only on server: every player gets 13 tiles (including east)"""
+        self.throwDices()
+        self.wall.divide()
+        for player in self.players:
+            player.clearHand()
+            # 13 tiles at least, with names as given by wall
+            player.addConcealedTiles(self.wall.deal([None] * 13))
+            # compensate boni
+            while len(player.concealedTiles) != 13:
+                player.addConcealedTiles(self.wall.deal())
+        PlayingGame.initHand(self)
@@ -23,7 +23,7 @@ import datetime
 from kde import KIcon
 from dialogs import WarningYesNo
 
-from qt import usingQt5, Qt, QVariant, RealQVariant, variantValue, QAbstractTableModel
+from qt import usingQt5, Qt, QVariant, RealQVariant, variantValue, QAbstractTableModel, QModelIndex
 from qt import QDialogButtonBox, QDialog, \
         QHBoxLayout, QVBoxLayout, QCheckBox, \
         QItemSelectionModel, QAbstractItemView
@@ -36,10 +36,17 @@ from common import Debug
 from modeltest import ModelTest
 
 class GamesModel(QAbstractTableModel):
-    """data for the list of games"""
+    """data for the list of games. The games are fetched on demand,
+    pageSize games at a time, ordered by their start time"""
+
+    pageSize = 200
+
     def __init__(self):
         QAbstractTableModel.__init__(self)
         self._resultRows = []
+        self.onlyPending = True
+        self.__exhausted = True
+        self.__lastGame = None # id and starttime of the last game fetched
 
     def columnCount(self, dummyParent=None):   # pylint: disable=no-self-use
         """including the hidden col 0"""
@@ -57,6 +64,64 @@ class GamesModel(QAbstractTableModel):
         finally:
             self.endResetModel()
 
+    def setFilter(self, onlyPending):
+        """forget all rows and fetch the first page"""
+        self.onlyPending = onlyPending
+        self.__exhausted = False
+        self.__lastGame = None
+        self.setResultset([])
+        self.fetchMore()
+
+    def canFetchMore(self, dummyParent=None):
+        """are there more games in the database?"""
+        return not self.__exhausted
+
+    def fetchMore(self, dummyParent=None):
+        """the next page. Only the games of that page are joined with
+        the players, see PrepareDB.indexes for the index used here.
+        The join may drop games, so the page and its end are found
+        without it"""
+        if self.__exhausted:
+            return
+        args = [self.pageSize + 1]
+        after = ''
+        if self.__lastGame:
+            after = 'and (starttime>? or (starttime=? and id>?)) '
+            args[0:0] = [self.__lastGame[1], self.__lastGame[1], self.__lastGame[0]]
+        games = Query("select id, starttime from game " \
+            "where seed is null " \
+            "%s%s" \
+            "and exists(select 1 from score s where s.game=game.id) " \
+            "order by starttime, id limit ?" % \
+            ("and endtime is null " if self.onlyPending else "", after), tuple(args)).records
+        # one more than a page tells us if there are more
+        self.__exhausted = len(games) <= self.pageSize
+        games = games[:self.pageSize]
+        if not games:
+            return
+        self.__lastGame = games[-1]
+        rows = Query("select g.id, g.starttime, " \
+            "p0.name||'///'||p1.name||'///'||p2.name||'///'||p3.name " \
+            "from game g, player p0, player p1, player p2, player p3 " \
+            "where g.id in (%s) " \
+            " and p0.id=g.p0 and p1.id=g.p1 " \
+            " and p2.id=g.p2 and p3.id=g.p3 " \
+            "order by g.starttime, g.id" % ','.join('?' * len(games)),
+            tuple(x[0] for x in games)).records
+        if rows:
+            self.beginInsertRows(QModelIndex(), len(self._resultRows), len(self._resultRows) + len(rows) - 1)
+            self._resultRows.extend(rows)
+            self.endInsertRows()
+
+    def removeGames(self, games):
+        """remove games from the model without fetching anything again"""
+        games = set(games)
+        for row in reversed(range(len(self._resultRows))):
+            if self._resultRows[row][0] in games:
+                self.beginRemoveRows(QModelIndex(), row, row)
+                del self._resultRows[row]
+                self.endRemoveRows()
+
     def index(self, row, column, dummyParent=None):
         """helper"""
         return self.createIndex(row, column, 0)
@@ -165,26 +230,21 @@ class Games(QDialog):
 
     def setQuery(self):
         """define the query depending on self.OnlyPending"""
-        query = Query("select g.id, g.starttime, " \
-            "p0.name||'///'||p1.name||'///'||p2.name||'///'||p3.name " \
-            "from game g, player p0," \
-            "player p1, player p2, player p3 " \
-            "where seed is null" \
-            " and p0.id=g.p0 and p1.id=g.p1 " \
-            " and p2.id=g.p2 and p3.id=g.p3 " \
-            "%s" \
-            "and exists(select 1 from score where game=g.id)" % \
-            ("and g.endtime is null " if self.onlyPending else ""))
-        self.model.setResultset(query.records)
+        self.model.setFilter(self.onlyPending)
         self.view.hideColumn(0)
 
     def __idxForGame(self, game):
-        """returns the model index for game"""
-        for row in range(self.model.rowCount()):
-            idx = self.model.index(row, 0)
-            if variantValue(self.model.data(idx, 0)) == game:
-                return idx
-        return self.model.index(0, 0)
+        """returns the model index for game, fetching until we have it"""
+        row = 0
+        while True:
+            for row in range(row, self.model.rowCount()):
+                idx = self.model.index(row, 0)
+                if variantValue(self.model.data(idx, 0)) == game:
+                    return idx
+            if not game or not self.model.canFetchMore():
+                return self.model.index(0, 0)
+            row = self.model.rowCount()
+            self.model.fetchMore()
 
     def __getSelectedGame(self):
         """returns the game id of the selected game"""
@@ -217,7 +277,8 @@ class Games(QDialog):
                 for game in games:
                     Query("DELETE FROM score WHERE game = ?", (game, ))
                     Query("DELETE FROM game WHERE id = ?", (game, ))
-                self.setQuery() # just reload entire table
+                self.model.removeGames(games)
+                self.selectionChanged()
         if usingQt5:
             deleteGames = list(x.data() for x in self.view.selectionModel().selectedRows(0))
         else:
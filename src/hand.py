@@ -22,17 +22,102 @@ Read the user manual for a description of the interface to this scoring engine
 """
 
 from itertools import chain
+from collections import OrderedDict
 import weakref
 
 from log import dbgIndent, fmt
-from tile import Tile, TileList
+from tile import Tile, TileList, TileCounts
 from meld import Meld, MeldList
 from rule import Score, UsedRule
-from common import Debug
+from shanten import Shanten
+from common import Debug, Options
 from intelligence import AIDefault
 from util import callers
 from message import Message
 
+class HandCache(object):
+    """a process wide cache for evaluated hands, shared by all players of
+    all games. The oldest unused entries are evicted if there are more than
+    Options.handCacheSize entries.
+
+    The key holds everything besides the hand string which influences the
+    evaluation. Hands which might rob a kong also depend on the robbed tile.
+    Once the hand has a winner, rules like EastWonNineTimesInARow also look
+    at the history of the game, so then the key holds the game and the hand
+    number. Before that, no rule looks at the history.
+
+    A Hand is only added when it is fully evaluated. While it is being
+    built it is in HandCache.building: LastOnlyPossible finds the calling
+    hands of the hand without the last tile, and that only ends because
+    adding the tile again returns the Hand being built.
+
+    The ruleset is identified by id(): Ruleset.cached returns one instance
+    per ruleset hash, and parameters like roofOff are attributes of that
+    instance. A cached Hand refers to its ruleset, so the id cannot be
+    reused while the entry exists."""
+
+    entries = OrderedDict()
+    building = {}
+    hits = 0
+    misses = 0
+    evictions = 0
+    shared = 0
+
+    def __init__(self):
+        raise Exception('HandCache is not meant to be instantiated')
+
+    @staticmethod
+    def key(player, string):
+        """returns the cache key"""
+        game = player.game
+        robbedTile = None
+        if game.moves:
+            lastMove = game.moves[-1]
+            if lastMove.message == Message.DeclaredKong and lastMove.player != player:
+                robbedTile = str(lastMove.meld[1])
+        winner = game.winner
+        history = (game.gameid, game.handctr, winner.wind) if winner else None
+        return (id(game.ruleset), player.wind, game.roundWind, player.mayWin,
+            game.notRotated, player.intelligence.name(), robbedTile, history, string)
+
+    @classmethod
+    def get(cls, key):
+        """returns the cached Hand or None"""
+        result = cls.entries.pop(key, None)
+        if result is None:
+            cls.misses += 1
+        else:
+            cls.hits += 1
+            cls.entries[key] = result # now it is the newest entry
+        return result
+
+    @staticmethod
+    def checkSize(size):
+        """returns an error message if size cannot be used"""
+        if size < 1:
+            return 'the HandCache needs at least one entry, not %d' % size
+
+    @classmethod
+    def add(cls, key, hand):
+        """add hand, evict the least recently used entries if needed"""
+        cls.entries[key] = hand
+        while len(cls.entries) > Options.handCacheSize:
+            cls.entries.popitem(last=False)
+            cls.evictions += 1
+
+    @classmethod
+    def clear(cls):
+        """clears the cache and its statistics"""
+        cls.entries.clear()
+        cls.building.clear()
+        cls.hits = cls.misses = cls.evictions = cls.shared = 0
+
+    @classmethod
+    def statistics(cls):
+        """a string for Debug.handCache"""
+        return 'HandCache: %d entries, hits:%d misses:%d evictions:%d shared:%d' % (
+            len(cls.entries), cls.hits, cls.misses, cls.evictions, cls.shared)
+
 class Hand(object):
     """represent the hand to be evaluated.
 
@@ -61,35 +146,74 @@ class Hand(object):
     was used for rearranging the hiden tiles to melds."""
     # pylint: disable=too-many-instance-attributes
 
+    __noChow = frozenset(['noChow'])
+    __concealed = frozenset(['concealed'])
+
     class __NotWon(UserWarning): # pylint: disable=invalid-name
         """should be won but is not a winning hand"""
 
-    def __new__(cls, player, string, prevHand=None): # pylint: disable=unused-argument
+    def __new__(cls, player, string, prevHand=None):
         """since a Hand instance is never changed, we can use a cache"""
-        cache = player.handCache
-        cacheKey = string
-        if cacheKey in cache:
-            result = cache[cacheKey]
-            player.cacheHits += 1
+        cacheKey = HandCache.key(player, string)
+        result = HandCache.building.get(cacheKey)
+        if result is not None and result.player is not player:
+            # only the player building it may see a Hand under construction
+            result = None
+        if result is None:
+            result = HandCache.get(cacheKey)
+        if result is not None:
+            if result.player is not player:
+                result = result.__sharedWith(player, prevHand)
             if Debug.hand:
-                result._player = weakref.ref(player) # pylint: disable=protected-access
                 result.debug(fmt(
                   '{callers}: cached Hand({id(result)} {string}) {result.lenOffset} {id(prevHand)}',
                     callers=callers(10, exclude=['__init__'])))
             return result
-        player.cacheMisses += 1
         result = object.__new__(cls)
-        cache[cacheKey] = result
+        result.__cacheKey = cacheKey
+        if cacheKey not in HandCache.building:
+            HandCache.building[cacheKey] = result
+        return result
+
+    def __sharedWith(self, player, prevHand):
+        """returns a shallow copy of self for another player. The evaluation
+        is shared, but everything referring to the player is not.
+        callingHands and shanten are computed later, the copy asks the
+        cached original for them. So the game server and the robot
+        clients running in its process search the winning tiles only once.
+        shanten only depends on the tiles and the ruleset, but callingHands
+        must hold Hands of our player, see callingHands."""
+        HandCache.shared += 1
+        result = object.__new__(Hand)
+        result.__dict__.update(self.__dict__)
+        result.__origin = self
+        result.__callingHands = None
+        result._player = weakref.ref(player) # pylint: disable=protected-access
+        result.intelligence = player.intelligence
+        result.prevHand = prevHand
+        result.indent = prevHand.indent + 1 if prevHand else 0
+        result.ruleCache = dict(self.ruleCache)
         return result
 
     def __init__(self, player, string, prevHand=None):
         """evaluate string for player. rules are to be applied in any case"""
-        # silence pylint. This method is time critical, so do not split it into smaller methods
-        # pylint: disable=too-many-instance-attributes,too-many-branches,too-many-statements
         if hasattr(self, 'string'):
             # I am from cache
             return
+        cacheKey = self.__cacheKey
+        try:
+            self.__evaluate(player, string, prevHand)
+        finally:
+            if HandCache.building.get(cacheKey) is self:
+                del HandCache.building[cacheKey]
+        HandCache.add(cacheKey, self)
+
+    def __evaluate(self, player, string, prevHand):
+        """the work for __init__"""
+        # silence pylint. This method is time critical, so do not split it into smaller methods
+        # pylint: disable=too-many-instance-attributes,too-many-branches,too-many-statements
         self._player = weakref.ref(player)
+        self.__origin = None
         self.indent = prevHand.indent + 1 if prevHand else 0
 
         # two shortcuts for speed:
@@ -101,6 +225,7 @@ class Hand(object):
         self.__won = None
         self.__score = None
         self.__callingHands = None
+        self.__shanten = None
         self.mjStr = ''
         self.__mjRule = None
         self.ruleCache = {}
@@ -118,6 +243,7 @@ class Hand(object):
                     tileStrings.append(part)
 
         self.__lastTile = self.__lastSource = self.__announcements = ''
+        self.__tileFeatures = self.__features = None
         self.__lastMeld = 0
         self.__lastMelds = MeldList()
         self.melds = MeldList()
@@ -125,6 +251,7 @@ class Hand(object):
         tileString = ' '.join(tileStrings)
         self.tiles = TileList(tileString.replace(' ', '').replace('R', ''))
         self.tiles.sort()
+        self.__counts = None
         self.values = tuple(x.value for x in self.tiles)
         self.suits = set(x.lowerGroup for x in self.tiles)
         for part in tileStrings[:]:
@@ -145,7 +272,7 @@ class Hand(object):
         self.usedRules = None
         if Debug.hand:
             self.debug(fmt('{callers}: new Hand({id(self)} {string} {self.lenOffset} {id(prevHand)})',
-                callers=callers(10, exclude=['__init__'])))
+                callers=callers(10, exclude=['__init__', '__evaluate'])))
         self.__arranged = None
         self.__won = self.lenOffset == 1 and self.player.mayWin
         try:
@@ -267,11 +394,11 @@ class Hand(object):
     def __applyRules(self):
         """find out which rules apply, collect in self.usedRules"""
         self.usedRules = []
+        self.__features = features = self.__computeFeatures()
         for meld in chain(self.melds, self.bonusMelds):
             self.usedRules.extend(UsedRule(x, meld) for x in meld.rules(self))
-        for rule in self.ruleset.handRules:
-            if rule.appliesToHand(self):
-                self.usedRules.append(UsedRule(rule))
+        self.usedRules.extend(UsedRule(x) for x in self.ruleset.matchingRules(
+            self.ruleset.handRules, self, features))
 
         self.__score = self.__totalScore()
 
@@ -469,9 +596,34 @@ class Hand(object):
         be available.
         """
         if self.__callingHands is None:
-            self.__callingHands = self.__findAllCallingHands()
+            origin = self.__origin
+            if origin is not None and (origin.__callingHands is not None or origin.player is not None):
+                # the winning tiles do not depend on the player but the Hands do.
+                # They are in the HandCache, this only makes copies for our player
+                self.__callingHands = list(
+                    Hand(self.player, x.string, prevHand=self) for x in origin.callingHands)
+            else:
+                self.__callingHands = self.__findAllCallingHands()
         return self.__callingHands
 
+    @property
+    def counts(self):
+        """the TileCounts of all tiles. Only computed when a rule asks for it"""
+        if self.__counts is None:
+            self.__counts = self.tiles.counts()
+        return self.__counts
+
+    @property
+    def shanten(self):
+        """how many tiles are missing for Mah Jongg and which tiles would help.
+        See class Shanten"""
+        if self.__shanten is None:
+            if self.__origin is not None:
+                self.__shanten = self.__origin.shanten
+            else:
+                self.__shanten = Shanten(self)
+        return self.__shanten
+
     def __findAllCallingHands(self):
         """always try to find all of them"""
         result = []
@@ -557,9 +709,48 @@ class Hand(object):
             if mjRules:
                 self.mjRule = mjRules[0]
             return
+        arrangements = self.__arrangements()
+        firstVariant = list(arrangements[0][1])
+        if all(list(x[1]) == firstVariant for x in arrangements[1:]):
+            # nothing to compare, our own evaluation will do the rest
+            bestRule, bestVariant = arrangements[0]
+        else:
+            bestRule, bestVariant = self.__bestArrangement(arrangements)
+        self.mjRule = bestRule
+        self.melds.extend(bestVariant)
+        self.melds.sort()
+        self.__rest = []
+        self.ruleCache.clear()
+        assert sum(len(x) for x in self.melds) == len(self.tiles), '%s != %s' % (
+            self.melds, self.tiles)
+
+    def __bestArrangement(self, arrangements):
+        """build a Hand for every arrangement and return mjRule and melds of the best.
+        If we might win with standard rules, first try only arrangements which can win"""
+        stdMJ = self.ruleset.standardMJRule
+        if self.__won and all(x[0] is stdMJ for x in arrangements):
+            mayWin = [x for x in arrangements if self.__mayWinWith(x[1])]
+            if mayWin and len(mayWin) < len(arrangements):
+                wonHands, _ = self.__tryArrangements(mayWin)
+                if wonHands:
+                    return max(wonHands, key=lambda x: x[2])[:2]
+        wonHands, lostHands = self.__tryArrangements(arrangements)
+        # we prefer a won Hand even if a lost Hand might have a higher score
+        tryHands = wonHands if wonHands else lostHands
+        return max(tryHands, key=lambda x: x[2])[:2]
+
+    def __mayWinWith(self, melds):
+        """can the standard rule accept melds at all?"""
+        allMelds = list(chain(self.melds, melds))
+        return (len(allMelds) == 5
+            and all(1 < len(x) < 5 for x in allMelds)
+            and sum(x.isChow for x in allMelds) <= self.ruleset.maxChows)
+
+    def __tryArrangements(self, arrangements):
+        """returns won and lost Hands for all arrangements"""
         wonHands = []
         lostHands = []
-        for mjRule, melds in self.__arrangements():
+        for mjRule, melds in arrangements:
             _ = ' '.join(str(x) for x in sorted(chain(self.melds, melds, self.bonusMelds))) + ' ' + self.mjStr
             tryHand = Hand(self.player, _, prevHand=self)
             if tryHand.won:
@@ -567,16 +758,7 @@ class Hand(object):
                 wonHands.append((mjRule, melds, tryHand))
             else:
                 lostHands.append((mjRule, melds, tryHand))
-        # we prefer a won Hand even if a lost Hand might have a higher score
-        tryHands = wonHands if wonHands else lostHands
-        bestRule, bestVariant, _ = max(tryHands, key=lambda x: x[2])
-        self.mjRule = bestRule
-        self.melds.extend(bestVariant)
-        self.melds.sort()
-        self.__rest = []
-        self.ruleCache.clear()
-        assert sum(len(x) for x in self.melds) == len(self.tiles), '%s != %s' % (
-            self.melds, self.tiles)
+        return wonHands, lostHands
 
     def __gt__(self, other):
         """compares hand values"""
@@ -601,7 +783,49 @@ class Hand(object):
 
     def __matchingRules(self, rules):
         """return all matching rules for this hand"""
-        return list(rule for rule in rules if rule.appliesToHand(self))
+        return self.ruleset.matchingRules(rules, self, self.features())
+
+    def features(self):
+        """a frozenset with what RuleCode.needs can ask for. Every feature
+        is a necessary condition for the rules needing it, so those rules
+        will not be evaluated for hands lacking it"""
+        if self.__features is None:
+            self.__features = self.__computeFeatures()
+        return self.__features
+
+    def __computeFeatures(self):
+        """the features for the current arrangement of melds"""
+        if self.__tileFeatures is None:
+            self.__tileFeatures = self.__computeTileFeatures()
+        result = self.__tileFeatures
+        if not any(x.isChow for x in self.melds):
+            result = result | self.__noChow
+        if not any((x.isExposed and not x.isClaimedKong) for x in self.melds):
+            result = result | self.__concealed
+        return result
+
+    def __computeTileFeatures(self):
+        """the features which do not depend on how tiles are arranged into melds"""
+        counts = self.counts
+        result = set()
+        if self.bonusMelds:
+            result.add('bonus')
+        honors = set(Tile.honors)
+        if self.suits & honors:
+            result.add('honors')
+        if len(self.suits - honors) == 1:
+            result.add('oneSuit')
+        if counts.only(TileCounts.majors):
+            result.add('onlyMajors')
+        if all(counts[x] >= 2 for x in TileCounts.dragons):
+            result.add('threeDragons')
+        if all(counts[x] >= 2 for x in TileCounts.winds):
+            result.add('fourWinds')
+        if len(self.tiles) == 18:
+            result.add('fourKongs')
+        if self.lastSource:
+            result.add('source ' + self.lastSource)
+        return frozenset(result)
 
     @staticmethod
     def maxLimitRule(usedRules):
@@ -32,7 +32,7 @@ from kde import usingKDE, KIcon, KDialog
 from dialogs import Sorry, Information, QuestionYesNo, KDialogIgnoringEscape
 from guiutil import decorateWindow
 from log import m18n, logWarning, logException, logDebug
-from message import Message, ChatMessage
+from message import Message, ChatMessage, MoveCodec
 from chat import ChatWindow
 from common import Options, SingleshotOptions, Internal, Debug, isAlive
 from query import Query
@@ -387,10 +387,16 @@ class HumanClient(Client):
                 logDebug('%s sends own voice %s to server' % (self.name, voiceId))
         maxGameId = Query('select max(id) from game').records[0][0]
         maxGameId = int(maxGameId) if maxGameId else 0
+        self.moveCodec = MoveCodec()
+        self.callServer('useCompactMoves', Message.registryHash()).addErrback(self.__noCompactMoves)
         self.callServer('setClientProperties',
             Internal.db.identifier,
             voiceId, maxGameId, Internal.version).addCallbacks(self.__initTableList, self.__versionError)
 
+    @staticmethod
+    def __noCompactMoves(dummyFailure):
+        """older servers do not know useCompactMoves, they keep sending jellied moves"""
+
     def __initTableList(self, dummy):
         """first load of the list. Process options like --demo, --table, --join"""
         self.showTableList()
@@ -483,8 +489,12 @@ class HumanClient(Client):
             return tables
         rulesetHashes = set(x[1] for x in tables)
         needRulesets = list(x for x in rulesetHashes if not Ruleset.hashIsKnown(x))
+        def fullRulesets(dummyResult):
+            """the server does not know needRulesetDiffs"""
+            return self.callServer('needRulesets', needRulesets)
         if needRulesets:
-            self.callServer('needRulesets', needRulesets).addCallback(gotRulesets).addCallback(self.__receiveTables)
+            self.callServer('needRulesetDiffs', needRulesets).addErrback(fullRulesets).addCallback(
+                gotRulesets).addCallback(self.__receiveTables)
         else:
             self.__receiveTables(tables)
 
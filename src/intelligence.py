@@ -23,6 +23,7 @@ import weakref
 from message import Message
 from common import IntDict, Debug
 from tile import Tile
+from shanten import Shanten
 
 class AIDefault(object):
     """all AI code should go in here"""
@@ -205,6 +206,10 @@ class AIDefault(object):
     def weighCallingHand(aiInstance, candidates):
         """if we can get a calling hand, prefer that"""
         for candidate in candidates:
+            shanten = Shanten.afterDiscard(candidates.hand, candidate.tile)
+            if shanten is not None and shanten > 0:
+                # cheap test without building the Hand: this discard cannot give a calling hand
+                continue
             newHand = candidates.hand - candidate.tile.concealed
             winningTiles = newHand.chancesToWin()
             if winningTiles:
@@ -25,6 +25,8 @@ import signal
 signal.signal(signal.SIGINT, signal.SIG_DFL)
 
 import os, sys, csv, subprocess, random, shutil, time, gc
+import threading
+from Queue import Queue, Empty
 from tempfile import mkdtemp
 
 from optparse import OptionParser
@@ -74,7 +76,7 @@ class Clone(object):
     def removeUnused(cls):
         """remove clones we do not use anymore"""
         for commitId in cls.clones.keys():
-            if not any(x.commitId == commitId for x in Server.servers):
+            if not any(x.commitId == commitId for x in Server.servers + Worker.workers):
                 cls.clones[commitId].remove()
 
     @classmethod
@@ -198,6 +200,64 @@ class Server(object):
     def __str__(self):
         return '{} pid={} sock={}'.format(self.commitId, self.process.pid, self.socketName)
 
+class Worker(object):
+    """a long lived simulator process for one commit, see simulator.work.
+    It imports the engine once and plays one job after the other without
+    game server and clients. A thread reads the results and puts them
+    into the results queue together with the worker."""
+    workers = []
+    def __init__(self, commitId, results):
+        self.commitId = commitId
+        self.clone = Clone(commitId)
+        self.job = None
+        srcDir = os.path.join(self.clone.tmpdir, 'src')
+        if not os.path.exists(os.path.join(srcDir, 'simulator.py')):
+            raise UserWarning('commit {} cannot be tested with --workers, it has no simulator'.format(commitId))
+        cmd = [sys.executable, os.path.join(srcDir, 'simulator.py')]
+        if OPTIONS.rounds:
+            cmd.append('--rounds={rounds}'.format(rounds=OPTIONS.rounds))
+        if OPTIONS.debug:
+            cmd.append('--debug={dbg}'.format(dbg=','.join(OPTIONS.debug)))
+        self.process = subprocess.Popen(cmd, cwd=srcDir,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.workers.append(self)
+        reader = threading.Thread(target=self.__readResults, args=(results,))
+        reader.daemon = True
+        reader.start()
+
+    def __readResults(self, results):
+        """runs in its own thread. None means the worker has ended"""
+        for line in iter(self.process.stdout.readline, ''):
+            results.put((self, line))
+        results.put((self, None))
+
+    def start(self, job):
+        """let the worker play job"""
+        assert self.job is None, '{} is still busy with {}'.format(self, self.job)
+        self.job = job
+        job.started = True
+        print('starting            %s' % job)
+        csv.writer(self.process.stdin, delimiter=';').writerow(
+            [job.game, job.ruleset, job.aiVariant])
+        self.process.stdin.flush()
+
+    def stop(self):
+        """the worker ends after the job it is playing"""
+        if self in self.workers:
+            self.workers.remove(self)
+            self.process.stdin.close()
+            self.process.wait()
+            Clone.removeUnused()
+
+    @classmethod
+    def stopAll(cls):
+        """stop all workers"""
+        for worker in cls.workers[:]:
+            worker.stop()
+
+    def __str__(self):
+        return 'worker {} pid={}'.format(self.commitId, self.process.pid)
+
 class Job(object):
     """a simple container"""
     def __init__(self, ruleset, aiVariant, commitId, game):
@@ -439,12 +499,6 @@ def doJobs():
     """now execute all jobs"""
     # pylint: disable=too-many-branches, too-many-locals, too-many-statements
 
-    if not OPTIONS.git and OPTIONS.csv:
-        if gitHead() in ('current', None):
-            print('Disabling CSV output: %s' % ('You have uncommitted changes' if gitHead() == 'current' else 'No git'))
-            print()
-            OPTIONS.csv = None
-
     try:
         jobs = []
         while getJobs(jobs):
@@ -477,6 +531,66 @@ def doJobs():
                         job.process.wait()
             time.sleep(1)
 
+def assignWorkerJobs(jobs, results):
+    """start as many jobs as there are idle workers, starting new workers
+    for other commits if needed. Returns the jobs not yet started"""
+    for job in jobs[:]:
+        idle = list(x for x in Worker.workers if x.job is None)
+        worker = next((x for x in idle if x.commitId == job.commitId), None)
+        if worker is None and len(Worker.workers) >= OPTIONS.workers:
+            unwanted = list(x for x in idle if not any(y.commitId == x.commitId for y in jobs))
+            if not unwanted:
+                continue
+            unwanted[0].stop()
+        if worker is None:
+            worker = Worker(job.commitId, results)
+        worker.start(job)
+        jobs.remove(job)
+    return jobs
+
+def doWorkerJobs():
+    """execute all jobs with OPTIONS.workers long lived simulator processes.
+    Wait for results, never poll"""
+    results = Queue()
+    try:
+        jobs = []
+        while True:
+            while len(jobs) < 2 * OPTIONS.workers:
+                try:
+                    jobs.append(next(OPTIONS.jobs))
+                except StopIteration:
+                    break
+            jobs = assignWorkerJobs(jobs, results)
+            if not any(x.job for x in Worker.workers):
+                break
+            try:
+                # with a timeout, python2 still handles signals while waiting
+                worker, line = results.get(True, 3600)
+            except Empty:
+                continue
+            if worker not in Worker.workers:
+                # we stopped it ourselves
+                continue
+            job, worker.job = worker.job, None
+            if line is None:
+                print('   Worker ended unexpectedly: %s: %s' % (worker, job))
+                worker.stop()
+                continue
+            row = next(csv.reader([line], delimiter=';'))
+            if row[0] == 'OK':
+                print('   Game over: %s' % job)
+                if OPTIONS.csv:
+                    with open(OPTIONS.csv, 'a') as csvFile:
+                        csv.writer(csvFile, delimiter=';').writerow(row[1:])
+            else:
+                print('   Game failed: %s: %s' % (job, row[-1]))
+    except UserWarning as exc:
+        print(exc)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        Worker.stopAll()
+
 def parse_options():
     """parse options"""
     parser = OptionParser()
@@ -511,6 +625,10 @@ def parse_options():
     parser.add_option('', '--servers', dest='servers',
         help='start a maximum of SERVERS kajonggserver instances. Default is 1',
         metavar='SERVERS', type=int, default=1)
+    parser.add_option('', '--workers', dest='workers',
+        help='play the games in WORKERS simulator processes without game servers and clients.'
+            ' WORKERS should be the number of CPU cores. Default is 0: use servers and clients',
+        metavar='WORKERS', type=int, default=0)
     parser.add_option('', '--git', dest='git',
         help='check all commits: either a comma separated list or a range from..until')
     parser.add_option('', '--debug', dest='debug',
@@ -523,6 +641,9 @@ def improve_options():
     # pylint: disable=too-many-branches,too-many-statements
     if OPTIONS.servers < 1:
         OPTIONS.servers = 1
+    if OPTIONS.workers and (OPTIONS.gui or OPTIONS.log):
+        print('--workers cannot be used together with --gui or --log')
+        sys.exit(2)
 
     cmdPath = os.path.join(startingDir(), 'kajongg.py')
     cmd = ['python', cmdPath, '--rulesets=']
@@ -630,13 +751,23 @@ def main():
 
     print()
 
-    doJobs()
+    if not OPTIONS.git and OPTIONS.csv:
+        if gitHead() in ('current', None):
+            print('Disabling CSV output: %s' % ('You have uncommitted changes' if gitHead() == 'current' else 'No git'))
+            print()
+            OPTIONS.csv = None
+
+    if OPTIONS.workers:
+        doWorkerJobs()
+    else:
+        doJobs()
     if OPTIONS.csv:
         evaluate(readGames(OPTIONS.csv))
 
 def cleanup(sig, dummyFrame):
     """at program end"""
     Server.stopAll()
+    Worker.stopAll()
     Clone.removeAll()
     sys.exit(sig)
 
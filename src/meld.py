@@ -133,6 +133,15 @@ class Meld(TileList):
                 TileList.__setattr__(self, 'exposedClaimed',
                     Meld(TileList([self[0].exposed, self[1].exposed, self[2].exposed, self[3].concealed])))
 
+    @classmethod
+    def clearRules(cls):
+        """forget which rules apply to the cached melds"""
+        for meld in dict((id(x), x) for x in cls.cache.values()).values():
+            for rules in (meld.__staticRules, meld.__dynamicRules,
+                    meld.__staticDoublingRules, meld.__dynamicDoublingRules):
+                rules.clear()
+            meld.__hasRules = meld.__hasDoublingRules = None
+
     def __setattr__(self, name, value):
         if (hasattr(self, '_fixed')
             and not name.endswith('__hasRules')
@@ -19,10 +19,11 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 """
 
 import datetime
+from hashlib import md5
 
 from log import m18n, m18nc, m18ncE, logWarning, logException, logDebug
 from sound import Voice, Sound
-from tile import Tile, TileList
+from tile import Tile, TileList, TileCounts
 from meld import Meld, MeldList
 from common import Internal, Debug
 from dialogs import Sorry
@@ -88,6 +89,168 @@ class Message(object):
             kwargs2[key] = Message.jelly(key, value)
         return args2, kwargs2
 
+    @staticmethod
+    def registryHash():
+        """client and server may only use MoveCodec if they agree about this"""
+        return md5(' '.join(sorted(Message.defined))).hexdigest()
+
+class MoveCodec(object):
+    """a compact encoding for move messages from the server to one client.
+    Server and client each hold one instance per connection. Both must
+    see every move in the same order because words and deltas
+    refer to the previous moves.
+
+    The payload is a flat list: message id, about, and then key and value
+    for every keyword argument. The message id is the index into the sorted
+    names of Message.defined. Names of players and keys are sent once,
+    afterwards only their index. Tiles are sent as integers, melds
+    as lists of integers. For score and token only the
+    part differing from the previous value for the same player is sent.
+    The decoder returns exactly what Message.jelly would have returned."""
+
+    deltaKeys = ('score', 'token')
+    tileCodes = {}
+    codeTiles = {}
+
+    def __init__(self):
+        self.messages = sorted(Message.defined)
+        self.messageIds = dict((x, idx) for idx, x in enumerate(self.messages))
+        self.words = []
+        self.wordIds = {}
+        self.lastValues = {}
+        if not MoveCodec.tileCodes:
+            MoveCodec.fillTables()
+
+    @staticmethod
+    def fillTables():
+        """every exposed or concealed tile with a code"""
+        for tile in TileCounts.tileOf:
+            if tile is not None:
+                for variant, flag in ((tile.exposed, 0), (tile.concealed, 64)):
+                    MoveCodec.tileCodes[variant] = tile.code | flag
+                    MoveCodec.codeTiles[tile.code | flag] = variant
+
+    @staticmethod
+    def tileKind(key):
+        """the Move attribute type for key: tile, tiles, meld, melds or None"""
+        key = key.lower()
+        for kind in ('tiles', 'tile', 'melds', 'meld'):
+            if key.endswith(kind):
+                return kind
+
+    def __encodeWord(self, word):
+        """the index if the receiver already knows word"""
+        if word in self.wordIds:
+            return self.wordIds[word]
+        self.wordIds[word] = len(self.words)
+        self.words.append(word)
+        return word
+
+    def __decodeWord(self, word):
+        """the inverse of __encodeWord"""
+        if isinstance(word, int):
+            return self.words[word]
+        self.wordIds[word] = len(self.words)
+        self.words.append(word)
+        return word
+
+    def __delta(self, about, key, value):
+        """a list with the length of the common prefix and the new rest"""
+        last = self.lastValues.get((about, key))
+        self.lastValues[(about, key)] = value
+        if not isinstance(value, str) or not isinstance(last, str):
+            return value
+        common = 0
+        for common, (char1, char2) in enumerate(zip(last, value)):
+            if char1 != char2:
+                break
+        else:
+            common = min(len(last), len(value))
+        return [common, value[common:]]
+
+    def __undelta(self, about, key, value):
+        """the inverse of __delta"""
+        if isinstance(value, list):
+            value = self.lastValues[(about, key)][:value[0]] + value[1]
+        self.lastValues[(about, key)] = value
+        return value
+
+    def __encodeTiles(self, tiles):
+        """a list of codes or None"""
+        codes = self.tileCodes
+        if tiles and all(x in codes for x in tiles):
+            return list(codes[x] for x in tiles)
+
+    def __encodeJellied(self, kind, value):
+        """like __encodeValue for a value already jellied by Message.jelly,
+        like moves relayed for a worker. None if we cannot"""
+        if kind == 'tile':
+            return self.tileCodes.get(value)
+        if kind == 'melds':
+            result = list(self.__encodeJellied('meld', x) for x in value.split(' '))
+            return None if None in result else result
+        return self.__encodeTiles(list(value[x:x + 2] for x in range(0, len(value), 2)))
+
+    def __encodeValue(self, key, value):
+        """compact if possible, otherwise what Message.jelly produces"""
+        kind = self.tileKind(key)
+        cls = value.__class__
+        if kind and cls is str:
+            result = self.__encodeJellied(kind, value)
+            if result is not None:
+                return result
+        elif kind == 'tile' and cls is Tile and value in self.tileCodes:
+            return self.tileCodes[value]
+        elif kind in ('tiles', 'meld') and cls in (TileList, Meld):
+            result = self.__encodeTiles(value)
+            if result is not None:
+                return result
+        elif kind == 'melds' and cls is MeldList and value:
+            result = list(self.__encodeTiles(x) for x in value)
+            if None not in result:
+                return result
+        return Message.jelly(key, value)
+
+    def __decodeValue(self, key, value):
+        """the inverse of __encodeValue"""
+        kind = self.tileKind(key)
+        if kind is None:
+            return value
+        tiles = self.codeTiles
+        if type(value) is int: # pylint: disable=unidiomatic-typecheck
+            return str(tiles[value])
+        if isinstance(value, list) and value and not isinstance(value[0], basestring):
+            if kind == 'melds':
+                return ' '.join(''.join(tiles[x] for x in meld) for meld in value)
+            return ''.join(tiles[x] for x in value)
+        return value
+
+    def encode(self, about, command, kwargs):
+        """the payload for about, command and the keyword arguments"""
+        result = [self.messageIds[command.name], self.__encodeWord(about)]
+        for key, value in kwargs.items():
+            if key in self.deltaKeys:
+                value = self.__delta(about, key, value)
+            else:
+                value = self.__encodeValue(key, value)
+            result.append(self.__encodeWord(key))
+            result.append(value)
+        return result
+
+    def decode(self, payload):
+        """returns about, the command name and kwargs like Message.jellyAll would"""
+        command = self.messages[payload[0]]
+        about = self.__decodeWord(payload[1])
+        kwargs = {}
+        for idx in range(2, len(payload), 2):
+            key = self.__decodeWord(payload[idx])
+            value = payload[idx + 1]
+            if key in self.deltaKeys:
+                kwargs[key] = self.__undelta(about, key, value)
+            else:
+                kwargs[key] = self.__decodeValue(key, value)
+        return about, command, kwargs
+
 class ServerMessage(Message):
     """those classes are used for messages from server to client"""
     # if sendScore is True, this message will send info about player scoring, so the clients can compare
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2014 Wolfgang Rohdewald <wolfgang@rohdewald.de>
+
+Kajongg is free software you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+Counters, gauges and histograms of this process in the text format
+of Prometheus. kajonggserver --metrics serves them over HTTP.
+"""
+
+import os, stat
+from bisect import bisect_left
+
+class Metric(object):
+    """the common part. Values are kept per tuple of label values"""
+    kind = None
+    registry = []
+
+    def __init__(self, name, helpText, labelNames=()):
+        self.name = name
+        self.helpText = helpText
+        self.labelNames = labelNames
+        self.values = {}
+        Metric.registry.append(self)
+
+    def labelText(self, labels, extra=None):
+        """the {a="b"} part"""
+        pairs = list(zip(self.labelNames, labels))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+            for name, value in pairs)
+
+    def samples(self):
+        """yield lines with the current values"""
+        for labels, value in sorted(self.values.items()):
+            yield '%s%s %s' % (self.name, self.labelText(labels), formatValue(value))
+
+    def exposition(self):
+        """all about us in the text format"""
+        yield '# HELP %s %s' % (self.name, self.helpText)
+        yield '# TYPE %s %s' % (self.name, self.kind)
+        for line in self.samples():
+            yield line
+
+    @staticmethod
+    def render():
+        """all metrics in the text format"""
+        return ''.join(line + '\n' for metric in Metric.registry for line in metric.exposition())
+
+class Counter(Metric):
+    """only goes up"""
+    kind = 'counter'
+
+    def inc(self, labels=(), value=1):
+        """count"""
+        self.values[labels] = self.values.get(labels, 0) + value
+
+class Gauge(Metric):
+    """the value is asked for when rendering"""
+    kind = 'gauge'
+
+    def __init__(self, name, helpText, function=None):
+        Metric.__init__(self, name, helpText)
+        self.function = function
+
+    def samples(self):
+        """we have no labels"""
+        if self.function:
+            yield '%s %s' % (self.name, formatValue(self.function()))
+
+class CounterFunction(Gauge):
+    """a counter kept elsewhere, like the HandCache statistics"""
+    kind = 'counter'
+
+class Histogram(Metric):
+    """how many observations were up to each bucket limit"""
+    kind = 'histogram'
+    secondBuckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name, helpText, labelNames=(), buckets=None):
+        Metric.__init__(self, name, helpText, labelNames)
+        self.buckets = tuple(buckets or self.secondBuckets)
+
+    def observe(self, value, labels=()):
+        """count value in its bucket. values holds the bucket counts, the sum and the count"""
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def samples(self):
+        """cumulative buckets, sum and count"""
+        for labels, (counts, total, count) in sorted(self.values.items()):
+            cumulated = 0
+            for limit, bucketCount in zip(self.buckets + ('+Inf', ), counts):
+                cumulated += bucketCount
+                yield '%s_bucket%s %d' % (self.name, self.labelText(
+                    labels, ('le', limit if limit == '+Inf' else formatValue(limit))), cumulated)
+            yield '%s_sum%s %s' % (self.name, self.labelText(labels), formatValue(total))
+            yield '%s_count%s %d' % (self.name, self.labelText(labels), count)
+
+def formatValue(value):
+    """as Prometheus wants it"""
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+Moves = Counter('kajongg_moves_total', 'moves told to the players', ('message', ))
+AnswerSeconds = Histogram('kajongg_answer_seconds',
+    'time between asking a player and getting the answer', ('message', ))
+RobotSeconds = Histogram('kajongg_robot_decision_seconds', 'time a robot needs to select its answer')
+DBCommitSeconds = Histogram('kajongg_db_commit_seconds', 'time for one transaction of the DBWriter')
+
+def serve(where):
+    """serve all metrics over HTTP at /metrics. where is a port on localhost
+    or the path of a UNIX socket"""
+    from twisted.internet import reactor
+    from twisted.web.resource import Resource
+    from twisted.web.server import Site
+
+    class MetricsResource(Resource):
+        """the text format, freshly rendered"""
+        isLeaf = True
+        def render_GET(self, request): # pylint: disable=invalid-name
+            """twisted.web calls this"""
+            request.setHeader('content-type', 'text/plain; version=0.0.4')
+            return Metric.render()
+
+    root = Resource()
+    root.putChild('metrics', MetricsResource())
+    if str(where).isdigit():
+        return reactor.listenTCP(int(where), Site(root), interface='127.0.0.1')
+    if os.path.exists(where) and stat.S_ISSOCK(os.stat(where).st_mode):
+        # left over from a server which did not stop cleanly
+        os.remove(where)
+    return reactor.listenUNIX(where, Site(root))
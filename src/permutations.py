@@ -22,10 +22,137 @@ Read the user manual for a description of the interface to this scoring engine
 """
 
 import itertools
+import mmap
+import os
+import struct
+import sys
+from collections import OrderedDict
 
 from tile import Tile
 from meld import Meld, MeldList
 
+class PermutationTable(object):
+    """Permutations.usefulPermutations precomputed for every group of
+    adjacent values a hand can hold. Build it by running this module,
+    it is read with mmap so processes share it and start without
+    computing anything. Groups not in the table are computed as before.
+
+    Format: a header with magic and entry count, the entries sorted by key,
+    and the data. The key holds the count of every value 1..9. The data
+    for one key is the number of variants, and per variant the number of
+    melds and one byte per meld: kind * 16 + first value."""
+
+    magic = b'KJP1'
+    header = struct.Struct('<4sI')
+    entry = struct.Struct('<9sI')
+    kinds = ('single', 'pair', 'pung', 'chow')
+    maxTiles = 14
+    fileName = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'permutations.tbl')
+
+    def __init__(self, fileName=None):
+        self.data = None
+        self.size = 0
+        try:
+            with open(fileName or self.fileName, 'rb') as tableFile:
+                data = mmap.mmap(tableFile.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError):
+            return
+        if data.size() < self.header.size or self.header.unpack_from(data)[0] != self.magic:
+            data.close()
+            return
+        self.data = data
+        self.size = self.header.unpack_from(data)[1]
+
+    @staticmethod
+    def key(values):
+        """the counts of values 1..9"""
+        return bytes(bytearray(values.count(x) for x in range(1, 10)))
+
+    def get(self, values):
+        """the useful permutations for values or None"""
+        if not self.size:
+            return None
+        key = self.key(values)
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            entryKey, offset = self.entry.unpack_from(
+                self.data, self.header.size + middle * self.entry.size)
+            if entryKey < key:
+                low = middle + 1
+            elif entryKey > key:
+                high = middle
+            else:
+                return self.__decode(offset)
+        return None
+
+    def __decode(self, offset):
+        """the variants stored at offset"""
+        data = self.data
+        variantCount = bytearray(data[offset:offset + 1])[0]
+        offset += 1
+        result = []
+        for _ in range(variantCount):
+            meldCount = bytearray(data[offset:offset + 1])[0]
+            codes = bytearray(data[offset + 1:offset + 1 + meldCount])
+            offset += 1 + meldCount
+            result.append(tuple(self.__meld(x) for x in codes))
+        return tuple(result)
+
+    @staticmethod
+    def __meld(code):
+        """a meld as a tuple of values"""
+        kind, value = divmod(code, 16)
+        if kind == 3:
+            return (value, value + 1, value + 2)
+        return (value,) * (kind + 1)
+
+    @staticmethod
+    def __encode(variants):
+        """the inverse of __decode"""
+        result = bytearray([len(variants)])
+        for variant in variants:
+            result.append(len(variant))
+            for meld in variant:
+                if len(meld) == 3 and meld[0] != meld[1]:
+                    kind = 3
+                else:
+                    kind = len(meld) - 1
+                result.append(kind * 16 + meld[0])
+        return bytes(result)
+
+    @classmethod
+    def groups(cls, maxTiles=None):
+        """all groups of adjacent values with up to maxTiles tiles"""
+        maxTiles = maxTiles or cls.maxTiles
+        for start in range(1, 10):
+            for length in range(1, min(11 - start, maxTiles + 1)):
+                for counts in itertools.product(range(1, 5), repeat=length):
+                    if sum(counts) <= maxTiles:
+                        yield tuple(value for idx, count in enumerate(counts)
+                            for value in [start + idx] * count)
+
+    @classmethod
+    def write(cls, fileName, maxTiles=None):
+        """build the table. A smaller maxTiles gives a partial table"""
+        entries = sorted((cls.key(x), Permutations.computeUseful(x)) for x in cls.groups(maxTiles))
+        offset = cls.header.size + len(entries) * cls.entry.size
+        index = []
+        data = []
+        for key, variants in entries:
+            encoded = cls.__encode(variants)
+            index.append(cls.entry.pack(key, offset))
+            data.append(encoded)
+            offset += len(encoded)
+        with open(fileName, 'wb') as tableFile:
+            tableFile.write(cls.header.pack(cls.magic, len(entries)))
+            tableFile.write(b''.join(index))
+            tableFile.write(b''.join(data))
+        table = PermutationTable(fileName)
+        for key, variants in entries:
+            assert table.get(tuple(value for value, count in enumerate(bytearray(key), 1)
+                for _ in range(count))) == variants, key
+
 class Permutations(object):
     """creates permutations for building melds out of single tiles.
     NEVER returns Kongs!"""
@@ -106,6 +233,7 @@ class Permutations(object):
         return result
 
     colorPermCache = {}
+    table = PermutationTable()
 
     @classmethod
     def usefulPermutations(cls, values):
@@ -114,36 +242,61 @@ class Permutations(object):
         This is meant for the standard MJ format (4 pungs/kongs/chows plus 1 pair)"""
         values = tuple(values)
         if values not in cls.colorPermCache:
-            variants = cls.permute(values)
-            result = []
-            maxPungs = -1
-            maxPungVariant = minMeldVariant = None
-            minMelds = 99
-            for variant in variants:
-                if all(len(meld) > 1 for meld in variant):
-                    # no singles: usable for MJ
-                    result.append(variant)
-                if len(variant) < minMelds:
-                    minMelds = len(variant)
-                    minMeldVariant = variant
-                pungCount = sum(len(meld) == 3 and len(set(meld)) == 1 for meld in variant)
-                if pungCount > maxPungs:
-                    maxPungs = pungCount
-                    maxPungVariant = variant
-            if maxPungs > 0 and maxPungVariant not in result:
-                result.append(maxPungVariant)
-            result.append(minMeldVariant)
-            if not result:
-                # if nothing seems useful, return all possible permutations
-                result.extend(variants)
-            cls.colorPermCache[values] = tuple(result)
+            result = cls.table.get(values)
+            if result is None:
+                result = cls.computeUseful(values)
+            cls.colorPermCache[values] = result
         return cls.colorPermCache[values]
 
+    @classmethod
+    def computeUseful(cls, values):
+        """see usefulPermutations, without looking at caches"""
+        variants = cls.permute(values)
+        result = []
+        maxPungs = -1
+        maxPungVariant = minMeldVariant = None
+        minMelds = 99
+        for variant in variants:
+            if all(len(meld) > 1 for meld in variant):
+                # no singles: usable for MJ
+                result.append(variant)
+            if len(variant) < minMelds:
+                minMelds = len(variant)
+                minMeldVariant = variant
+            pungCount = sum(len(meld) == 3 and len(set(meld)) == 1 for meld in variant)
+            if pungCount > maxPungs:
+                maxPungs = pungCount
+                maxPungVariant = variant
+        if maxPungs > 0 and maxPungVariant not in result:
+            result.append(maxPungVariant)
+        result.append(minMeldVariant)
+        if not result:
+            # if nothing seems useful, return all possible permutations
+            result.extend(variants)
+        return tuple(result)
+
+    # the least recently used entries are evicted, like in the HandCache
+    colorVariantCache = OrderedDict()
+    colorVariantCacheSize = 20000
+
     @classmethod
     def __colorVariants(cls, color, values):
         """generates all possible meld variants out of original
         where values is a string like '113445'.
-        Returns lists of Meld"""
+        Returns lists of Meld. Hands created by Hand.__add__ and
+        Hand.__sub__ only change one suit, so the others come from here"""
+        cacheKey = (color, tuple(sorted(values)))
+        result = cls.colorVariantCache.pop(cacheKey, None)
+        if result is None:
+            result = cls.__computeColorVariants(color, values)
+            while len(cls.colorVariantCache) >= cls.colorVariantCacheSize:
+                cls.colorVariantCache.popitem(last=False)
+        cls.colorVariantCache[cacheKey] = result # now it is the newest entry
+        return result
+
+    @classmethod
+    def __computeColorVariants(cls, color, values):
+        """see __colorVariants"""
         allValues = sorted(values)
         vSet = set(allValues)
         groups = []
@@ -162,3 +315,6 @@ class Permutations(object):
             if melds:
                 result.append(melds)
         return result
+
+if __name__ == '__main__':
+    PermutationTable.write(sys.argv[1] if len(sys.argv) > 1 else PermutationTable.fileName)
@@ -22,7 +22,7 @@ import weakref
 from collections import defaultdict
 
 from log import logException, logWarning, m18n, m18nc, m18nE
-from common import WINDS, IntDict, Debug
+from common import WINDS, IntDict, Debug, Internal
 from query import Query
 from tile import Tile, TileList, elements
 from meld import Meld, MeldList
@@ -83,6 +83,9 @@ class Players(list):
     @staticmethod
     def createIfUnknown(name):
         """create player in database if not there yet"""
+        if not Internal.db:
+            # only if we have a DB open. False for simulated games
+            return
         if name not in Players.allNames.values():
             Players.load()  # maybe somebody else already added it
             if name not in Players.allNames.values():
@@ -115,21 +118,14 @@ class Player(object):
         self.wind = WINDS[0]
         self.intelligence = AIDefault(self)
         self.visibleTiles = IntDict(game.visibleTiles) if game else IntDict()
-        self.handCache = {}
-        self.cacheHits = 0
-        self.cacheMisses = 0
         self.clearHand()
         self.__lastSource = '1' # no source: blessing from heaven or earth
         self.handBoard = None
 
     def clearCache(self):
-        """clears the cache with Hands"""
-        if Debug.hand and len(self.handCache):
-            self.game.debug('%s: cache hits:%d misses:%d' % (self, self.cacheHits, self.cacheMisses))
-        self.handCache.clear()
+        """clears the cache with Permutations. The HandCache is shared
+        by all players and survives the hand"""
         Permutations.cache.clear()
-        self.cacheHits = 0
-        self.cacheMisses = 0
 
     @property
     def name(self):
@@ -404,7 +400,10 @@ class Player(object):
                 # the last discarded one is available to us since we can claim it
                 visible -= 1
         visible += sum(x.visibleTiles.count([lowerTile, upperTile]) for x in self.others())
-        visible += sum(x.exposed == lowerTile for x in hand.tiles)
+        if lowerTile.code is None:
+            visible += sum(x.exposed == lowerTile for x in hand.tiles)
+        else:
+            visible += hand.counts[lowerTile.code]
         return 4 - visible
 
     def violatesOriginalCall(self, discard=None):
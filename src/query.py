@@ -24,13 +24,21 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 """
 
 import os, traceback, time, datetime, random
+import threading
 from collections import defaultdict
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
 import sqlite3
 
+from twisted.internet.defer import Deferred, succeed
+
 from kde import appdataDir
 from util import xToUtf8, Duration
 from log import logInfo, logWarning, logException, logError, logDebug, m18ncE, m18n
 from common import IntDict, Options, Internal, Debug
+from metrics import DBCommitSeconds
 
 class QueryException(Exception):
     """as the name says"""
@@ -93,9 +101,138 @@ class DBCursor(sqlite3.Cursor):
         else:
             return self.statement
 
+class DBWriter(threading.Thread):
+    """writes behind for DBHandle.write with its own connection. Everything
+    written within tick seconds is committed in one transaction. The
+    statements of one write() are never split over transactions, so
+    they are committed together or not at all"""
+
+    tick = 0.1
+
+    def __init__(self, path, pragmas=()):
+        threading.Thread.__init__(self, name='DBWriter')
+        self.daemon = True
+        self.path = path
+        self.pragmas = pragmas
+        self.queue = Queue()
+        self.start()
+
+    def write(self, statements):
+        """statements is a list of (statement, args). Returns a Deferred
+        firing in the reactor thread after the commit"""
+        result = Deferred()
+        self.queue.put((statements, result))
+        return result
+
+    def sync(self):
+        """block until everything written so far is committed"""
+        done = threading.Event()
+        self.queue.put((None, done))
+        done.wait()
+
+    def stop(self):
+        """commit everything written so far and end the thread"""
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        """collect for one tick, but commit at once if somebody waits"""
+        connection = sqlite3.connect(self.path, timeout=10.0)
+        for pragma in self.pragmas:
+            connection.execute(pragma)
+        try:
+            while True:
+                units = [self.queue.get()]
+                deadline = time.time() + self.tick
+                while units[-1] is not None and units[-1][0] is not None:
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        units.append(self.queue.get(True, timeout))
+                    except Empty:
+                        break
+                self.__commit(connection, list(x for x in units if x is not None))
+                if units[-1] is None:
+                    return
+        finally:
+            connection.close()
+
+    def __commit(self, connection, units):
+        """if the common transaction fails, try every unit on its own"""
+        writes = list(x for x in units if x[0] is not None)
+        failures = {}
+        start = time.time()
+        try:
+            self.__execute(connection, writes)
+        except sqlite3.Error:
+            for statements, done in writes:
+                try:
+                    self.__execute(connection, [(statements, done)])
+                except sqlite3.Error as exc:
+                    failures[done] = QueryException('ERROR in %s: %s for %s' % (
+                        self.path, exc.message, statements))
+        from twisted.internet import reactor
+        if writes:
+            # not thread safe, let the reactor count
+            reactor.callFromThread(DBCommitSeconds.observe, time.time() - start)
+        for statements, done in units:
+            if statements is None:
+                done.set()
+            elif done in failures:
+                reactor.callFromThread(logError, str(failures[done]))
+                reactor.callFromThread(done.errback, failures[done])
+            else:
+                reactor.callFromThread(done.callback, None)
+
+    @staticmethod
+    def __execute(connection, units):
+        """one transaction for all units"""
+        try:
+            for statements, _ in units:
+                for statement, args in statements:
+                    connection.execute(statement, args or ())
+            connection.commit()
+        except sqlite3.Error:
+            connection.rollback()
+            raise
+
 class DBHandle(sqlite3.Connection):
     """a handle with our preferred configuration"""
 
+    # the game server commits at the end of every hand of every table.
+    # With WAL, readers and the writer do not block each other, and
+    # synchronous=NORMAL only syncs at checkpoints. A power failure
+    # may lose the last commits but never corrupts the database
+    serverProfile = (
+        'PRAGMA journal_mode=WAL',
+        'PRAGMA synchronous=NORMAL',
+        'PRAGMA cache_size=-20000',
+        'PRAGMA mmap_size=268435456')
+
+    # statements on hot paths. They only take arguments, never use %
+    # for them: sqlite caches compiled statements by their text
+    statements = {
+        'insertScore': 'INSERT INTO SCORE '
+            '(game,hand,data,manualrules,player,scoretime,won,prevailing,wind,'
+            'points,payments,balance,rotated,notrotated) '
+            'VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?)',
+        'login': 'select id, password from player where name=?',
+        # only looks at the open games of one player, see PrepareDB.indexes
+        'suspendedTables': 'select g.id, g.starttime, g.seed, g.ruleset, '
+            '(select max(scoretime) from score where game=g.id) '
+            'from game g, player p0, player p1, player p2, player p3 '
+            'where g.id in ('
+            '  select game.id from game, player where player.name=? and game.p0=player.id and game.endtime is null'
+            '  union select game.id from game, player where player.name=? and game.p1=player.id and game.endtime is null'
+            '  union select game.id from game, player where player.name=? and game.p2=player.id and game.endtime is null'
+            '  union select game.id from game, player where player.name=? and game.p3=player.id and game.endtime is null)'
+            ' and g.autoplay=0'
+            ' and p0.id=g.p0 and p1.id=g.p1 '
+            ' and p2.id=g.p2 and p3.id=g.p3 '
+            ' and exists(select 1 from ruleset where ruleset.id=g.ruleset)'
+            ' and exists(select 1 from score where game=g.id) limit 10'}
+
     # pylint: disable=no-member
     def __init__(self, path):
         assert Internal.db is None, id(self)
@@ -103,10 +240,14 @@ class DBHandle(sqlite3.Connection):
         self.inTransaction = None
         self.path = path
         self.identifier = None
+        self.writer = None
+        self.pragmas = ()
         try:
             sqlite3.Connection.__init__(self, self.path, timeout=10.0)
         except sqlite3.Error as exc:
             logException('opening %s: %s' % (self.path, exc.message))
+        # Query uses this for all statements
+        self.queryCursor = self.cursor(DBCursor)
         if self.hasTable('general'):
             cursor = self.cursor()
             cursor.execute('select ident from general')
@@ -158,6 +299,41 @@ class DBHandle(sqlite3.Connection):
         except sqlite3.Error as exc:
             logWarning('%s cannot rollback: %s' % (self.name, exc.message))
 
+    def useProfile(self, pragmas):
+        """execute pragmas, and also for the writer"""
+        for pragma in pragmas:
+            self.queryCursor.execute(pragma, silent=not Debug.sql)
+            self.queryCursor.fetchall()
+        self.pragmas = pragmas
+
+    def startWriter(self):
+        """from now on, write() writes behind in a separate thread.
+        It is a daemon thread, so commit everything before the reactor stops"""
+        if self.writer is None:
+            self.writer = DBWriter(self.path, self.pragmas)
+            from twisted.internet import reactor
+            reactor.addSystemEventTrigger('before', 'shutdown', self.sync)
+
+    def write(self, statements):
+        """statements is a list of (statement, args), to be committed
+        together. If we have a writer, this only queues them.
+        Returns a Deferred firing after the commit"""
+        if Debug.sql:
+            for statement, args in statements:
+                logDebug('write %s [%s]' % (statement, args))
+        if self.writer:
+            return self.writer.write(statements)
+        with self:
+            for statement, args in statements:
+                Query(statement, args)
+        return succeed(None)
+
+    def sync(self):
+        """make sure everything written is committed. Call this before
+        reading what might still be queued"""
+        if self.writer:
+            self.writer.sync()
+
     def close(self, silent=False):
         """just for logging"""
         if not silent and (Debug.sql or Debug.quit):
@@ -165,6 +341,9 @@ class DBHandle(sqlite3.Connection):
                 logDebug('Closing Internal.db: %s' % self.path)
             else:
                 logDebug('Closing DBHandle %s: %s' % (self, self.path))
+        if self.writer:
+            self.writer.stop()
+            self.writer = None
         if self is Internal.db:
             Internal.db = None
         try:
@@ -207,16 +386,20 @@ class Query(object):
         self.records = []
         self.statement = statement
         self.args = args
+        self.lastrowid = None
+        self.__rowcount = 0
         if Internal.db:
-            self.cursor = Internal.db.cursor(DBCursor) # pylint: disable=no-member
-            self.cursor.execute(statement, args, silent=silent, mayFail=mayFail, failSilent=failSilent)
-            self.failure = self.cursor.failure
-            self.records = list(self.cursor.fetchall())
+            # the cursor is shared by all queries, so save what we need
+            cursor = Internal.db.queryCursor
+            cursor.execute(statement, args, silent=silent, mayFail=mayFail, failSilent=failSilent)
+            self.failure = cursor.failure
+            self.records = list(cursor.fetchall())
+            self.lastrowid = cursor.lastrowid
+            self.__rowcount = cursor.rowcount
             if not Internal.db.inTransaction:
                 Internal.db.commit()
         else:
             # may happen at shutdown
-            self.cursor = None
             self.failure = None
             self.records = list()
         if self.records and Debug.sql:
@@ -228,16 +411,15 @@ class Query(object):
 
     def rowcount(self):
         """how many rows were affected?"""
-        if self.cursor:
-            return self.cursor.rowcount
-        else:
-            return 0
+        return self.__rowcount
 
 def initDb():
     """open the db, create or update it if needed.
     sets Internal.db."""
     PrepareDB(DBHandle.dbPath()) # create or upgrade
     DBHandle(DBHandle.dbPath())
+    if Internal.isServer:
+        Internal.db.useProfile(DBHandle.serverProfile)
 #    if not Internal.db = DBHandle.default:  # had to create it. Close and reopen
 #        Internal.db = DBHandle()
 #        assert Internal.db = DBHandle.default
@@ -358,6 +540,9 @@ class PrepareDB(object):
                     Query('UPDATE general SET schemaversion=?', (version,))
                 logInfo(m18n('Database %1 updated from schema %2 to %3',
                     Internal.db.path, currentVersion, version), showDialog=True)
+            # indexes do not change the schema version
+            with Internal.db:
+                self.createIndexes()
         except sqlite3.Error as exc:
             logException('opening %s: %s' % (self.path, exc.message))
         finally:
@@ -373,6 +558,28 @@ class PrepareDB(object):
         # of many test games (with autoplay=1)
         self.createIndex('idxautoplay', 'game(autoplay)')
 
+    # name: what to index
+    indexes = (
+        ('idxgame', 'score(game)'),
+        # this makes finding suspended games much faster in the presence
+        # of many test games (with autoplay=1)
+        ('idxautoplay', 'game(autoplay)'),
+        # the open games of a player
+        ('idxopen0', 'game(p0,endtime)'),
+        ('idxopen1', 'game(p1,endtime)'),
+        ('idxopen2', 'game(p2,endtime)'),
+        ('idxopen3', 'game(p3,endtime)'),
+        # the last scoretime of a game, without reading the score rows
+        ('idxscoretime', 'score(game,scoretime)'),
+        # the scoring games in the Games dialog, page by page
+        ('idxhistory', 'game(seed,endtime,starttime)'))
+
+    @classmethod
+    def createIndexes(cls):
+        """create missing indexes"""
+        for name, cmd in cls.indexes:
+            cls.createIndex(name, cmd)
+
     @classmethod
     def sqlForCreateTable(cls, table):
         """the SQL command for creating 'table'"""
@@ -389,10 +596,7 @@ class PrepareDB(object):
         """creates empty tables"""
         for table in ['player', 'game', 'score', 'ruleset', 'rule', 'general']:
             cls.createTable(table)
-        cls.createIndex('idxgame', 'score(game)')
-        # this makes finding suspended games much faster in the presence
-        # of many test games (with autoplay=1)
-        cls.createIndex('idxautoplay', 'game(autoplay)')
+        cls.createIndexes()
 
         if Internal.isServer:
             Query('ALTER TABLE player add password text')
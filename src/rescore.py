@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2014 Wolfgang Rohdewald <wolfgang@rohdewald.de>
+
+Kajongg is free software you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+Scores all hands saved in the table score of a database again and
+writes what changed as csv to stdout:
+
+hand;game;hand;player;wind;won;won now;points;points now;rules now
+game;game;player;points;points now;wins;wins now
+
+There is one hand row for every saved hand with a different result and
+one game row for every player of a game with such a hand. Without
+--ruleset, every game is scored with its own ruleset, which checks changes
+of the scoring code. With --ruleset, all games are scored with that one.
+
+The games are read in chunks of --chunk games. The chunks are scored
+by --workers processes, each of them started as rescore.py --worker.
+The workers get the rulesets like a client gets them from the game
+server and never open the database.
+
+Penalties and manually computed scores are not scored again. Rules
+about the history of a game like East winning nine times in a row
+never apply.
+"""
+
+from __future__ import print_function
+
+import os, sys, csv, json, subprocess, threading, time, traceback
+from itertools import groupby
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+from optparse import OptionParser, SUPPRESS_HELP
+
+from common import Options, Debug
+from log import m18n
+from query import DBHandle, Query
+from rule import Ruleset
+from bulkscoring import BulkScorer
+from hand import HandCache
+
+import predefined # pylint: disable=unused-import
+
+class Rescorer(object):
+    """the part running in the workers"""
+
+    def __init__(self):
+        self.scorers = {}
+
+    def define(self, key, rulesetList):
+        """rulesetList is what Ruleset.toList returns"""
+        self.scorers[key] = BulkScorer(Ruleset(rulesetList))
+
+    def score(self, rows):
+        """rows are tuples (ruleset key, winds, mayWin, string).
+        Returns a tuple (won, points, rule names) for every row"""
+        result = [None] * len(rows)
+        order = sorted(range(len(rows)), key=lambda x: rows[x][0])
+        for key, indices in groupby(order, key=lambda x: rows[x][0]):
+            indices = list(indices)
+            scores = self.scorers[key].score(
+                (str(rows[x][3]), str(rows[x][1]), bool(rows[x][2])) for x in indices)
+            for scoreIdx, idx in enumerate(indices):
+                result[idx] = (bool(scores.won[scoreIdx]), scores.totals[scoreIdx],
+                    scores.rules[scoreIdx])
+        return result
+
+def work(jobFile, resultFile):
+    """one json list per line in jobFile: ['ruleset', key, toList()] defines
+    a ruleset, ['score', rows] asks for Rescorer.score(rows). For every
+    score job write one line with the json encoded result"""
+    rescorer = Rescorer()
+    for line in iter(jobFile.readline, ''):
+        job = json.loads(line)
+        if job[0] == 'ruleset':
+            rescorer.define(job[1], job[2])
+        else:
+            resultFile.write(json.dumps(rescorer.score(job[1])) + '\n')
+            resultFile.flush()
+
+class Worker(object):
+    """a rescore.py --worker process. A thread reads the results and
+    puts them into the results queue together with the worker"""
+
+    def __init__(self, results, options):
+        self.job = None
+        self.rulesets = set()
+        cmd = [sys.executable, os.path.abspath(__file__), '--worker',
+            '--handcache={}'.format(options.handCacheSize)]
+        if options.debug:
+            cmd.append('--debug={}'.format(options.debug))
+        self.process = subprocess.Popen(cmd, cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        reader = threading.Thread(target=self.__readResults, args=(results,))
+        reader.daemon = True
+        reader.start()
+
+    def __readResults(self, results):
+        """runs in its own thread. None means the worker has ended"""
+        for line in iter(self.process.stdout.readline, ''):
+            results.put((self, line))
+        results.put((self, None))
+
+    def __send(self, job):
+        """one line"""
+        self.process.stdin.write(json.dumps(job) + '\n')
+
+    def start(self, job, rows, rulesets):
+        """score rows. rulesets maps ruleset keys to Ruleset.toList()"""
+        assert self.job is None, '{} is still busy with {}'.format(self, self.job)
+        self.job = job
+        for key in set(x[0] for x in rows) - self.rulesets:
+            self.__send(['ruleset', key, rulesets[key]])
+            self.rulesets.add(key)
+        self.__send(['score', rows])
+        self.process.stdin.flush()
+
+    def stop(self):
+        """the worker ends after its job"""
+        self.process.stdin.close()
+        self.process.wait()
+
+    def __str__(self):
+        return 'worker pid={}'.format(self.process.pid)
+
+class History(object):
+    """reads the saved hands of the database in chunks of games"""
+
+    def __init__(self, chunkSize, ruleset=None):
+        self.chunkSize = chunkSize
+        self.ruleset = ruleset
+        self.rulesets = {}
+        self.skipped = 0
+        self.__manualText = set([u'Score computed manually', m18n('Score computed manually')])
+
+    def __rulesetKey(self, rulesetId):
+        """the key for the workers. None if that ruleset cannot be loaded"""
+        if self.ruleset:
+            key = self.ruleset.hash
+            if key not in self.rulesets:
+                self.rulesets[key] = self.ruleset.toList()
+            return key
+        if rulesetId not in self.rulesets:
+            try:
+                self.rulesets[rulesetId] = Ruleset.cached(rulesetId).toList()
+            except Exception as exc: # pylint: disable=broad-except
+                print('game ruleset {}: {}'.format(rulesetId, exc), file=sys.stderr)
+                self.rulesets[rulesetId] = None
+        return rulesetId if self.rulesets[rulesetId] else None
+
+    def chunks(self):
+        """yield lists of (record, row) where row is for Rescorer.score.
+        row is None for hands which cannot be scored again"""
+        lastId = 0
+        while True:
+            games = Query('select id from game where id>? order by id limit ?',
+                (lastId, self.chunkSize)).records
+            if not games:
+                return
+            records = Query('select s.game, s.hand, p.name, s.wind, s.prevailing, s.won, s.data, '
+                's.points, s.manualrules, g.ruleset from score s, game g, player p '
+                'where s.game>=? and s.game<=? and s.penalty=0 and g.id=s.game and p.id=s.player '
+                'order by s.game, s.hand, s.player', (games[0][0], games[-1][0])).records
+            lastId = games[-1][0]
+            if records:
+                yield list((x, self.__row(x)) for x in records)
+
+    def __row(self, record):
+        """the job for Rescorer.score"""
+        _, _, _, wind, prevailing, won, data, _, manualrules, rulesetId = record
+        key = self.__rulesetKey(rulesetId)
+        if key is None or not data or manualrules in self.__manualText:
+            self.skipped += 1
+            return None
+        return (key, (wind + prevailing).lower(), bool(won), data)
+
+def compare(pairs, counts=None):
+    """yield the csv rows of the report. pairs holds (record, result)
+    sorted by game with records as selected by History and results
+    as returned by Rescorer.score. result None means unchanged.
+    counts gets the number of games, hands and changes"""
+    if counts is None:
+        counts = {}
+    for gameId, gamePairs in groupby(pairs, key=lambda x: x[0][0]):
+        totals = []
+        byPlayer = {}
+        handRows = []
+        for record, result in gamePairs:
+            _, handId, player, wind, _, won, _, points = record[:8]
+            counts['hands'] = counts.get('hands', 0) + 1
+            if result is None:
+                newWon, newPoints, rules = bool(won), points, ()
+            else:
+                newWon, newPoints, rules = result
+            if (newWon, newPoints) != (bool(won), points):
+                handRows.append(['hand', gameId, handId, player, wind, int(bool(won)),
+                    int(newWon), points, newPoints, '||'.join(rules)])
+            if player not in byPlayer:
+                byPlayer[player] = [player, 0, 0, 0, 0]
+                totals.append(byPlayer[player])
+            total = byPlayer[player]
+            total[1] += points
+            total[2] += newPoints
+            total[3] += int(bool(won))
+            total[4] += int(newWon)
+        counts['games'] = counts.get('games', 0) + 1
+        if handRows:
+            counts['changed hands'] = counts.get('changed hands', 0) + len(handRows)
+            counts['changed games'] = counts.get('changed games', 0) + 1
+            for row in handRows:
+                yield row
+            for total in totals:
+                yield ['game', gameId] + total
+
+def rescore(options, writer):
+    """score the history in options.workers processes"""
+    history = History(options.chunk, options.ruleset)
+    results = Queue()
+    workers = list(Worker(results, options) for _ in range(options.workers))
+    idle = list(workers)
+    chunks = enumerate(history.chunks())
+    done = {}
+    nextChunk = 0
+    counts = {}
+    try:
+        while True:
+            for worker in idle[:]:
+                chunkNr, chunk = next(chunks, (None, None))
+                if chunk is None:
+                    break
+                idle.remove(worker)
+                worker.start((chunkNr, chunk), list(x[1] for x in chunk if x[1]), history.rulesets)
+            if len(idle) == len(workers):
+                break
+            worker, line = results.get()
+            if line is None:
+                raise UserWarning('{} ended unexpectedly'.format(worker))
+            (chunkNr, chunk), worker.job = worker.job, None
+            idle.append(worker)
+            scored = iter(json.loads(line))
+            done[chunkNr] = list((record, next(scored) if row else None) for record, row in chunk)
+            # write in the order of the games, the workers may finish in any order
+            while nextChunk in done:
+                writer.writerows(compare(done.pop(nextChunk), counts))
+                sys.stdout.flush()
+                nextChunk += 1
+    finally:
+        for worker in workers:
+            worker.stop()
+    counts['not scored again'] = history.skipped
+    return counts
+
+def findRuleset(name):
+    """a predefined ruleset or a ruleset in the database, by name or hash.
+    The templates of the ruleset editor are preferred"""
+    for ruleset in predefined.PredefinedRuleset.rulesets():
+        if name in (ruleset.name, ruleset.hash):
+            return ruleset.load()
+    records = Query('select hash from ruleset where name=? or hash=? order by id',
+        (name, name)).records
+    if not records:
+        raise UserWarning('ruleset {} not found'.format(name))
+    return Ruleset.cached(records[0][0]).load()
+
+def parseArgs():
+    """as the name says"""
+    parser = OptionParser()
+    parser.add_option('', '--db', dest='dbPath', metavar='DBPATH',
+        help='the database with the history')
+    parser.add_option('', '--ruleset', dest='ruleset',
+        help='score all games with RULESET: a name or a hash', metavar='RULESET')
+    parser.add_option('', '--workers', dest='workers', type=int, default=2,
+        help='score in WORKERS processes (2)', metavar='WORKERS')
+    parser.add_option('', '--chunk', dest='chunk', type=int, default=100,
+        help='read CHUNK games at once (100)', metavar='CHUNK')
+    parser.add_option('', '--handcache', dest='handCacheSize',
+        help='cache up to HANDCACHESIZE evaluated hands (%d)' % Options.handCacheSize,
+        type=int, default=Options.handCacheSize)
+    parser.add_option('', '--debug', dest='debug',
+        help=Debug.help())
+    parser.add_option('', '--worker', dest='worker', action='store_true',
+        default=False, help=SUPPRESS_HELP)
+    (options, args) = parser.parse_args()
+    if args and ''.join(args):
+        print('unrecognized arguments:', ' '.join(args), file=sys.stderr)
+        sys.exit(2)
+    Options.handCacheSize = options.handCacheSize
+    msg = HandCache.checkSize(options.handCacheSize) or Debug.setOptions(options.debug)
+    if msg:
+        print(msg, file=sys.stderr)
+        sys.exit(2)
+    Options.fixed = True # may not be changed anymore
+    if not options.worker:
+        if not options.dbPath or not os.path.exists(options.dbPath):
+            print('--db must name an existing database', file=sys.stderr)
+            sys.exit(2)
+        if options.workers < 1 or options.chunk < 1:
+            print('--workers and --chunk must be positive', file=sys.stderr)
+            sys.exit(2)
+    return options
+
+def main():
+    """rescore or work"""
+    options = parseArgs()
+    if options.worker:
+        results = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+        # whatever else is written to stdout must not get mixed with the results
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+        work(sys.stdin, results)
+        return
+    # only read, never create or upgrade the database
+    DBHandle(options.dbPath.decode('utf-8'))
+    try:
+        if options.ruleset:
+            options.ruleset = findRuleset(options.ruleset.decode('utf-8'))
+        started = time.time()
+        counts = rescore(options, csv.writer(sys.stdout, delimiter=';'))
+    except UserWarning as exc:
+        print(exc, file=sys.stderr)
+        sys.exit(1)
+    except Exception: # pylint: disable=broad-except
+        traceback.print_exc()
+        sys.exit(1)
+    for name in ('games', 'hands', 'not scored again', 'changed hands', 'changed games'):
+        print('{:>18}: {}'.format(name, counts.get(name, 0)), file=sys.stderr)
+    print('{:>18}: {:.1f}'.format('seconds', time.time() - started), file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -23,6 +23,7 @@ Read the user manual for a description of the interface to this scoring engine
 
 import types
 from hashlib import md5
+from itertools import groupby
 
 from qt import QVariant
 
@@ -285,26 +286,30 @@ class Ruleset(object):
     cache = dict()
     hits = 0
     misses = 0
+    __nearest = dict() # hash -> the most similar predefined ruleset
 
     @staticmethod
     def clearCache():
         """clears the cache with Rulesets"""
         Ruleset.cache.clear()
+        Ruleset.__nearest.clear()
 
     @staticmethod
     def cached(name):
         """If a Ruleset instance is never changed, we can use a cache"""
         if isinstance(name, list):
             # we got the rules over the wire
-            _, wiredHash, _, _ = name[0]
+            wiredHash = name[0][1]
         else:
             wiredHash = None
         for predefined in PredefinedRuleset.rulesets():
             if predefined.hash in (name, wiredHash):
                 return predefined
         cache = Ruleset.cache
-        if not isinstance(name, list) and name in cache:
-            return cache[name]
+        key = wiredHash or name
+        if key in cache:
+            # do not parse the same rules again
+            return cache[key]
         result = Ruleset(name)
         cache[result.rulesetId] = result
         cache[result.hash] = result
@@ -313,7 +318,8 @@ class Ruleset(object):
     def __init__(self, name):
         """name may be:
             - an integer: ruleset.id from the sql table
-            - a list: the full ruleset specification (probably sent from the server)
+            - a list: the full ruleset specification (probably sent from the server),
+              see toList and toDiffList
             - a string: The hash value of a ruleset"""
         Rule.importRulecode()
         self.name = name
@@ -323,6 +329,8 @@ class Ruleset(object):
         self.__dirty = False # only the ruleset editor is supposed to make us dirty
         self.__loaded = False
         self.__filteredLists = {}
+        self.__applicableRules = {}
+        self.__matchers = {}
         self.description = None
         self.rawRules = None # used when we get the rules over the network
         self.doublingMeldRules = []
@@ -361,8 +369,15 @@ into a situation where you have to pay a penalty"""))
         """have we been modified since load or last save?"""
         self.__dirty = dirty
         if dirty:
+            self.clearDerived()
             self.__computeHash()
 
+    def clearDerived(self):
+        """forget the rule lists and matchers derived from the rules"""
+        self.__filteredLists = {}
+        self.__applicableRules = {}
+        self.__matchers = {}
+
     @property
     def hash(self):
         """a md5sum computed from the rules but not name and description"""
@@ -398,8 +413,12 @@ into a situation where you have to pay a penalty"""))
             query = Query("select id,hash,name,description from ruleset where id=?", (self.name,))
         elif isinstance(self.name, list):
             # we got the rules over the wire
-            self.rawRules = self.name[1:]
-            (self.rulesetId, self.__hash, self.name, self.description) = self.name[0]
+            header = self.name[0]
+            if len(header) > 4:
+                self.rawRules = self.__expandDiff(header[4], header[5], self.name[1:])
+            else:
+                self.rawRules = self.name[1:]
+            (self.rulesetId, self.__hash, self.name, self.description) = header[:4]
             self.load() # load raw rules at once, rules from db only when needed
             return
         else:
@@ -433,7 +452,7 @@ into a situation where you have to pay a penalty"""))
         if self.rulesetId: # a saved ruleset, do not do this for predefined rulesets
             # we might have introduced new parameter rules which do not exist in this ruleset saved with the game,
             # so add missing parameters from the predefined ruleset most similar to this one
-            self.__setParametersFrom(sorted(PredefinedRuleset.rulesets(), key=lambda x: len(self.diff(x)))[0])
+            self.__setParametersFrom(self.nearestPredefined())
         self.doublingMeldRules = list(x for x in self.meldRules if x.score.doubles)
         self.doublingHandRules = list(x for x in self.handRules if x.score.doubles)
         for mjRule in self.mjRules:
@@ -456,6 +475,46 @@ into a situation where you have to pay a penalty"""))
         result.extend(self.ruleRecord(x) for x in self.allRules)
         return result
 
+    def nearestPredefined(self):
+        """the predefined ruleset most similar to this one. Computed once per hash"""
+        result = Ruleset.__nearest.get(self.hash)
+        if result is None:
+            result = sorted(PredefinedRuleset.rulesets(), key=lambda x: len(self.diff(x.load())))[0]
+            Ruleset.__nearest[self.hash] = result
+        return result
+
+    def toDiffList(self):
+        """like toList but with only those rules which are not in the most
+        similar predefined ruleset. The header has two more fields: the hash of
+        that predefined ruleset and the indices of its rules we do not have.
+        Positions are not compared, they change when rules are removed"""
+        def content(record):
+            """the record without ruleset and position"""
+            return (record[1], ) + tuple(record[3:])
+        self.load()
+        base = self.nearestPredefined()
+        baseRecords = list(content(x) for x in base.toList()[1:])
+        records = self.toList()[1:]
+        ownRecords = set(content(x) for x in records)
+        dropped = list(idx for idx, x in enumerate(baseRecords) if x not in ownRecords)
+        baseRecords = set(baseRecords)
+        result = [[self.rulesetId, self.hash, self.name, self.description, base.hash, dropped]]
+        result.extend(x for x in records if content(x) not in baseRecords)
+        return result
+
+    @staticmethod
+    def __expandDiff(baseHash, dropped, records):
+        """the rule records of a ruleset we got from toDiffList"""
+        for base in PredefinedRuleset.rulesets():
+            if base.hash == baseHash:
+                break
+        else:
+            raise Exception('ruleset %s is not predefined here' % baseHash)
+        dropped = set(dropped)
+        result = list(x for idx, x in enumerate(base.toList()[1:]) if idx not in dropped)
+        result.extend(records)
+        return sorted(result, key=lambda x: (x[1], x[2]))
+
     def loadRules(self):
         """load rules from database or from self.rawRules (got over the net)"""
         for record in self.rawRules or self.__loadQuery().records:
@@ -489,6 +548,44 @@ into a situation where you have to pay a penalty"""))
             self.__filteredLists[attrName] = list(x for x in self.allRules if hasattr(x, attrName))
         return self.__filteredLists[attrName]
 
+    def applicableRules(self, ruleList, features):
+        """returns the rules out of ruleList which might apply to a hand
+        with features, in their original order. See RuleCode.needs"""
+        cacheKey = (ruleList.listId, features)
+        if cacheKey not in self.__applicableRules:
+            self.__applicableRules[cacheKey] = list(x for x in ruleList if x.needs <= features)
+        return self.__applicableRules[cacheKey]
+
+    def matchingRules(self, ruleList, hand, features):
+        """the rules out of ruleList applying to hand, in their original order"""
+        matcher = self.__matchers.get(ruleList.listId)
+        if matcher is None:
+            matcher = self.__matchers[ruleList.listId] = self.__compileMatcher(ruleList)
+        return matcher(hand, features)
+
+    @staticmethod
+    def __compileMatcher(ruleList):
+        """generate one function testing all rules of ruleList, instead of
+        finding and calling appliesToHand of every rule. Consecutive rules
+        with the same needs share one test of the hand features"""
+        namespace = {}
+        lines = ['def matcher(hand, features):', '    result = []']
+        step = ' ' * 4
+        for needsIdx, (needs, group) in enumerate(groupby(enumerate(ruleList), key=lambda x: x[1].needs)):
+            indent = step
+            if needs:
+                namespace['needs%d' % needsIdx] = needs
+                lines.append(step + 'if needs%d <= features:' % needsIdx)
+                indent = step * 2
+            for idx, rule in group:
+                namespace['rule%d' % idx] = rule
+                namespace['applies%d' % idx] = rule.appliesToHand
+                lines.append('%sif applies%d(hand):' % (indent, idx))
+                lines.append(indent + step + 'result.append(rule%d)' % idx)
+        lines.append('    return result')
+        exec(compile('\n'.join(lines), '<%s>' % ruleList.name, 'exec'), namespace) # pylint: disable=exec-used
+        return namespace['matcher']
+
     @staticmethod
     def newId(minus=False):
         """returns an unused ruleset id. This is not multi user safe."""
@@ -695,6 +792,7 @@ class RuleBase(object):
 
     options = {}
     ruleClasses = {}
+    needs = frozenset()
     def __init__(self, name, definition, description):
         self.__name = name
         self.definition = definition
@@ -740,10 +838,10 @@ class Rule(RuleBase):
         """cache results for func"""
         code = func.__code__
         clsMethod = code.co_varnames[0] == 'cls'
+        cacheKey = (cls, func.__name__)
         def wrapper(*args):
             """closure"""
             hand = args[1] if clsMethod else args[0]
-            cacheKey = (cls, func.__name__)
             if cacheKey not in hand.ruleCache:
                 result = func(*args)
                 hand.ruleCache[cacheKey] = result
@@ -832,6 +930,7 @@ class Rule(RuleBase):
                     # to call those things indirectly
                     # pylint: disable=attribute-defined-outside-init
                     self.redirectTo(code, self.__class__, memoize=True)
+                    self.__class__.needs = frozenset(code.needs)
                     if hasattr(code, 'selectable'):
                         self.hasSelectable = True
                 elif variant[0] == 'O':
@@ -17,12 +17,12 @@ along with this program if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 """
 
-from tile import Tile, elements
+from tile import Tile, TileCounts, elements
 from meld import Meld, MeldList
-from common import IntDict, WINDS
+from common import IntDict
 from message import Message
-from query import Query
 from permutations import Permutations
+from shanten import Shanten
 
 class RuleCode(object):
     """Parent for all RuleCode classes. A RuleCode class can be used to
@@ -37,9 +37,14 @@ class RuleCode(object):
 
     All methods in RuleCode classes will automatically be converted
     into staticmethods or classmethods if the 1st arg is named 'cls'.
+
+    needs lists hand features which must all be present for appliesToHand
+    to possibly return True, see Hand.features. Rules needing a feature
+    the hand does not have are never evaluated for it.
     """
 
     cache = ()
+    needs = ()
 
 # pylint: disable=missing-docstring
 # the class and method names are mostly self explaining, we do not
@@ -158,56 +163,78 @@ class ZeroPointHand(RuleCode):
         return not any(x.meld for x in hand.usedRules if x.meld and len(x.meld) > 1)
 
 class NoChow(RuleCode):
+    needs = ('noChow',)
+
     def appliesToHand(hand):
         return not any(x.isChow for x in hand.melds)
 
 class OnlyConcealedMelds(RuleCode):
+    needs = ('concealed',)
+
     def appliesToHand(hand):
         return not any((x.isExposed and not x.isClaimedKong) for x in hand.melds)
 
 class FalseColorGame(RuleCode):
+    needs = ('honors', 'oneSuit')
+
     def appliesToHand(hand):
         dwSet = set(Tile.honors)
         return dwSet & hand.suits and len(hand.suits - dwSet) == 1
 
 class TrueColorGame(RuleCode):
+    needs = ('oneSuit',)
+
     def appliesToHand(hand):
         return len(hand.suits) == 1 and hand.suits < set(Tile.colors)
 
 class Purity(RuleCode):
+    needs = ('oneSuit', 'noChow')
+
     def appliesToHand(hand):
         return (len(hand.suits) == 1 and hand.suits < set(Tile.colors)
             and not any(x.isChow for x in hand.melds))
 
 class ConcealedTrueColorGame(RuleCode):
+    needs = ('oneSuit', 'concealed')
+
     def appliesToHand(hand):
         if len(hand.suits) != 1 or not hand.suits < set(Tile.colors):
             return False
         return not any((x.isExposed and not x.isClaimedKong) for x in hand.melds)
 
 class OnlyMajors(RuleCode):
+    needs = ('onlyMajors',)
+
     def appliesToHand(hand):
-        return all(x.isMajor for x in hand.tiles)
+        return hand.counts.only(TileCounts.majors)
 
 class OnlyHonors(RuleCode):
+    needs = ('onlyMajors',)
+
     def appliesToHand(hand):
-        return all(x.isHonor for x in hand.tiles)
+        return hand.counts.only(TileCounts.honors)
 
 class HiddenTreasure(RuleCode):
+    needs = ('noChow', 'concealed')
+
     def appliesToHand(hand):
         return (not any(((x.isExposed and not x.isClaimedKong) or x.isChow) for x in hand.melds)
             and hand.lastTile and hand.lastTile.isConcealed
             and len(hand.melds) == 5)
 
 class BuriedTreasure(RuleCode):
+    needs = ('oneSuit', 'noChow')
+
     def appliesToHand(hand):
         return (len(hand.suits - set(Tile.honors)) == 1
             and sum(x.isPung for x in hand.melds) == 4
             and all((x.isPung and x.isConcealed) or x.isPair for x in hand.melds))
 
 class AllTerminals(RuleCode):
+    needs = ('onlyMajors',)
+
     def appliesToHand(hand):
-        return all(x.isTerminal for x in hand.tiles)
+        return hand.counts.only(TileCounts.terminals)
 
 class StandardMahJongg(RuleCode):
     cache = ('appliesToHand',)
@@ -240,141 +267,28 @@ class StandardMahJongg(RuleCode):
         doublingWinnerRules = sum(x.rule.score.doubles for x in hand.matchingWinnerRules())
         return hand.score.doubles + doublingWinnerRules >= hand.ruleset.minMJDoubles
 
-    def fillChow(group, values):
-        val0, val1 = values
-        if val0 + 1 == val1:
-            if val0 == 1:
-                return {Tile(group, val0 + 2)}
-            if val0 == 8:
-                return {Tile(group, val0 - 1)}
-            return {Tile(group, val0 - 1), Tile(group, val0 + 2)}
-        else:
-            assert val0 + 2 == val1, 'group:%s values:%s' % (group, values)
-            return {Tile(group, val0 + 1)}
-
-    def winningTileCandidates(cls, hand):
-        # pylint: disable=too-many-locals,too-many-return-statements,too-many-branches,too-many-statements
-        if len(hand.melds) > 7:
-            # hope 7 is sufficient, 6 was not
-            return set()
-        if not hand.tilesInHand:
+    def winningTileCandidates(hand):
+        """exactly the tiles completing the melds, see Shanten.waits.
+        The hand may still not be won: minimum points, limits"""
+        if hand.counts[TileCounts.unknownCode]:
             return set()
-        inHand = list(x.exposed for x in hand.tilesInHand)
-        result = inHand[:]
-        pairs = 0
-        isolated = 0
-        maxChows = hand.ruleset.maxChows - sum(x.isChow for x in hand.declaredMelds)
-        # TODO: does not differentiate between maxChows == 1 and maxChows > 1
-        # test with kajonggtest and a ruleset where maxChows == 2
-        if maxChows < 0:
+        melds = hand.declaredMelds
+        if any(not (x.isPungKong or x.isChow or x.isPair) for x in melds):
             return set()
-        if maxChows == 0:
-            checkTiles = set(inHand)
-        else:
-            checkTiles = set(inHand) & elements.honors
-        for tileName in checkTiles:
-            count = inHand.count(tileName)
-            if count == 1:
-                isolated += 1
-            elif count == 2:
-                pairs += 1
-            else:
-                for _ in range(count):
-                    result.remove(tileName)
-        if maxChows:
-            if pairs > 2 or isolated > 2 or (pairs > 1 and isolated > 1):
-                # this is not a calling hand
-                return set()
-        else:
-            if pairs + isolated > 2:
-                return set()
-        if maxChows == 0:
-            return set(result)
-        melds = []
-        for group in hand.suits & set(Tile.colors):
-            values = sorted(x.value for x in result if x.group == group)
-            changed = True
-            while (changed and len(values) > 2
-                    and values.count(values[0]) == 1
-                    and values.count(values[1]) == 1
-                    and values.count(values[2]) == 1):
-                changed = False
-                if values[0] + 2 == values[2] and (len(values) == 3 or values[3] > values[0] + 3):
-                    # logDebug('removing first 3 from %s' % values)
-                    meld = Tile(group, values[0]).chow
-                    for pair in meld:
-                        result.remove(pair)
-                    melds.append(meld)
-                    values = values[3:]
-                    changed = True
-                elif values[0] + 1 == values[1] and values[2] > values[0] + 2:
-                    # logDebug('found incomplete chow at start of %s' % values)
-                    return cls.fillChow(group, values[:2])
-            changed = True
-            while (changed and len(values) > 2
-                    and values.count(values[-1]) == 1
-                    and values.count(values[-2]) == 1
-                    and values.count(values[-3]) == 1):
-                changed = False
-                if values[-1] - 2 == values[-3] and (len(values) == 3 or values[-4] < values[-1] - 3):
-                    meld = Tile(group, values[-3]).chow
-                    for pair in meld:
-                        result.remove(pair)
-                    melds.append(meld)
-                    values = values[:-3]
-                    changed = True
-                elif values[-1] - 1 == values[-2] and values[-3] < values[-1] - 2:
-                    # logDebug('found incomplete chow at end of %s' % values)
-                    return cls.fillChow(group, values[-2:])
-
-            if len(values) % 3 == 0:
-                # adding a 4th, 7th or 10th tile with this color can not let us win,
-                # so we can exclude this color from the candidates
-                result = list(x for x in result if x.group != group)
-                continue
-            valueSet = set(values)
-            if len(values) == 4 and len(values) == len(valueSet):
-                if values[0] + 3 == values[-1]:
-                    # logDebug('seq4 in %s' % hand.tilesInHand)
-                    return {Tile(group, values[0]), Tile(group, values[-1])}
-            if len(values) == 7 and len(values) == len(valueSet):
-                if values[0] + 6 == values[6]:
-                    # logDebug('seq7 in %s' % hand.tilesInHand)
-                    return {Tile(group, values[x]) for x in (0, 3, 6)}
-            if len(values) == 1:
-                # only a pair of this value is possible
-                # logDebug('need pair')
-                return {Tile(group, values[0]).concealed}
-            if len(valueSet) == 1:
-                # no chow reachable, only pair/pung
-                continue
-            singles = set(x for x in valueSet
-                 if values.count(x) == 1
-                 and not set([x-1, x-2, x+1, x+2]) & valueSet)
-            isolated += len(singles)
-            if isolated > 1:
-                # this is not a calling hand
-                return set()
-            if len(values) == 2 and len(valueSet) == 2:
-                # exactly two adjacent values: must be completed to Chow
-                if maxChows == 0:
-                    # not a calling hand
-                    return set()
-                # logDebug('return fillChow for %s' % values)
-                return cls.fillChow(group, values)
-            if (len(values) == 4 and len(valueSet) == 2
-                    and values[0] == values[1] and values[2] == values[3]):
-                return {Tile(group, values[0]), Tile(group, values[2])}
-            if maxChows:
-                for value in valueSet:
-                    if value > 1:
-                        result.append(Tile(group, value - 1))
-                    if value < 9:
-                        result.append(Tile(group, value + 1))
-        return set(result)
+        sets = list(x for x in melds if not x.isPair)
+        codes = Shanten.waits(hand.tilesInHand.counts(), 4 - len(sets),
+            hand.ruleset.maxChows - sum(x.isChow for x in sets), 1 - len(melds) + len(sets))
+        return set(TileCounts.tileOf[x] for x in codes)
 
     def shouldTry(hand, maxMissing=10):
         return True
+
+    def shanten(hand, counts):
+        melds = list(x for x in hand.declaredMelds if len(x) > 2)
+        return Shanten.standard(counts, 4 - len(melds),
+            hand.ruleset.maxChows - sum(x.isChow for x in melds),
+            pairDeclared=len(melds) < len(hand.declaredMelds))
+
     def rearrange(hand, rest):
         """rest is a list of those tiles that can still
         be rearranged: No declared melds and no bonus tiles.
@@ -386,6 +300,8 @@ class StandardMahJongg(RuleCode):
 
 class SquirmingSnake(StandardMahJongg):
     cache = ()
+    targets = Shanten.snakeTargets([(1, 1, 9, 9, x) for x in (2, 5, 8)], winds=False)
+
     def appliesToHand(hand):
         cacheKey = (hand.ruleset.standardMJRule.__class__, 'appliesToHand')
         std = hand.ruleCache.get(cacheKey, None)
@@ -405,11 +321,18 @@ class SquirmingSnake(StandardMahJongg):
         """they have already been found by the StandardMahJongg rule"""
         return set()
 
+    def shanten(hand, counts):
+        if hand.declaredMelds:
+            return None
+        return Shanten.pattern(counts, SquirmingSnake.targets)
+
 class WrigglingSnake(RuleCode):
+    targets = Shanten.snakeTargets([(1,)], winds=True)
+
     def shouldTry(hand, maxMissing=3):
         if hand.declaredMelds:
             return False
-        return (len(set(x.exposed for x in hand.tiles)) + maxMissing > 12
+        return (len(hand.counts.codes()) + maxMissing > 12
            and all(not x.isChow for x in hand.declaredMelds))
 
     def computeLastMelds(hand):
@@ -439,6 +362,11 @@ class WrigglingSnake(RuleCode):
             # pair of 1 is not complete
             return set([Tile(group, '1')])
 
+    def shanten(hand, counts):
+        if hand.declaredMelds:
+            return None
+        return Shanten.pattern(counts, WrigglingSnake.targets)
+
     def rearrange(hand, rest):
         melds = []
         for tileName in rest[:]:
@@ -523,7 +451,7 @@ class TripleKnitting(RuleCode):
         yield tuple(melds), tuple(rest)
 
     def appliesToHand(cls, hand):
-        if any(x.isHonor for x in hand.tiles):
+        if hand.counts.anyOf(TileCounts.honors):
             return False
         if len(hand.declaredMelds) > 1:
             return False
@@ -536,7 +464,7 @@ class TripleKnitting(RuleCode):
     def winningTileCandidates(cls, hand):
         if hand.declaredMelds:
             return set()
-        if any(x.isHonor for x in hand.tiles):
+        if hand.counts.anyOf(TileCounts.honors):
             return set()
         _, rest = cls.findTriples(hand)
         if len(rest) not in (1, 4):
@@ -546,6 +474,11 @@ class TripleKnitting(RuleCode):
             result.remove(restTile)
         return set(result)
 
+    def shanten(hand, counts):
+        if hand.declaredMelds:
+            return None
+        return Shanten.triples(counts)
+
     def shouldTry(cls, hand, maxMissing=3):
         if hand.declaredMelds:
             return False
@@ -603,7 +536,7 @@ class Knitting(RuleCode):
         return pairCount >= pairWanted
 
     def appliesToHand(cls, hand):
-        if any(x.isHonor for x in hand.tiles):
+        if hand.counts.anyOf(TileCounts.honors):
             return False
         if len(hand.declaredMelds) > 1:
             return False
@@ -614,7 +547,7 @@ class Knitting(RuleCode):
     def winningTileCandidates(cls, hand):
         if hand.declaredMelds:
             return set()
-        if any(x.isHonor for x in hand.tiles):
+        if hand.counts.anyOf(TileCounts.honors):
             return set()
         couples, singleTile = cls.findCouples(hand)
         if len(couples) != 6:
@@ -627,6 +560,12 @@ class Knitting(RuleCode):
         otherSuit = (hand.suits - set([singleTile.lowerGroup])).pop()
         otherTile = Tile(otherSuit, singleTile.value).concealed
         return set([otherTile])
+
+    def shanten(hand, counts):
+        if hand.declaredMelds:
+            return None
+        return Shanten.couples(counts)
+
     def rearrange(cls, hand, rest):
         melds = []
         for couple in cls.findCouples(hand, rest)[0]:
@@ -681,7 +620,7 @@ class AllPairHonors(RuleCode):
             result[Message.Chow] = -999
         return result
     def maybeCallingOrWon(hand):
-        if any(x.value in Tile.minors for x in hand.tiles):
+        if hand.counts.anyOf(TileCounts.minors):
             return False
         return len(hand.declaredMelds) < 2
     def appliesToHand(cls, hand):
@@ -698,13 +637,16 @@ class AllPairHonors(RuleCode):
         if len(single) != 1:
             return set()
         return set(single)
+    def shanten(hand, counts):
+        if hand.declaredMelds:
+            return None
+        return Shanten.pairs(counts, TileCounts.majors)
     def shouldTry(hand, maxMissing=4):
         if hand.declaredMelds:
             return False
-        tiles = list(x.exposed for x in hand.tiles)
         pairCount = kongCount = 0
-        for tile in elements.majors:
-            count = tiles.count(tile)
+        for code in TileCounts.majors:
+            count = hand.counts[code]
             if count == 2:
                 pairCount += 1
             elif count == 4:
@@ -737,45 +679,63 @@ class AllPairHonors(RuleCode):
 
 
 class FourfoldPlenty(RuleCode):
+    needs = ('fourKongs',)
+
     def appliesToHand(hand):
         return len(hand.tiles) == 18
 
 class ThreeGreatScholars(RuleCode):
+    needs = ('threeDragons',)
+
     def appliesToHand(cls, hand):
         return (BigThreeDragons.appliesToHand(hand)
             and ('nochow' not in cls.options or not any(x.isChow for x in hand.melds)))
 
 class BigThreeDragons(RuleCode):
+    needs = ('threeDragons',)
+
     def appliesToHand(hand):
         return len([x for x in hand.melds if x.isDragonMeld and x.isPungKong]) == 3
 
 class BigFourJoys(RuleCode):
+    needs = ('fourWinds',)
+
     def appliesToHand(hand):
         return len([x for x in hand.melds if x.isWindMeld and x.isPungKong]) == 4
 
 class LittleFourJoys(RuleCode):
+    needs = ('fourWinds',)
+
     def appliesToHand(hand):
         lengths = sorted([min(len(x), 3) for x in hand.melds if x.isWindMeld])
         return lengths == [2, 3, 3, 3]
 
 class LittleThreeDragons(RuleCode):
+    needs = ('threeDragons',)
+
     def appliesToHand(hand):
         lengths = sorted([min(len(x), 3) for x in hand.melds if x.isDragonMeld])
         return lengths == [2, 3, 3]
 
 class FourBlessingsHoveringOverTheDoor(RuleCode):
+    needs = ('fourWinds',)
+
     def appliesToHand(hand):
         return len([x for x in hand.melds if x.isPungKong and x.isWindMeld]) == 4
 
 class AllGreen(RuleCode):
     def appliesToHand(hand):
-        return set(x.exposed for x in hand.tiles) < elements.greenHandTiles
+        return hand.counts.codes() < TileCounts.greenHandTiles
 
 class LastTileFromWall(RuleCode):
+    needs = ('source w',)
+
     def appliesToHand(hand):
         return hand.lastSource == 'w'
 
 class LastTileFromDeadWall(RuleCode):
+    needs = ('source e',)
+
     def appliesToHand(hand):
         return hand.lastSource == 'e'
 
@@ -784,6 +744,8 @@ class LastTileFromDeadWall(RuleCode):
         return hand.lastSource == 'w'
 
 class IsLastTileFromWall(RuleCode):
+    needs = ('source z',)
+
     def appliesToHand(hand):
         return hand.lastSource == 'z'
 
@@ -792,6 +754,8 @@ class IsLastTileFromWall(RuleCode):
         return hand.lastSource == 'w'
 
 class IsLastTileFromWallDiscarded(RuleCode):
+    needs = ('source Z',)
+
     def appliesToHand(hand):
         return hand.lastSource == 'Z'
 
@@ -800,6 +764,8 @@ class IsLastTileFromWallDiscarded(RuleCode):
         return hand.lastSource == 'd'
 
 class RobbingKong(RuleCode):
+    needs = ('source k',)
+
     def appliesToHand(hand):
         return hand.lastSource == 'k'
 
@@ -807,17 +773,23 @@ class RobbingKong(RuleCode):
         """for scoring game"""
         return (hand.lastSource and hand.lastSource in 'kwd'
             and hand.lastTile and hand.lastTile.group.islower()
-            and [x.exposed for x in hand.tiles].count(hand.lastTile.exposed) < 2)
+            and hand.counts[hand.lastTile.code] < 2)
 
 class GatheringPlumBlossomFromRoof(RuleCode):
+    needs = ('source e',)
+
     def appliesToHand(hand):
         return LastTileFromDeadWall.appliesToHand(hand) and hand.lastTile is Tile(Tile.stone, '5').concealed
 
 class PluckingMoon(RuleCode):
+    needs = ('source z',)
+
     def appliesToHand(hand):
         return IsLastTileFromWall.appliesToHand(hand) and hand.lastTile is Tile(Tile.stone, '1').concealed
 
 class ScratchingPole(RuleCode):
+    needs = ('source k',)
+
     def appliesToHand(hand):
         return RobbingKong.appliesToHand(hand) and hand.lastTile is Tile(Tile.bamboo, '2')
 
@@ -836,18 +808,15 @@ class EastWonNineTimesInARow(RuleCode):
                 # we are only proposing for the last needed Win
                 needWins -= 1
         if game.winner and game.winner.wind == 'E' and game.notRotated >= needWins:
-            prevailing = WINDS[game.roundsFinished % 4]
-            eastMJCount = int(Query("select count(1) from score "
-                "where game=%d and won=1 and wind='E' and player=%d "
-                "and prevailing='%s'" % \
-                (game.gameid, game.players['E'].nameid, prevailing)).records[0][0])
-            return eastMJCount == needWins
+            return game.eastWins() == needWins
         return False
     def rotate(cls, game):
         return cls.appliesToGame(game, needWins=EastWonNineTimesInARow.nineTimes)
 
 class GatesOfHeaven(StandardMahJongg):
     cache = ()
+    targets = Shanten.snakeTargets([(1, 1, 9, 9, x) for x in Tile.numbers], winds=False)
+    targets28 = Shanten.snakeTargets([(1, 1, 9, 9, x) for x in Tile.minors], winds=False)
 
     def computeLastMelds(hand):
         return [hand.lastTile.single]
@@ -907,6 +876,13 @@ class GatesOfHeaven(StandardMahJongg):
                     result = Tile.numbers
         return {Tile(list(hand.suits)[0], x) for x in result}
 
+    def shanten(cls, hand, counts):
+        if hand.declaredMelds:
+            return None
+        if 'pair28' in cls.options:
+            return Shanten.pattern(counts, GatesOfHeaven.targets28)
+        return Shanten.pattern(counts, GatesOfHeaven.targets)
+
 class ThirteenOrphans(RuleCode):
 
     def computeLastMelds(hand):
@@ -941,7 +917,7 @@ class ThirteenOrphans(RuleCode):
         return result
 
     def appliesToHand(hand):
-        return set(x.exposed for x in hand.tiles) == elements.majors
+        return hand.counts.codes() == TileCounts.majors
 
     def winningTileCandidates(cls, hand):
         if any(x in hand.values for x in Tile.minors):
@@ -958,6 +934,11 @@ class ThirteenOrphans(RuleCode):
             assert len(missing) == 1
             return missing
 
+    def shanten(hand, counts):
+        if hand.declaredMelds:
+            return None
+        return Shanten.orphans(counts)
+
     def shouldTry(hand, maxMissing=4):
         # TODO: look at how many tiles there still are on the wall
         if hand.declaredMelds:
@@ -1003,14 +984,20 @@ class OwnSeason(RuleCode):
         return meld.isBonus and meld[0].group == Tile.season
 
 class OwnFlowerOwnSeason(RuleCode):
+    needs = ('bonus',)
+
     def appliesToHand(hand):
         return sum(x.isBonus and x[0].value == hand.ownWind for x in hand.bonusMelds) == 2
 
 class AllFlowers(RuleCode):
+    needs = ('bonus',)
+
     def appliesToHand(hand):
         return len([x for x in hand.bonusMelds if x.group == Tile.flower]) == 4
 
 class AllSeasons(RuleCode):
+    needs = ('bonus',)
+
     def appliesToHand(hand):
         return len([x for x in hand.bonusMelds if x.group == Tile.season]) == 4
 
@@ -1053,6 +1040,8 @@ class TwofoldFortune(RuleCode):
         return len(kungs) >= 2
 
 class BlessingOfHeaven(RuleCode):
+    needs = ('source 1',)
+
     def appliesToHand(hand):
         return hand.ownWind == Tile.east and hand.lastSource == '1'
 
@@ -1063,6 +1052,8 @@ class BlessingOfHeaven(RuleCode):
             and not set(hand.announcements) - {'a'})
 
 class BlessingOfEarth(RuleCode):
+    needs = ('source 1',)
+
     def appliesToHand(hand):
         return hand.ownWind != Tile.east and hand.lastSource == '1'
 
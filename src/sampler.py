@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2014 Wolfgang Rohdewald <wolfgang@rohdewald.de>
+
+Kajongg is free software you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+A sampling profiler for a running game server: kajonggserver --profile=DIR
+installs it, SIGUSR2 starts and stops sampling. While sampling, the stack
+of the reactor thread is looked at every few milliseconds of CPU time. The
+stacks are written every minute and when sampling stops into DIR in the
+folded format of flamegraph.pl, with the subsystem as the root frame.
+"""
+
+import os, sys, signal, time
+
+from log import logInfo, logWarning
+
+class Sampler(object):
+    """collects stacks and writes them"""
+
+    # the innermost frame matching one of those decides the subsystem
+    subsystems = (
+        ('DB', ('query.py', 'sqlite3')),
+        ('serialization', ('message.py', 'twisted/spread', 'twisted/python/reflect')),
+        ('AI', ('intelligence.py', 'altint.py', 'shanten.py', 'permutations.py')),
+        ('scoring', ('hand.py', 'rule.py', 'rulecode.py', 'meld.py', 'tile.py')),
+        ('reactor', ('twisted/internet', )))
+
+    interval = 0.005
+    dumpInterval = 60
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.stacks = {}
+        self.sampling = False
+        self.started = None
+        self.lastDump = None
+
+    def install(self):
+        """SIGUSR2 toggles sampling"""
+        if not hasattr(signal, 'setitimer'):
+            logWarning('This platform cannot sample, --profile is ignored')
+            return
+        signal.signal(signal.SIGPROF, self.__sample)
+        signal.signal(signal.SIGUSR2, self.__toggle)
+        logInfo('kill -USR2 %d starts and stops sampling into %s' % (os.getpid(), self.directory))
+
+    def __toggle(self, dummySignal, dummyFrame):
+        """start or stop sampling"""
+        if self.sampling:
+            self.stop()
+        else:
+            self.start()
+
+    def start(self):
+        """sample every interval seconds of CPU time"""
+        self.stacks = {}
+        self.sampling = True
+        self.started = self.lastDump = time.time()
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        """stop sampling and write what we have"""
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        self.sampling = False
+        self.dump()
+
+    def __sample(self, dummySignal, frame):
+        """called by SIGPROF in the main thread. Only count here, a dump
+        is written at the next sample after dumpInterval"""
+        self.sample(frame)
+        if time.time() - self.lastDump > self.dumpInterval:
+            self.dump()
+
+    def sample(self, frame):
+        """count the stack of frame"""
+        names = []
+        files = []
+        while frame is not None:
+            code = frame.f_code
+            files.append(code.co_filename)
+            names.append('%s:%s' % (os.path.basename(code.co_filename), code.co_name))
+            frame = frame.f_back
+        names.append(self.subsystem(files))
+        key = ';'.join(reversed(names))
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    @classmethod
+    def subsystem(cls, files):
+        """files holds the source files of a stack, innermost first"""
+        for fileName in files:
+            fileName = fileName.replace('\\', '/')
+            for subsystem, patterns in cls.subsystems:
+                if any(x in fileName for x in patterns):
+                    return subsystem
+        return 'other'
+
+    def folded(self):
+        """the stacks as flamegraph.pl wants them"""
+        return ''.join('%s %d\n' % x for x in sorted(self.stacks.items()))
+
+    def dump(self):
+        """write the stacks and start counting anew"""
+        now = time.time()
+        if self.stacks:
+            fileName = os.path.join(self.directory, 'kajongg-%d-%s.folded' % (
+                os.getpid(), time.strftime('%Y%m%d-%H%M%S', time.localtime(now))))
+            try:
+                with open(fileName, 'w') as outFile:
+                    outFile.write(self.folded())
+            except IOError as exc:
+                sys.stderr.write('cannot write %s: %s\n' % (fileName, exc))
+        self.stacks = {}
+        self.lastDump = now
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2014 Wolfgang Rohdewald <wolfgang@rohdewald.de>
+
+Kajongg is free software you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+Measures the scoring engine with the hands from scoringtest.py.
+For every ruleset of scoringtest, this writes one csv row per benchmark
+and cache state:
+
+commit;ruleset;roofOff;benchmark;caches;cases;seconds;cases per second
+
+cold means that everything the engine remembers is forgotten before
+each case, and the measured time includes building the Hand: building
+may already compute what a benchmark asks for. Subtract the cold hand
+benchmark to get the benchmark alone. warm means that every case has
+already been measured once, the Hand comes from the HandCache and is
+not measured.
+
+seconds is the best of --repeat runs. Compare rows only if they were
+measured on the same machine.
+"""
+
+from __future__ import print_function
+
+import sys, csv
+from timeit import default_timer
+from optparse import OptionParser
+
+from hand import Hand, HandCache
+from meld import Meld
+from permutations import Permutations
+from shanten import Shanten
+from util import gitHead
+import scoringtest
+from scoringtest import RULESETS, GAMES
+
+class Cases(scoringtest.Helpers):
+    """collects the hands of the scoring tests instead of testing them"""
+
+    helpers = set(['scoreTest', 'callingTest', 'shantenTest'])
+
+    def __init__(self):
+        self.scored = []
+        self.calling = []
+        for cls in scoringtest.Base.__subclasses__():
+            testMe = cls.__dict__['testMe']
+            # other tests do more than calling our helpers
+            if set(testMe.__code__.co_names) & self.helpers:
+                testMe(self)
+
+    def scoreTest(self, string, expected, winds=None, totals=None):
+        """collect a hand for scoring"""
+        self.scored.append((string, expected, winds or 'ee'))
+
+    def callingTest(self, string, expected):
+        """collect a hand for callingHands"""
+        self.calling.append((string, None, 'ee'))
+
+    def shantenTest(self, string, expected, tiles=None):
+        """not measured"""
+
+    def forRuleset(self, idx, benchmark):
+        """the cases for RULESETS[idx]: tuples with winds and string"""
+        cases = self.calling if benchmark == 'callingHands' else self.scored
+        return list((winds, string) for string, expected, winds in cases
+            if benchmark == 'callingHands' or self.expectedFor(expected, idx) is not None)
+
+def clearCaches():
+    """forget everything the scoring engine has computed so far"""
+    HandCache.clear()
+    Meld.clearRules()
+    for cache in (Permutations.cache, Permutations.permuteCache,
+            Permutations.colorPermCache, Permutations.colorVariantCache):
+        cache.clear()
+    for cache in (Shanten.blockCache, Shanten.completeCache, Shanten.waitCache):
+        cache.clear()
+    for ruleset in RULESETS:
+        ruleset.clearDerived()
+
+# what is measured for an existing hand. 'hand' measures Hand() itself
+ACTIONS = {
+    'hand': None,
+    'callingHands': lambda hand: hand.callingHands,
+    'explain': lambda hand: hand.explain(),
+    'total': lambda hand: hand.total()}
+
+def measure(idx, benchmark, cases, cold):
+    """returns the seconds needed for all cases"""
+    game = GAMES[idx]
+    action = ACTIONS[benchmark]
+    result = 0.0
+    for winds, string in cases:
+        Cases.prepareGame(game, winds)
+        if cold:
+            clearCaches()
+            start = default_timer()
+            hand = Hand(game.winner, string)
+            if action:
+                action(hand)
+            result += default_timer() - start
+        elif action is None:
+            start = default_timer()
+            Hand(game.winner, string)
+            result += default_timer() - start
+        else:
+            hand = Hand(game.winner, string)
+            start = default_timer()
+            action(hand)
+            result += default_timer() - start
+    return result
+
+def run(options):
+    """yields one row per ruleset, benchmark and cache state"""
+    cases = Cases()
+    commit = gitHead()
+    for idx, ruleset in enumerate(RULESETS):
+        for benchmark in sorted(ACTIONS):
+            if options.benchmarks and benchmark not in options.benchmarks:
+                continue
+            rulesetCases = cases.forRuleset(idx, benchmark)
+            for caches in ('cold', 'warm'):
+                cold = caches == 'cold'
+                if not cold:
+                    measure(idx, benchmark, rulesetCases, cold=False)
+                seconds = min(measure(idx, benchmark, rulesetCases, cold)
+                    for _ in range(options.repeat))
+                yield [commit, ruleset.name, int(ruleset.roofOff), benchmark, caches,
+                    len(rulesetCases), '%.6f' % seconds,
+                    '%.1f' % (len(rulesetCases) / seconds if seconds else 0)]
+            clearCaches()
+
+def parseArgs():
+    """parse options"""
+    parser = OptionParser()
+    parser.add_option('', '--repeat', dest='repeat', type=int, default=3,
+        help='report the best of REPEAT runs', metavar='REPEAT')
+    parser.add_option('', '--benchmark', dest='benchmarks', default='',
+        help='comma separated list out of %s. Default is all' % ','.join(sorted(ACTIONS)),
+        metavar='BENCHMARK')
+    parser.add_option('', '--csv', dest='csv',
+        help='append results to file CSV instead of writing them to stdout', metavar='CSV')
+    options, args = parser.parse_args()
+    if args:
+        parser.error('unknown arguments: %s' % ' '.join(args))
+    options.benchmarks = list(x for x in options.benchmarks.split(',') if x)
+    for benchmark in options.benchmarks:
+        if benchmark not in ACTIONS:
+            parser.error('unknown benchmark: %s' % benchmark)
+    if options.repeat < 1:
+        parser.error('--repeat must be at least 1')
+    return options
+
+def main():
+    """write the results"""
+    options = parseArgs()
+    if options.csv:
+        with open(options.csv, 'a') as csvFile:
+            writer = csv.writer(csvFile, delimiter=';')
+            for row in run(options):
+                writer.writerow(row)
+                csvFile.flush()
+    else:
+        writer = csv.writer(sys.stdout, delimiter=';')
+        for row in run(options):
+            writer.writerow(row)
+            sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
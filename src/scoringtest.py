@@ -21,12 +21,28 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 
 from __future__ import print_function
 
-from common import Debug, isPython3  # pylint: disable=unused-import
-import unittest
-from game import PlayingGame
-from hand import Hand, Score
-from tile import TileList
+from common import Debug, Options, Internal, isPython3  # pylint: disable=unused-import
+import os, sys, shutil, sqlite3, unittest
+from tempfile import mkdtemp
+from game import PlayingGame, ServerGame
+from hand import Hand, HandCache, Score
+from tile import Tile, TileList, TileCounts
+from meld import Meld, MeldList
+from message import Message, MoveCodec
+from permutations import Permutations
+import permutations
 from predefined import ClassicalChineseDMJL, ClassicalChineseBMJA
+from simulator import Simulator
+from query import DBWriter, DBHandle, PrepareDB, Query
+from player import Players
+from rule import Ruleset
+from rulecode import EastWonNineTimesInARow
+from timerwheel import TimerWheel
+from twisted.internet.task import Clock
+from metrics import Metric, Counter, Histogram
+from sampler import Sampler
+from bulkscoring import BulkScorer
+from rescore import Rescorer, compare
 
 RULESETS = []
 
@@ -68,29 +84,38 @@ class NoWin(Expected):
 class Helpers(object):
     """for my test classes"""
     # pylint: disable=no-member
+    @staticmethod
+    def expectedFor(expected, idx):
+        """expected may be a list with one entry per ruleset. If it is
+        shorter than RULESETS, roofOff rulesets reuse the entries"""
+        if isinstance(expected, list):
+            if idx >= len(expected):
+                idx %= len(RULESETS) // 2
+            return expected[idx]
+        return expected
+
+    @staticmethod
+    def prepareGame(game, winds):
+        """winds: the wind of the winner and the round wind"""
+        for widx, wind in enumerate('ESWN'):
+            game.players[widx].wind = wind
+        game.winner = game.players[winds[0].upper()]
+        game.myself = game.winner
+        game.roundsFinished = 'eswn'.index(winds[1])
+        game.winner.clearCache()
+
     def scoreTest(self, string, expected, winds=None, totals=None):
         """execute one scoreTest test"""
         if winds is None:
             winds = 'ee'
         for idx, ruleset in enumerate(RULESETS):
-            if isinstance(expected, list):
-                expIdx = idx
-                if expIdx >= len(expected):
-                    expIdx %= len(RULESETS) // 2
-                exp = expected[expIdx]
-            else:
-                exp = expected
+            exp = self.expectedFor(expected, idx)
             if exp is None:
                 continue
             exp.ruleset = ruleset
             variants = []
             game = GAMES[idx]
-            for widx, wind in enumerate('ESWN'):
-                game.players[widx].wind = wind
-            game.winner = game.players[winds[0].upper()]
-            game.myself = game.winner
-            game.roundsFinished = 'eswn'.index(winds[1])
-            game.winner.clearCache()
+            self.prepareGame(game, winds)
             if Debug.hand:
                 print('')
                 print('starting test for %s'% ruleset.name)
@@ -114,19 +139,27 @@ class Helpers(object):
             game.players[0].clearCache()
             hand = Hand(game.players[0], string)
             testSays = TileList(set(x.lastTile.exposed for x in hand.callingHands)).sorted()
-            if isinstance(expected, list):
-                if idx >= len(expected):
-                    idx %= len(RULESETS) // 2
-                expIdx = idx
-                if expIdx >= len(expected):
-                    expIdx %= len(RULESETS) // 2
-                exp = expected[expIdx]
-            else:
-                exp = expected
-            completingTiles = TileList(exp)
+            completingTiles = TileList(self.expectedFor(expected, idx))
             self.assertTrue(testSays == completingTiles,
                 '%s: %s may be completed by %s but testresult is %s' % (
                 ruleset.name, string, completingTiles or 'None', testSays or 'None'))
+            if testSays:
+                self.assertTrue(hand.shanten.number == 0 and set(testSays) <= set(hand.shanten.tiles),
+                    '%s: %s is calling for %s but shanten says %s %s' % (
+                    ruleset.name, string, testSays, hand.shanten.number, hand.shanten.tiles))
+
+    def shantenTest(self, string, expected, tiles=None):
+        """test the shanten number of a hand"""
+        for idx, ruleset in enumerate(RULESETS):
+            exp = expected[idx % len(expected)] if isinstance(expected, list) else expected
+            game = GAMES[idx]
+            game.players[0].clearCache()
+            hand = Hand(game.players[0], string)
+            self.assertTrue(hand.shanten.number == exp,
+                '%s: %s has shanten %s, expected %s' % (
+                ruleset.name, string, hand.shanten.number, exp))
+            if tiles is not None:
+                self.assertEqual(hand.shanten.tiles, TileList(tiles).sorted())
 
     def dumpCase(self, hand, expected, total):
         """dump test case"""
@@ -557,6 +590,7 @@ class CallingHands(Base):
         self.callingTest('RC4C4C5C6C5C7C8 dgdgdg s6s6s6', 'c4c5')
         self.callingTest('RS1S4C5C6C5C7C8 dgdgdg s6s6s6', '')
         self.callingTest('RDbDgDrWsWwWeWnB1B9C1S1S9C9 LWe', 'dbdgdrwewswwwns1s9b1b9c1c9')
+        self.callingTest('RS8S6S7C4S5B4C4S6S7S4B3C4S7', ['b2b5', ''])
 
 class Recursion(Base):
     """recursion in Hand computing should never happen"""
@@ -564,6 +598,450 @@ class Recursion(Base):
         self.scoreTest('c6c6c6C6 fe fs RS8S8C1C2C3C4C5C7C8C9 LC6', [NoWin(16), NoWin(16, 1)])
         self.scoreTest('c6c6c6C6 fe fs RS8S8C1C2C3C4C5C7C8C9 LC7', [NoWin(16), NoWin(16, 1)])
 
+class TileCounting(Base):
+    """TileCounts counts exposed and concealed tiles together"""
+    def testMe(self):
+        counts = TileList('S1s1S2B9DrdrXyb0').counts()
+        self.assertEqual(len(counts), TileCounts.size)
+        self.assertEqual(sum(counts), 8)
+        self.assertEqual(counts[Tile('s1').code], 2)
+        self.assertEqual(counts[Tile('Dr').code], 2)
+        self.assertTrue(Tile('b0').code is None)
+        self.assertEqual(counts[TileCounts.unknownCode], 2)
+        self.assertEqual(counts.codes(), frozenset([Tile('s1').code, Tile('s2').code,
+            Tile('b9').code, Tile('dr').code, TileCounts.unknownCode]))
+        self.assertTrue(counts.anyOf(TileCounts.dragons))
+        self.assertFalse(counts.only(TileCounts.honors))
+        majors = TileList('S1B9DrWe').counts()
+        self.assertTrue(majors.only(TileCounts.majors))
+        self.assertEqual(str(majors.added(Tile('s1').code)), 'drwes1s1b9')
+        self.assertEqual(counts.groupValues('s'), (1, 1, 2))
+        self.assertEqual(str(TileList('C3c2C1').counts().tiles()), 'c1c2c3')
+        self.assertEqual((majors + majors - majors), majors)
+
+class Shanten(Base):
+    """how many tiles are missing"""
+    def testMe(self):
+        self.shantenTest('RS1S2S3S4S5S6S7S8S9B1B1B1C1', [0, 4])
+        self.shantenTest('RS1S2S3S4S5S6S7S8S9B1B1B1C1C1', [-1, 3])
+        self.shantenTest('RS2S2S2B1B1B1C1C2C3DrDrWeWe', 0, 'drwe')
+        self.shantenTest('RS1S1S1S2S3S4S5S6S7S8S9S9S9', 0)
+        self.shantenTest('RS1S4S7B2B5B8C3C6C9WeWsWwWn', [7, 6])
+        self.shantenTest('RS1S9B1B9C1C9WeWsWwWnDbDgDr', 0, 's1s9b1b9c1c9wewswwwndbdgdr')
+        self.shantenTest('RS1S1S9S9B1B1B9B9C1C1WeWeWs', [3, 0])
+        self.shantenTest('RC1C2C3C4C5C6C7C8C9WeWsWwWn', [2, 0])
+        self.shantenTest('RS1B1S2B2S3B3S4B4S5B5S6B6S7', 0)
+        self.shantenTest('RXyXyXyXyXyXyXyXyXyXyXyXyXy', None)
+
+class PermutationTable(Base):
+    """the precomputed permutations must be what we would compute"""
+    def testMe(self):
+        tmpdir = mkdtemp(prefix='kajongg')
+        try:
+            fileName = os.path.join(tmpdir, 'permutations.tbl')
+            permutations.PermutationTable.write(fileName, maxTiles=6)
+            table = permutations.PermutationTable(fileName)
+            self.assertTrue(table.size)
+            for values in ((1, 1, 2, 3), (3, 4, 5, 5, 6, 7), (7, 8, 9), (9, 9, 9, 9), (2, 2, 3, 3, 4, 4)):
+                self.assertEqual(table.get(values), Permutations.computeUseful(values))
+            # too many tiles for this table, or more than 4 of a kind
+            self.assertTrue(table.get((1, 2, 3, 4, 5, 6, 7)) is None)
+            self.assertTrue(table.get((1, 1, 1, 1, 1)) is None)
+            table.data.close()
+        finally:
+            shutil.rmtree(tmpdir)
+        if Permutations.table.size:
+            for values in ((3, 4, 5, 5, 5, 6, 7, 7), (1, 2, 3, 4, 5, 6, 7, 8, 9)):
+                self.assertEqual(Permutations.table.get(values), Permutations.computeUseful(values))
+
+class ColorVariantCache(Base):
+    """the color variants are evicted least recently used first"""
+    def testMe(self):
+        oldSize = Permutations.colorVariantCacheSize
+        Permutations.cache.clear()
+        Permutations.colorVariantCache.clear()
+        try:
+            Permutations.colorVariantCacheSize = 3
+            Permutations(TileList('S1S2S3B1B2B3C4C4C4'))
+            Permutations(TileList('S1S2S3B7B8B9C4C4C4'))
+            self.assertEqual(list(Permutations.colorVariantCache),
+                [('S', (1, 2, 3)), ('B', (7, 8, 9)), ('C', (4, 4, 4))])
+        finally:
+            Permutations.colorVariantCacheSize = oldSize
+            Permutations.cache.clear()
+            Permutations.colorVariantCache.clear()
+
+class RuleIndex(Base):
+    """rules left out by Ruleset.applicableRules must not apply"""
+    def testMe(self):
+        for game in GAMES:
+            ruleset = game.ruleset
+            ruleLists = (ruleset.handRules, ruleset.winnerRules, ruleset.loserRules)
+            for string in ('dgdgdg drdrdr dbdb wewewe s1s2s3 mw Ldrdrdrdr',
+                    'RWsWsWsWwWwWwWeWeWeWnWnS1S1 me', 'RS1S1S2S3S4S5S6S7S8S9S9S9DgDgDg mz fe',
+                    'b2b2b2b2 RB3B3B3B6B6B6B7B8B9DgDg mk LB8'):
+                hand = Hand(game.players[0], string)
+                features = hand.features()
+                applicable = sum((ruleset.applicableRules(x, features) for x in ruleLists), [])
+                for rule in sum((list(x) for x in ruleLists), []):
+                    if rule not in applicable:
+                        self.assertFalse(rule.appliesToHand(hand), '%s: %s' % (string, rule.name))
+                self.assertTrue(len(ruleset.applicableRules(ruleset.winnerRules, features))
+                    < len(ruleset.winnerRules))
+
+class CompiledRules(Base):
+    """Ruleset.matchingRules finds what appliesToHand of every applicable rule finds"""
+    def testMe(self):
+        for game in GAMES:
+            ruleset = game.ruleset
+            for string in ('dgdgdg drdrdr dbdb wewewe s1s2s3 mw Ldrdrdrdr',
+                    'RWsWsWsWwWwWwWeWeWeWnWnS1S1 me', 'RS1S1S2S3S4S5S6S7S8S9S9S9DgDgDg mz fe',
+                    'b2b2b2b2 RB3B3B3B6B6B6B7B8B9DgDg mk LB8', 'RC1C1C1C2C3C4C5C6C7C8C9C9C9 mw LC1'):
+                hand = Hand(game.players[0], string)
+                features = hand.features()
+                expected = list(x for x in ruleset.applicableRules(ruleset.handRules, features)
+                    if x.appliesToHand(hand))
+                self.assertEqual(ruleset.matchingRules(ruleset.handRules, hand, features), expected)
+
+class BulkScoring(Base):
+    """BulkScorer returns what Hand says"""
+    def testMe(self):
+        rows = ['dgdgdg drdrdr dbdb wewewe s1s2s3 mw Ldrdrdrdr',
+            ('RWsWsWsWwWwWwWeWeWeWnWnS1S1 me', 'we'),
+            ('b2b2b2b2 RB3B3B3B6B6B6B7B8B9DgDg mk LB8', 'sw'),
+            'dgdgdg drdrdr dbdb wewewe s1s2s3 mw Ldrdrdrdr',
+            ('RS1S1S2S3S4S5S6S7S8S9S9S9DgDgDg mz fe', 'ee', False),
+            'RB1B1B2B3B4 mw']
+        for idx, ruleset in enumerate(RULESETS):
+            scores = BulkScorer(ruleset).score(rows)
+            self.assertEqual(len(scores), len(rows))
+            game = GAMES[idx]
+            for rowIdx, row in enumerate(rows):
+                string, winds, mayWin = BulkScorer.normalize(row)
+                self.prepareGame(game, winds)
+                game.winner.mayWin = mayWin
+                hand = Hand(game.winner, string)
+                game.winner.mayWin = True
+                self.assertEqual(scores.row(rowIdx), (string, hand.won, hand.score.points,
+                    hand.score.doubles, hand.score.limits, hand.score.total(),
+                    tuple(x.rule.name for x in hand.usedRules or ())))
+        self.assertEqual(list(BulkScorer.readRows(['# comment', '', 'we\tRB1B1 mw', 'RB2B2 mw'])),
+            [('RB1B1 mw', 'we'), 'RB2B2 mw'])
+
+class Rescoring(Base):
+    """Rescorer gets the rulesets over the wire, compare only reports changes"""
+    def testMe(self):
+        rescorer = Rescorer()
+        for idx, ruleset in enumerate(RULESETS[:2]):
+            rescorer.define(idx, ruleset.toList())
+        string = 'dgdgdg drdrdr dbdb wewewe s1s2s3 mw Ldrdrdrdr'
+        results = rescorer.score([(0, 'we', True, string), (1, 'we', True, string),
+            (0, 'ee', False, 'RB1B1B2B3B4 mw')])
+        for result, scores in zip(results[:2], (BulkScorer(x).score([(string, 'we')]) for x in RULESETS[:2])):
+            self.assertEqual(result, (True, scores.totals[0], scores.rules[0]))
+        self.assertFalse(results[2][0])
+        won, points, rules = results[0]
+        records = [(1, 0, 'a', 'W', 'E', 1, string, points, '', 1),
+            (1, 0, 'b', 'E', 'E', 0, 'RB1B1B2B3B4 mw', 4, '', 1),
+            (2, 0, 'a', 'W', 'E', 1, string, points + 2, '', 1)]
+        counts = {}
+        self.assertEqual(list(compare(zip(records, [results[0], None, results[0]]), counts)), [
+            ['hand', 2, 0, 'a', 'W', 1, 1, points + 2, points, '||'.join(rules)],
+            ['game', 2, 'a', points + 2, points, 1, 1]])
+        self.assertEqual(counts, {'games': 2, 'hands': 3, 'changed hands': 1, 'changed games': 1})
+        self.assertTrue(won)
+
+class RulesetDiff(Base):
+    """toDiffList only sends what differs from a predefined ruleset"""
+    def testMe(self):
+        base = GAMES[0].ruleset
+        rules = list(list(x) for x in base.toList()[1:])
+        changed = next(x for x in rules if x[1] == base.meldRules.listId)
+        changed[5] += 2
+        rules.remove(next(x for x in rules if x[1] == base.handRules.listId))
+        custom = Ruleset([[5, 'customHash', 'custom', 'test']] + rules)
+        custom.dirty = True
+        self.assertEqual(custom.nearestPredefined().hash, base.hash)
+        diff = custom.toDiffList()
+        self.assertEqual(diff[0][4:], [base.hash, sorted(diff[0][5])])
+        self.assertEqual(len(diff[0][5]), 2)
+        self.assertEqual(list(x[1:] for x in diff[1:]), [tuple(changed[1:])])
+        diff[0][1] = 'copyHash'
+        copy = Ruleset(diff)
+        copy.dirty = True
+        self.assertEqual(copy.hash, custom.hash)
+        self.assertEqual(copy.toList()[1:], custom.toList()[1:])
+
+class HandCaching(Base):
+    """the HandCache evicts the least recently used hands"""
+    def testMe(self):
+        player = GAMES[0].players[0]
+        oldSize = Options.handCacheSize
+        HandCache.clear()
+        try:
+            Options.handCacheSize = 2
+            hand1 = Hand(player, 's1s1s1 s2s2s2')
+            hand2 = Hand(player, 's3s3s3 s4s4s4')
+            self.assertTrue(Hand(player, 's1s1s1 s2s2s2') is hand1)
+            Hand(player, 's5s5s5 s6s6s6')
+            self.assertEqual(HandCache.evictions, 1)
+            self.assertTrue(Hand(player, 's1s1s1 s2s2s2') is hand1)
+            self.assertTrue(Hand(player, 's3s3s3 s4s4s4') is not hand2)
+            # building a Hand may need the Hand itself, even with a tiny cache
+            Options.handCacheSize = 1
+            string = 's1s1s1s1 b5b6b7 RB7B8C2C2C6C7C8 Lb5'
+            self.assertEqual(sorted(str(x.lastTile) for x in Hand(player, string).callingHands), ['B6', 'B9'])
+            self.assertFalse(HandCache.building)
+            self.assertTrue(HandCache.checkSize(0))
+            self.assertFalse(HandCache.checkSize(1))
+            # with a winner, rules may look at the history of the game
+            game = PlayingGame([], RULESETS[0])
+            withoutWinner = HandCache.key(game.players[0], string)
+            game.winner = game.players[0]
+            withWinner = HandCache.key(game.players[0], string)
+            game.handctr += 1
+            self.assertEqual(len(set([withoutWinner, withWinner, HandCache.key(game.players[0], string)])), 3)
+        finally:
+            Options.handCacheSize = oldSize
+            HandCache.clear()
+
+class HandSharing(Base):
+    """a Hand found in the HandCache for another game shares the evaluation,
+    shanten and the search for calling hands. But the calling hands belong
+    to the player"""
+    def testMe(self):
+        HandCache.clear()
+        try:
+            # GAMES may have a winner from other tests, that would be another key
+            game, other = PlayingGame([], RULESETS[0]), PlayingGame([], RULESETS[0])
+            string = 'RS8S6S7C4S5B4C4S6S7S4B3C4S7'
+            hand1 = Hand(game.players[0], string)
+            hand2 = Hand(other.players[0], string)
+            self.assertTrue(hand2 is not hand1)
+            self.assertEqual(HandCache.shared, 1)
+            self.assertTrue(hand2.score == hand1.score)
+            self.assertTrue(hand1.callingHands)
+            misses = HandCache.misses
+            self.assertTrue(hand2.callingHands)
+            self.assertEqual(HandCache.misses, misses)
+            self.assertEqual([x.string for x in hand2.callingHands], [x.string for x in hand1.callingHands])
+            self.assertTrue(all(x.player is other.players[0] for x in hand2.callingHands))
+            self.assertTrue(all(x.player is game.players[0] for x in hand1.callingHands))
+            self.assertTrue(hand2.shanten is hand1.shanten)
+        finally:
+            HandCache.clear()
+
+class Simulation(Base):
+    """play complete games without game server and clients"""
+    def testMe(self):
+        oldRounds = Options.rounds
+        try:
+            Options.rounds = 1
+            simulator = Simulator(RULESETS[0])
+            row = simulator.play(1)
+            self.assertEqual(row, simulator.play(1))
+            self.assertEqual(len(row), 5 + 4 * 4)
+            self.assertEqual(sorted(row[5::4]), sorted(Simulator.names))
+            self.assertEqual(sum(row[6::4]), 0)
+            self.assertEqual(sum(row[8::4]), 1)
+        finally:
+            Options.rounds = oldRounds
+            HandCache.clear()
+
+class SimulatedEastWins(Base):
+    """the Simulator has no database, it counts the wins of East itself"""
+    def testMe(self):
+        oldRounds, oldNineTimes = Options.rounds, EastWonNineTimesInARow.nineTimes
+        try:
+            Options.rounds = 1
+            simulator = Simulator(RULESETS[0])
+            for nineTimes in (0, 1):
+                EastWonNineTimesInARow.nineTimes = nineTimes
+                for seed in range(1, 5):
+                    row = simulator.play(seed)
+                    self.assertEqual(len(row), 5 + 4 * 4)
+                    self.assertEqual(sum(row[6::4]), 0)
+        finally:
+            Options.rounds = oldRounds
+            EastWonNineTimesInARow.nineTimes = oldNineTimes
+            HandCache.clear()
+
+class DBWriting(Base):
+    """the DBWriter commits everything written before sync, but
+    never parts of one write"""
+    def testMe(self):
+        tmpdir = mkdtemp(prefix='kajongg')
+        try:
+            connection = sqlite3.connect(os.path.join(tmpdir, 'test.db'))
+            connection.execute('create table t(x integer unique)')
+            connection.commit()
+            writer = DBWriter(os.path.join(tmpdir, 'test.db'))
+            try:
+                insert = 'insert into t values(?)'
+                writer.write([(insert, (1,)), (insert, (2,))])
+                writer.write([(insert, (3,)), (insert, (1,))])
+                writer.write([(insert, (4,))])
+                writer.sync()
+                self.assertEqual(connection.execute('select x from t order by x').fetchall(),
+                    [(1,), (2,), (4,)])
+            finally:
+                writer.stop()
+                connection.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+class ScoresWritten(Base):
+    """when a ServerGame ends, all its scores and its end time are in the database"""
+    def testMe(self):
+        tmpdir = mkdtemp(prefix='kajongg')
+        oldRounds, oldIsServer = Options.rounds, Internal.isServer
+        try:
+            Options.rounds = 1
+            Internal.isServer = True
+            path = os.path.join(tmpdir, 'test.db')
+            PrepareDB(path)
+            DBHandle(path)
+            Internal.db.startWriter()
+            for name in Simulator.names:
+                Players.createIfUnknown(name)
+            ruleset = ClassicalChineseDMJL()
+            ruleset.save()
+            Query('insert into game(id,seed) values(?,?)', (1, 'proposed'))
+            simulator = Simulator(ruleset)
+            game = ServerGame(Simulator.names, ruleset, gameid=1, wantedGame='1',
+                client=simulator, playOpen=True)
+            game.saveStartTime()
+            game.nameWallTiles()
+            while not game.finished():
+                simulator.playHand(game)
+                game.maybeRotateWinds()
+            self.assertEqual(Query('select count(1), max(hand) from score where game=1').records,
+                [(4 * game.handctr, game.handctr - 1)])
+            self.assertTrue(Query('select endtime from game where id=1').records[0][0])
+        finally:
+            Options.rounds, Internal.isServer = oldRounds, oldIsServer
+            if Internal.db:
+                Internal.db.close()
+            HandCache.clear()
+            shutil.rmtree(tmpdir)
+
+class CompactMoves(Base):
+    """MoveCodec delivers what Message.jelly would"""
+    def testMe(self):
+        server = MoveCodec()
+        client = MoveCodec()
+        moves = [
+            ('Robot 1', Message.PickedTile, dict(tile=Tile('Xy'), token='3/1/E1/Ws', deadEnd=False)),
+            ('Robot 1', Message.Discard, dict(tile=Tile('b3'), score='B1B2B3 fe', token='3/1/E1/Ws')),
+            ('Robot 1', Message.Discard, dict(tile=Tile('fe'), score='B1B2B3 R', token='3/1/E2/Ws')),
+            ('Robot 2', Message.Discard, dict(tile=Tile('b0'), score='B1B2B3 fe', token=None)),
+            ('Robot 1', Message.DeclaredKong, dict(meld=Meld('c1C1C1c1'), tiles=TileList('Xy'))),
+            (None, Message.MahJongg, dict(melds=MeldList('b1b1b1 S2S3S4'), withDiscardTile=None,
+                                          tiles=TileList(), score='')),
+            ('Robot 2', Message.Discard, dict(tile=Tile('C5'), score='B1B2', token='3/1/E2/Ws'))]
+        for about, command, kwargs in moves:
+            expected = Message.jellyAll([], kwargs)[1]
+            self.assertEqual(client.decode(server.encode(about, command, kwargs)),
+                (about, command.name, expected))
+        # moves relayed for a worker are already jellied, they must be compacted the same way
+        server, relay, client = MoveCodec(), MoveCodec(), MoveCodec()
+        for about, command, kwargs in moves:
+            expected = Message.jellyAll([], kwargs)[1]
+            payload = relay.encode(about, command, expected)
+            self.assertEqual(payload, server.encode(about, command, kwargs))
+            self.assertEqual(client.decode(payload), (about, command.name, expected))
+
+class TimerWheeling(Base):
+    """the timer wheel calls in order, never early, and stops ticking when idle"""
+    def testMe(self):
+        clock = Clock()
+        wheel = TimerWheel(tick=0.1, slots=8, reactor=clock)
+        called = []
+        wheel.callLater(2.0, called.append, 'late')
+        wheel.callLater(0.25, called.append, 'early')
+        wheel.callLater(0.25, called.append, 'cancelled').cancel()
+        wheel.deferLater(1.05, called.append, 'deferred')
+        clock.advance(0.2)
+        self.assertEqual(called, [])
+        clock.advance(0.1)
+        self.assertEqual(called, ['early'])
+        clock.pump([0.1] * 10)
+        self.assertEqual(called, ['early', 'deferred'])
+        clock.pump([0.1] * 6)
+        self.assertEqual(called, ['early', 'deferred'])
+        clock.pump([0.1] * 4)
+        self.assertEqual(called, ['early', 'deferred', 'late'])
+        self.assertEqual(wheel.count, 0)
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+class TimerWheelOrder(Base):
+    """timers due in the same tick are called like with reactor.callLater,
+    and the reactor only wakes up when a timer is due"""
+    def testMe(self):
+        clock = Clock()
+        wheel = TimerWheel(tick=0.1, slots=8, reactor=clock)
+        called = []
+        wheel.callLater(60, called.append, 'ping')
+        self.assertEqual(self.wakeups(clock), [600])
+        for name in 'fedcba':
+            wheel.callLater(0.2, called.append, name)
+        wheel.callLater(0.15, called.append, 'first')
+        wheel.callLater(0.2, lambda: cancelled.cancel()) # pylint: disable=unnecessary-lambda
+        cancelled = wheel.callLater(0.2, called.append, 'cancelled')
+        self.assertEqual(self.wakeups(clock), [2])
+        clock.advance(0.2)
+        self.assertEqual(called, ['first', 'f', 'e', 'd', 'c', 'b', 'a'])
+        self.assertEqual(wheel.count, 1)
+        self.assertEqual(self.wakeups(clock), [600])
+        clock.advance(59.8)
+        self.assertEqual(called[-1], 'ping')
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    @staticmethod
+    def wakeups(clock):
+        """the ticks when the reactor will call the wheel"""
+        return list(int(round(x.getTime() * 10)) for x in clock.getDelayedCalls())
+
+class MetricsText(Base):
+    """counters and histograms in the text format of Prometheus"""
+    def testMe(self):
+        counter = Counter('test_moves_total', 'moves', ('message', ))
+        histogram = Histogram('test_seconds', 'seconds', buckets=(0.1, 1.0))
+        try:
+            counter.inc(('Discard', ))
+            counter.inc(('Discard', ), 2)
+            histogram.observe(0.1)
+            histogram.observe(0.5)
+            histogram.observe(3.0)
+            text = Metric.render()
+            self.assertIn('# TYPE test_moves_total counter\ntest_moves_total{message="Discard"} 3\n', text)
+            self.assertIn('test_seconds_bucket{le="0.1"} 1\n'
+                'test_seconds_bucket{le="1.0"} 2\n'
+                'test_seconds_bucket{le="+Inf"} 3\n'
+                'test_seconds_sum 3.6\n'
+                'test_seconds_count 3\n', text)
+        finally:
+            Metric.registry.remove(counter)
+            Metric.registry.remove(histogram)
+
+class Sampling(Base):
+    """the sampler folds stacks for flamegraph.pl with the subsystem as root"""
+    def testMe(self):
+        self.assertEqual(Sampler.subsystem(['/x/twisted/internet/base.py', '/x/hand.py', '/x/server.py']),
+            'reactor')
+        self.assertEqual(Sampler.subsystem(['/x/rule.py', '/x/intelligence.py']), 'scoring')
+        self.assertEqual(Sampler.subsystem(['/x/server.py']), 'other')
+        sampler = Sampler(None)
+        def inner():
+            """the leaf"""
+            sampler.sample(sys._getframe()) # pylint: disable=protected-access
+        inner()
+        inner()
+        stack, count = sampler.folded().split()
+        self.assertEqual(count, '2')
+        self.assertTrue(stack.startswith('other;'))
+        self.assertTrue(stack.endswith(';scoringtest.py:testMe;scoringtest.py:inner'))
+
 class TstProgram(unittest.TestProgram):
     """we want global access to this program so we can check for verbosity in our tests"""
     def __init__(self, *args, **kwargs):
@@ -64,7 +64,7 @@ Internal.logPrefix = 'S'
 
 from twisted.spread import pb
 from twisted.internet import error
-from twisted.internet.defer import maybeDeferred, fail, succeed
+from twisted.internet.defer import Deferred, maybeDeferred, fail, succeed
 from zope.interface import implements
 from twisted.cred import checkers, portal, credentials, error as credError
 from twisted.internet import reactor
@@ -72,19 +72,22 @@ from twisted.internet.error import ReactorNotRunning
 reactor.addSystemEventTrigger('before', 'shutdown', cleanExit)
 Internal.reactor = reactor
 
-from tile import Tile, TileList, elements
-from game import PlayingGame
+from tile import Tile, TileList
+from game import ServerGame
 from player import Players
 from wall import WallEmpty
 from client import Client, Table
-from query import Query, initDb
+from query import Query, DBHandle, initDb
 from meld import Meld, MeldList
 from log import m18n, m18nE, m18ncE, logDebug, logWarning, logError, SERVERMARK
 from util import Duration, elapsedSince
-from message import Message, ChatMessage
+from message import Message, ChatMessage, MoveCodec
 from common import Debug
 from sound import Voice
 from deferredutil import DeferredBlock
+from timerwheel import TimerWheel
+from hand import HandCache
+import metrics
 from rule import Ruleset
 
 def srvMessage(*args):
@@ -120,7 +123,7 @@ class DBPasswordChecker(object):
                 query = Query('insert or ignore into player(name,password) values(?,?)', (cred.username, password))
             elif args[1] == 'deluser':
                 pass
-        query = Query('select id, password from player where name=?', (cred.username,))
+        query = Query(DBHandle.statements['login'], (cred.username,))
         if not len(query.records):
             template = 'Wrong username: %1'
             if Debug.connections:
@@ -139,34 +142,6 @@ class DBPasswordChecker(object):
             return fail(credError.UnauthorizedLogin(srvMessage(m18nE('Wrong password'))))
         return userid
 
-class ServerGame(PlayingGame):
-    """the central game instance on the server"""
-    # pylint: disable=too-many-arguments, too-many-public-methods
-    def __init__(self, names, ruleset, gameid=None, wantedGame=None,
-                client=None, playOpen=False, autoPlay=False):
-        PlayingGame.__init__(self, names, ruleset, gameid, wantedGame, client, playOpen, autoPlay)
-        self.shouldSave = True
-
-    def throwDices(self):
-        """sets random living and kongBox
-        sets divideAt: an index for the wall break"""
-        self.wall.tiles.sort()
-        self.randomGenerator.shuffle(self.wall.tiles)
-        PlayingGame.throwDices(self)
-
-    def initHand(self):
-        """Happens only on server: every player gets 13 tiles (including east)"""
-        self.throwDices()
-        self.wall.divide()
-        for player in self.players:
-            player.clearHand()
-            # 13 tiles at least, with names as given by wall
-            player.addConcealedTiles(self.wall.deal([None] * 13))
-            # compensate boni
-            while len(player.concealedTiles) != 13:
-                player.addConcealedTiles(self.wall.deal())
-        PlayingGame.initHand(self)
-
 class ServerTable(Table):
     """a table on the game server"""
     # pylint: disable=too-many-arguments
@@ -181,6 +156,7 @@ class ServerTable(Table):
         self.remotes = {}   # maps client connections to users
         self.game = None
         self.client = None
+        self.shard = None   # the Shard playing this table, see shard.py
         server.tables[self.tableid] = self
         if Debug.table:
             logDebug('new table %s' % self)
@@ -247,6 +223,8 @@ class ServerTable(Table):
         if user in self.users:
             self.running = False
             self.users.remove(user)
+            if self.shard:
+                self.shard.userLeft(self, user)
             self.sendChatMessage(ChatMessage(self.tableid, user.name,
                 m18nE('leaves the table'), isStatusMessage=True))
             if user is self.owner:
@@ -346,6 +324,8 @@ class ServerTable(Table):
             raise srvError(pb.Error,
                 m18nE('Only the initiator %1 can start this game, you are %2'),
                 self.owner.name, user.name)
+        if self.server.shards and self.server.shards.place(self, user):
+            return
         if self.suspendedAt:
             self.__connectPlayers()
             self.__checkDbIdents()
@@ -410,30 +390,12 @@ class ServerTable(Table):
                 return
         if Debug.table:
             logDebug('Game starts on table %s' % self)
-        elementIter = iter(elements.all(self.game.ruleset))
-        wallSize = len(self.game.wall.tiles)
-        self.game.wall.tiles = []
-        for _ in range(wallSize):
-            self.game.wall.tiles.append(elementIter.next().concealed)
+        self.game.nameWallTiles()
         assert isinstance(self.game, ServerGame), self.game
         self.running = True
-        self.__adaptOtherTables()
+        self.server.gameStarted(self)
         self.sendVoiceIds()
 
-    def __adaptOtherTables(self):
-        """if the players on this table also reserved seats on other tables, clear them
-        make running table invisible for other users"""
-        for user in self.users:
-            for tableid in self.server.tablesWith(user):
-                if tableid != self.tableid:
-                    self.server.leaveTable(user, tableid)
-        foreigners = list(x for x in self.server.srvUsers if x not in self.users)
-        if foreigners:
-            if Debug.table:
-                logDebug('make running table %s invisible for %s' % (self, ','.join(str(x) for x in foreigners)))
-            for srvUser in foreigners:
-                self.server.callRemote(srvUser, 'tableRemoved', self.tableid, '')
-
     def sendVoiceIds(self):
         """tell each player what voice ids the others have. By now the client has a Game instance!"""
         humanPlayers = [x for x in self.game.players if isinstance(self.remotes[x], User)]
@@ -623,11 +585,17 @@ class ServerTable(Table):
             block.callback(self.saveHand)
 
     def saveHand(self, dummyResults=None):
-        """save the hand to the database and proceed to next hand"""
+        """save the hand to the database and proceed to next hand
+        when the clients and the database are done"""
         if not self.running:
             return
-        self.tellAll(None, Message.SaveHand, self.nextHand)
-        self.game.saveHand()
+        written = Deferred()
+        def proceed(results):
+            """the clients saved the hand, wait for our database"""
+            # errors are already logged by the DBWriter
+            written.addBoth(lambda dummy: self.nextHand(results))
+        self.tellAll(None, Message.SaveHand, proceed)
+        self.game.saveHand().chainDeferred(written)
 
     def nextHand(self, dummyResults):
         """next hand: maybe rotate"""
@@ -839,9 +807,8 @@ class MJServer(object):
     def __init__(self):
         self.tables = {}
         self.srvUsers = list()
+        self.shards = None
         Players.load()
-        self.lastPing = None
-        self.checkPings()
 
     def chat(self, chatString):
         """a client sent us a chat message"""
@@ -854,15 +821,21 @@ class MJServer(object):
         """accept a new user"""
         if not user in self.srvUsers:
             self.srvUsers.append(user)
+            self.checkPing(user)
             self.loadSuspendedTables(user)
 
     def callRemote(self, user, *args, **kwargs):
         """if we still have a connection, call remote, otherwise clean up"""
+        if user.mind:
+            return self.callRemoteJellied(user, *Message.jellyAll(args, kwargs))
+
+    def callRemoteJellied(self, user, args, kwargs):
+        """like callRemote but args and kwargs are already jellied. This
+        lets us jelly a message only once for all receivers"""
         if user.mind:
             try:
-                args2, kwargs2 = Message.jellyAll(args, kwargs)
                 # pylint: disable=star-args
-                return user.mind.callRemote(*args2, **kwargs2).addErrback(MJServer.ignoreLostConnection)
+                return user.mind.callRemote(*args, **kwargs).addErrback(MJServer.ignoreLostConnection)
             except (pb.DeadReferenceError, pb.PBConnectionLost):
                 user.mind = None
                 self.logout(user)
@@ -879,18 +852,23 @@ class MJServer(object):
             except ReactorNotRunning:
                 pass
 
-    def checkPings(self):
-        """are all clients still alive? If not log them out"""
-        if not self.srvUsers and self.lastPing and elapsedSince(self.lastPing) > 30:
-            # no user at all since 30 seconds, but we did already have a user
+    def checkPing(self, user):
+        """is the client still alive? If not log him out. Pinging only
+        stamps the user, so we look again when his last ping is 60 seconds old"""
+        if user not in self.srvUsers:
+            return
+        idle = elapsedSince(user.lastPing)
+        if idle > 60:
+            logDebug('No messages from %s since 60 seconds, clearing connection now' % user.name)
+            user.mind = None
+            self.logout(user)
+        else:
+            TimerWheel.default().callLater(60 - idle, self.checkPing, user)
+
+    def __checkLastDisconnect(self):
+        """no user at all since 30 seconds, but we did already have a user"""
+        if not self.srvUsers:
             self.__stopAfterLastDisconnect()
-        for user in self.srvUsers:
-            self.lastPing = max(self.lastPing, user.lastPing) if self.lastPing else user.lastPing
-            if elapsedSince(user.lastPing) > 60:
-                logDebug('No messages from %s since 60 seconds, clearing connection now' % user.name)
-                user.mind = None
-                self.logout(user)
-        reactor.callLater(10, self.checkPings)
 
     @staticmethod
     def ignoreLostConnection(failure):
@@ -954,12 +932,13 @@ class MJServer(object):
         assert result
         return result
 
-    def needRulesets(self, rulesetHashes):
-        """the client wants those full rulesets"""
+    def needRulesets(self, rulesetHashes, asDiff=False):
+        """the client wants those full rulesets. With asDiff, only send what is not
+        in the most similar predefined ruleset, see Ruleset.toDiffList"""
         result = []
-        for table in self.tables.values():
-            if table.ruleset.hash in rulesetHashes:
-                result.append(table.ruleset.toList())
+        rulesets = dict((x.ruleset.hash, x.ruleset) for x in self.tables.values())
+        for ruleset in (rulesets[x] for x in rulesetHashes if x in rulesets):
+            result.append(ruleset.toDiffList() if asDiff else ruleset.toList())
         return result
 
     def joinTable(self, user, tableid):
@@ -1003,6 +982,20 @@ class MJServer(object):
         """try to start the game"""
         return self._lookupTable(tableid).readyForGameStart(user)
 
+    def gameStarted(self, table):
+        """if the players on this table also reserved seats on other tables, clear them
+        make running table invisible for other users"""
+        for user in table.users:
+            for tableid in self.tablesWith(user):
+                if tableid != table.tableid:
+                    self.leaveTable(user, tableid)
+        foreigners = list(x for x in self.srvUsers if x not in table.users)
+        if foreigners:
+            if Debug.table:
+                logDebug('make running table %s invisible for %s' % (table, ','.join(str(x) for x in foreigners)))
+            for srvUser in foreigners:
+                self.callRemote(srvUser, 'tableRemoved', table.tableid, '')
+
     def removeTable(self, table, reason, message=None, *args):
         """remove a table"""
         assert reason in ('silent', 'tableRemoved', 'gameOver', 'abort')
@@ -1013,6 +1006,8 @@ class MJServer(object):
                 m18n(message, *args)), withGamePrefix=None)
         if table.tableid in self.tables:
             del self.tables[table.tableid]
+            if table.shard:
+                table.shard.removeTable(table)
             if reason == 'silent':
                 tellUsers = []
             else:
@@ -1036,7 +1031,9 @@ class MJServer(object):
             self.leaveTable(user, tableid, m18nE('Player %1 has logged out'), user.name)
         # wait a moment. We want the leaveTable message to arrive everywhere before
         # we say serverDisconnects. Sometimes the order was reversed.
-        reactor.callLater(1, self.__logout2, user)
+        TimerWheel.default().callLater(1, self.__logout2, user)
+        if not self.srvUsers:
+            TimerWheel.default().callLater(30, self.__checkLastDisconnect)
 
     def __logout2(self, user):
         """now the leaveTable message had a good chance to get to the clients first"""
@@ -1053,20 +1050,8 @@ class MJServer(object):
         user logs out, there are filters anyway returning only
         the suspended games for a certain user.
         Never load old autoplay games."""
-        query = Query("select distinct g.id, g.starttime, " \
-            "g.seed, " \
-            "ruleset, s.scoretime " \
-            "from game g, player p0, score s," \
-            "player p1, player p2, player p3 " \
-            "where autoplay=0 " \
-            " and p0.id=g.p0 and p1.id=g.p1 " \
-            " and p2.id=g.p2 and p3.id=g.p3 " \
-            " and (p0.name=? or p1.name=? or p2.name=? or p3.name=?) " \
-            " and s.game=g.id" \
-            " and g.endtime is null" \
-            " and exists(select 1 from ruleset where ruleset.id=g.ruleset)" \
-            " and exists(select 1 from score where game=g.id)" \
-            " and s.scoretime = (select max(scoretime) from score where game=g.id) limit 10",
+        Internal.db.sync()
+        query = Query(DBHandle.statements['suspendedTables'],
             (user.name, user.name, user.name, user.name))
         for gameid, _, seed, ruleset, suspendTime in query.records:
             if gameid not in (x.game.gameid for x in self.tables.values() if x.game):
@@ -1083,6 +1068,7 @@ class User(pb.Avatar):
         self.dbIdent = None
         self.voiceId = None
         self.maxGameId = None
+        self.moveCodec = None
         self.lastPing = None
         self.pinged()
 
@@ -1132,12 +1118,21 @@ class User(pb.Avatar):
                             clientVersion or '<4.9.0',
                             '.'.join(serverVersion.split('.')[:2]) + '.*'))
         self.server.sendTables(self)
+    def perspective_useCompactMoves(self, registryHash):
+        """perspective_* methods are to be called remotely.
+        If we know the same messages, send moves with MoveCodec"""
+        if registryHash == Message.registryHash():
+            self.moveCodec = MoveCodec()
+        return self.moveCodec is not None
     def perspective_ping(self):
         """perspective_* methods are to be called remotely"""
         return self.pinged()
     def perspective_needRulesets(self, rulesetHashes):
         """perspective_* methods are to be called remotely"""
         return self.server.needRulesets(rulesetHashes)
+    def perspective_needRulesetDiffs(self, rulesetHashes):
+        """perspective_* methods are to be called remotely"""
+        return self.server.needRulesets(rulesetHashes, asDiff=True)
     def perspective_joinTable(self, tableid):
         """perspective_* methods are to be called remotely"""
         return self.server.joinTable(self, tableid)
@@ -1181,7 +1176,7 @@ class MJRealm(object):
 
 def parseArgs():
     """as the name says"""
-    from optparse import OptionParser
+    from optparse import OptionParser, SUPPRESS_HELP
     parser = OptionParser()
     defaultPort = Options.defaultPort()
     parser.add_option('', '--port', dest='port',
@@ -1194,6 +1189,19 @@ def parseArgs():
         help=m18n('do not terminate local game server after last client disconnects'), default=False)
     parser.add_option('', '--debug', dest='debug',
         help=Debug.help())
+    parser.add_option('', '--handcache', dest='handCacheSize',
+        help=m18n('the server will cache up to HANDCACHESIZE evaluated hands (%d)' % Options.handCacheSize),
+        type=int, default=Options.handCacheSize)
+    parser.add_option('', '--shards', dest='shards',
+        help=m18n('play the games in SHARDS worker processes (0)'),
+        type=int, default=0)
+    parser.add_option('', '--shardof', dest='shardof', help=SUPPRESS_HELP, default=None)
+    parser.add_option('', '--metrics', dest='metrics',
+        help=m18n('serve metrics for Prometheus at http://localhost:METRICS/metrics or on the UNIX socket METRICS'),
+        default=None)
+    parser.add_option('', '--profile', dest='profile',
+        help=m18n('kill -USR2 starts and stops sampling where we lose time into DIRECTORY'),
+        metavar='DIRECTORY', default=None)
     parser.add_option('', '--nokde', dest='nokde', action='store_true',
         help=m18n('do not use KDE bindings. Only for testing'))
     parser.add_option('', '--qt5', dest='qt5', action='store_true',
@@ -1203,6 +1211,11 @@ def parseArgs():
         logWarning(m18n('unrecognized arguments:%1', ' '.join(args)))
         sys.exit(2)
     Options.continueServer |= options.continueServer
+    msg = HandCache.checkSize(options.handCacheSize)
+    if msg:
+        logWarning(msg)
+        sys.exit(2)
+    Options.handCacheSize = options.handCacheSize
     if options.dbpath:
         Options.dbPath = os.path.expanduser(options.dbpath)
     if options.socket:
@@ -1212,16 +1225,48 @@ def parseArgs():
     del parser           # makes Debug.gc quieter
     return options
 
+def serveMetrics(where, server=None):
+    """the metrics of this process, see metrics.py. Only the game server
+    knows the users and all tables"""
+    metrics.CounterFunction('kajongg_handcache_hits_total', 'hands found in the HandCache',
+        lambda: HandCache.hits)
+    metrics.CounterFunction('kajongg_handcache_misses_total', 'hands not found in the HandCache',
+        lambda: HandCache.misses)
+    metrics.Gauge('kajongg_handcache_entries', 'hands in the HandCache', lambda: len(HandCache.entries))
+    if server:
+        metrics.Gauge('kajongg_tables', 'open tables', lambda: len(server.tables))
+        metrics.Gauge('kajongg_running_tables', 'tables playing a game',
+            lambda: sum(x.running for x in server.tables.values()))
+        metrics.Gauge('kajongg_users', 'connected users', lambda: len(server.srvUsers))
+    metrics.serve(where)
+
 def kajonggServer():
     """start the server"""
     # pylint: disable=too-many-branches
     options = parseArgs()
     if not initDb():
         sys.exit(1)
+    # scores and game records are written behind, all tables share one writer
+    Internal.db.startWriter()
+    import predefined # pylint: disable=unused-variable
+    if options.profile:
+        from sampler import Sampler
+        Sampler(options.profile).install()
+    if options.shardof:
+        from shard import ShardServer
+        ShardServer.connect(options.shardof)
+        if options.metrics:
+            serveMetrics(options.metrics)
+        reactor.run()
+        return
     realm = MJRealm()
     realm.server = MJServer()
+    if options.shards > 0:
+        from shard import Shards
+        realm.server.shards = Shards(realm.server, options.shards, options)
+    if options.metrics:
+        serveMetrics(options.metrics, realm.server)
     kajonggPortal = portal.Portal(realm, [DBPasswordChecker()])
-    import predefined # pylint: disable=unused-variable
     try:
         if Options.socket:
             if os.name == 'nt':
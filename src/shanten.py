@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+
+"""Copyright (C) 2014 Wolfgang Rohdewald <wolfgang@rohdewald.de>
+
+Kajongg is free software you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+Shanten computes how many tiles a hand misses for Mah Jongg and which tiles would help.
+"""
+
+from tile import Tile, TileList, TileCounts
+
+class Shanten(object):
+    """how far a hand is from Mah Jongg, computed from TileCounts without
+    building any Hand or Meld.
+
+    number is the count of tiles which must still be exchanged: -1 for a
+    complete hand, 0 for a calling hand. None if no mjRule can be reached.
+    This does not look at minimum points, doubles or tiles still available.
+
+    tiles are those which would lower number if drawn. They are only
+    computed for hands which are not too long, in exposed form.
+
+    rules are the mjRules reaching number.
+
+    The mjRules compute their part with method shanten(hand, counts),
+    using the helpers in this class. counts only holds the tiles in
+    hand, not the declared melds."""
+
+    # key: tuple of counts for one suit or for all honors
+    # value: tuple of all useful decompositions, see __blocks
+    blockCache = {}
+
+    suitCodes = tuple(tuple(range(x * 9, x * 9 + 9)) for x in range(3))
+    honorCodes = tuple(range(27, 34))
+    playable = tuple(range(34)) # all codes without bonus and unknown tiles
+
+    def __init__(self, hand):
+        self.number = None
+        self.rules = []
+        self.tiles = TileList()
+        if hand.counts[TileCounts.unknownCode]:
+            return
+        counts = hand.tilesInHand.counts()
+        rules = [x for x in hand.ruleset.mjRules if hasattr(x, 'shanten')]
+        numbers = list((x, x.shanten(hand, counts)) for x in rules)
+        numbers = list(x for x in numbers if x[1] is not None)
+        if not numbers:
+            return
+        self.number = min(x[1] for x in numbers)
+        self.rules = list(x[0] for x in numbers if x[1] == self.number)
+        if hand.lenOffset > 0 or self.number < 0:
+            return
+        for code in self.playable:
+            if hand.counts[code] >= 4:
+                continue
+            more = counts.added(code)
+            if any(self.__lower(x.shanten(hand, more)) for x in self.rules):
+                self.tiles.append(TileCounts.tileOf[code])
+        self.tiles = self.tiles.sorted()
+
+    def __lower(self, number):
+        """is number better than ours?"""
+        return number is not None and number < self.number
+
+    @staticmethod
+    def afterDiscard(hand, tile):
+        """the shanten number of hand without tile, or None if not every
+        mjRule knows how to compute it or if no mjRule can be reached"""
+        if any(not hasattr(x, 'shanten') for x in hand.ruleset.mjRules):
+            return None
+        counts = hand.tilesInHand.counts()
+        if not counts[tile.code]:
+            return None
+        counts = counts.added(tile.code, -1)
+        numbers = list(x.shanten(hand, counts) for x in hand.ruleset.mjRules)
+        numbers = list(x for x in numbers if x is not None)
+        if numbers:
+            return min(numbers)
+
+    @staticmethod
+    def standard(counts, melds=4, chows=4, pairDeclared=False):
+        """four melds and a pair. We still need melds melds,
+        up to chows of them may be chows"""
+        if chows < 0:
+            return None
+        states = set([(0, 0, 0, 0, 0)])
+        for codes in Shanten.suitCodes:
+            states = Shanten.__combine(states, Shanten.__blocks(
+                tuple(counts[x] for x in codes), True))
+        states = Shanten.__combine(states, Shanten.__blocks(
+            tuple(counts[x] for x in Shanten.honorCodes), False))
+        result = 99
+        for meldCount, chowCount, pairParts, chowParts, head in states:
+            if pairDeclared:
+                pairParts += head
+                head = 1
+            wasted = max(0, chowCount - chows)
+            meldCount = min(meldCount - wasted, melds)
+            chowParts = min(chowParts, chows - (chowCount - wasted))
+            parts = min(pairParts + chowParts, melds - meldCount)
+            result = min(result, 2 * melds - 2 * meldCount - parts - head)
+        return result
+
+    @staticmethod
+    def __combine(states, blocks):
+        """all sums of a state and a decomposition, with at most one head"""
+        result = set()
+        for state in states:
+            for block in blocks:
+                if state[4] + block[4] < 2:
+                    result.add(tuple(min(x + y, 4) for x, y in zip(state, block)))
+        return Shanten.__prune(result)
+
+    @staticmethod
+    def __prune(states):
+        """remove states which are not better than some other state
+        in any respect. Only chows are bad because they may be limited"""
+        result = []
+        for state in states:
+            if not any(other is not state
+                    and other[0] >= state[0] and other[1] <= state[1]
+                    and other[2] >= state[2] and other[3] >= state[3]
+                    and other[4] >= state[4] for other in states):
+                result.append(state)
+        return tuple(result)
+
+    @staticmethod
+    def __blocks(counts, isSuit):
+        """all useful decompositions of counts for one suit or for the honors.
+        A decomposition is a tuple: melds, chows out of melds,
+        pairs to be completed to pungs, partial chows, and 1 if there
+        is a pair for the head."""
+        cacheKey = (counts, isSuit)
+        if cacheKey in Shanten.blockCache:
+            return Shanten.blockCache[cacheKey]
+        first = next((idx for idx, x in enumerate(counts) if x), None)
+        if first is None:
+            result = ((0, 0, 0, 0, 0),)
+        else:
+            def remove(*offsets):
+                """counts without the tiles at first+offsets"""
+                rest = list(counts)
+                for offset in offsets:
+                    rest[first + offset] -= 1
+                return tuple(rest)
+            variants = [(remove(0), (0, 0, 0, 0, 0))]
+            count = counts[first]
+            if count >= 3:
+                variants.append((remove(0, 0, 0), (1, 0, 0, 0, 0)))
+            if count >= 2:
+                variants.append((remove(0, 0), (0, 0, 1, 0, 0)))
+                variants.append((remove(0, 0), (0, 0, 0, 0, 1)))
+            if isSuit:
+                if first < 7 and counts[first + 1] and counts[first + 2]:
+                    variants.append((remove(0, 1, 2), (1, 1, 0, 0, 0)))
+                for offset in (1, 2):
+                    if first + offset < 9 and counts[first + offset]:
+                        variants.append((remove(0, offset), (0, 0, 0, 1, 0)))
+            states = set()
+            for rest, block in variants:
+                states |= set(Shanten.__combine([block], Shanten.__blocks(rest, isSuit)))
+            result = Shanten.__prune(states)
+        Shanten.blockCache[cacheKey] = result
+        return result
+
+    # key: tuple of counts for one suit or for all honors, isSuit
+    # value: dict (melds, pairs): fewest chows, for all ways to use
+    # all those tiles for complete melds and pairs
+    completeCache = {}
+
+    # key: like completeCache
+    # value: tuple of (index, value of completeCache) for each tile
+    # which can be added such that all tiles are used
+    waitCache = {}
+
+    @staticmethod
+    def waits(counts, melds=4, chows=4, pairs=1):
+        """the codes of all tiles completing counts to exactly melds melds
+        with up to chows chows and pairs pairs. Other tiles cannot be
+        added and tiles are never left over"""
+        if melds < 0 or chows < 0 or pairs not in (0, 1):
+            return frozenset()
+        groups = list((codes, True) for codes in Shanten.suitCodes)
+        groups.append((Shanten.honorCodes, False))
+        completes = list(Shanten.__complete(tuple(counts[x] for x in codes), isSuit)
+            for codes, isSuit in groups)
+        result = set()
+        for idx, (codes, isSuit) in enumerate(groups):
+            others = {(0, 0): 0}
+            for other in completes[:idx] + completes[idx + 1:]:
+                others = Shanten.__add(others, other)
+            if not others:
+                continue
+            for offset, parts in Shanten.__waits(tuple(counts[x] for x in codes), isSuit):
+                parts = Shanten.__add(others, parts)
+                if parts.get((melds, pairs), 99) <= chows:
+                    result.add(codes[offset])
+        return frozenset(result)
+
+    @staticmethod
+    def __add(parts1, parts2):
+        """all sums like in completeCache, with at most 4 melds and 1 pair"""
+        result = {}
+        for (melds1, pairs1), chows1 in parts1.items():
+            for (melds2, pairs2), chows2 in parts2.items():
+                key = (melds1 + melds2, pairs1 + pairs2)
+                if key[0] <= 4 and key[1] <= 1:
+                    result[key] = min(result.get(key, 99), chows1 + chows2)
+        return result
+
+    @staticmethod
+    def __complete(counts, isSuit):
+        """see completeCache"""
+        cacheKey = (counts, isSuit)
+        if cacheKey in Shanten.completeCache:
+            return Shanten.completeCache[cacheKey]
+        first = next((idx for idx, x in enumerate(counts) if x), None)
+        if first is None:
+            result = {(0, 0): 0}
+        else:
+            def remove(*offsets):
+                """counts without the tiles at first+offsets"""
+                rest = list(counts)
+                for offset in offsets:
+                    rest[first + offset] -= 1
+                return tuple(rest)
+            variants = []
+            if counts[first] >= 3:
+                variants.append((remove(0, 0, 0), {(1, 0): 0}))
+            if counts[first] >= 2:
+                variants.append((remove(0, 0), {(0, 1): 0}))
+            if isSuit and first < 7 and counts[first + 1] and counts[first + 2]:
+                variants.append((remove(0, 1, 2), {(1, 0): 1}))
+            result = {}
+            for rest, part in variants:
+                for key, chows in Shanten.__add(part, Shanten.__complete(rest, isSuit)).items():
+                    result[key] = min(result.get(key, 99), chows)
+        Shanten.completeCache[cacheKey] = result
+        return result
+
+    @staticmethod
+    def __waits(counts, isSuit):
+        """see waitCache"""
+        cacheKey = (counts, isSuit)
+        if cacheKey not in Shanten.waitCache:
+            result = []
+            for offset, count in enumerate(counts):
+                if count < 4:
+                    more = list(counts)
+                    more[offset] += 1
+                    parts = Shanten.__complete(tuple(more), isSuit)
+                    if parts:
+                        result.append((offset, parts))
+            Shanten.waitCache[cacheKey] = tuple(result)
+        return Shanten.waitCache[cacheKey]
+
+    @staticmethod
+    def couples(counts):
+        """seven knitted couples out of two suits"""
+        result = 99
+        for suit0, suit1 in ((0, 1), (0, 2), (1, 2)):
+            coupled = singles = 0
+            for code0, code1 in zip(Shanten.suitCodes[suit0], Shanten.suitCodes[suit1]):
+                coupled += min(counts[code0], counts[code1])
+                singles += abs(counts[code0] - counts[code1])
+            coupled = min(coupled, 7)
+            result = min(result, 13 - 2 * coupled - min(singles, 7 - coupled))
+        return result
+
+    @staticmethod
+    def triples(counts):
+        """four knitted triples and a knitted couple"""
+        # best[triples, couples] is the most tiles we can use
+        best = {(0, 0): 0}
+        pairings = (None, (0, 1), (0, 2), (1, 2))
+        for value in range(9):
+            suitCounts = list(counts[x[value]] for x in Shanten.suitCodes)
+            newBest = {}
+            for (tripleCount, coupleCount), used in best.items():
+                for triples in range(5 - tripleCount):
+                    for pairing in pairings[:4 - 3 * coupleCount]:
+                        gain = sum(min(count, triples + (pairing is not None and suit in pairing))
+                            for suit, count in enumerate(suitCounts))
+                        key = (tripleCount + triples, coupleCount + (pairing is not None))
+                        newBest[key] = max(newBest.get(key, 0), used + gain)
+            best = newBest
+        return 13 - best.get((4, 1), 0)
+
+    @staticmethod
+    def pairs(counts, codes):
+        """seven different pairs, all with a code out of codes"""
+        pairCount = min(sum(counts[x] >= 2 for x in codes), 7)
+        singles = sum(counts[x] == 1 for x in codes)
+        return 13 - 2 * pairCount - min(singles, 7 - pairCount)
+
+    @staticmethod
+    def orphans(counts):
+        """one of each major plus one more"""
+        kinds = sum(counts[x] > 0 for x in TileCounts.majors)
+        return 13 - kinds - any(counts[x] > 1 for x in TileCounts.majors)
+
+    @staticmethod
+    def pattern(counts, targets):
+        """targets are dicts with code: count, together 14 tiles"""
+        return 13 - max(sum(min(counts[code], count) for code, count in target.items())
+            for target in targets)
+
+    @staticmethod
+    def snakeTargets(extras, winds):
+        """for each suit: 1 to 9 plus all values in extras. With winds,
+        also one of each wind"""
+        result = []
+        for codes in Shanten.suitCodes:
+            for extra in extras:
+                target = dict((x, 1) for x in codes)
+                for value in extra:
+                    target[codes[value - 1]] += 1
+                if winds:
+                    for wind in Tile.winds:
+                        target[TileCounts.codeOf(Tile.wind, wind)] = 1
+                result.append(target)
+        return result
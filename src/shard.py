@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2014 Wolfgang Rohdewald <wolfgang@rohdewald.de>
+
+Kajongg is free software you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+With kajonggserver --shards=N, the game server plays the games in N
+worker processes, each with its own reactor.
+
+The game server still accepts all logins and holds all tables,
+the table lists and the chat. When a game starts, a worker gets a copy
+of the table and plays the game with the robots. The worker calls
+its clients through the game server, which relays those calls and
+returns the answers. If a user leaves the table or the table is removed,
+the game server tells the worker. The workers write into the same
+data base as the game server, see DBHandle.serverProfile.
+
+A worker registers with a secret which the game server passes on its
+stdin, so no other local process can play the worker. Afterwards each
+worker only talks to its own Shard.
+"""
+
+import os, sys, shutil, subprocess, binascii
+from tempfile import mkdtemp
+
+from twisted.spread import pb
+from twisted.internet import reactor
+
+from common import Options, Internal, Debug
+from log import m18nE, logDebug
+from message import Message
+from player import Players
+from game import ServerGame
+from server import ServerTable, User
+
+class Shard(pb.Referenceable):
+    """the game server side of a worker process"""
+
+    def __init__(self, server, remote):
+        self.server = server
+        self.remote = remote
+        self.tables = set()
+
+    def startTable(self, table, user):
+        """the worker should start the game of table for user"""
+        self.tables.add(table.tableid)
+        table.shard = self
+        if Debug.table:
+            logDebug('table %s is played by worker %d' % (table, id(self) % 10000))
+        owner = table.owner.name if table.owner else None
+        users = list([x.name, x.dbIdent, x.voiceId, x.maxGameId] for x in table.users)
+        gameid = table.game.gameid if table.suspendedAt else None
+        return self.remote.callRemote('startTable', table.tableid, table.ruleset.toDiffList(),
+            table.suspendedAt, table.playOpen, table.autoPlay, table.wantedGame,
+            gameid, owner, user.name, users).addErrback(self.__failed, table)
+
+    def __failed(self, failure, table):
+        """the worker could not start the table"""
+        table.abort(m18nE('Error for player %1: %2\n%3'), table.owner.name if table.owner else '',
+            failure.getErrorMessage(), '')
+
+    def userLeft(self, table, user):
+        """the worker should stop playing table"""
+        self.remote.callRemote('userLeft', table.tableid, user.name)
+
+    def removeTable(self, table):
+        """the worker should forget table"""
+        self.tables.discard(table.tableid)
+        table.shard = None
+        self.remote.callRemote('removeTable', table.tableid)
+
+    def __user(self, name):
+        """the logged in user with name"""
+        for user in self.server.srvUsers:
+            if user.name == name:
+                return user
+
+    def remote_relay(self, userName, args, kwargs):
+        """call a user for the worker, the worker gets the answer.
+        args and kwargs are jellied by the worker, the MoveCodec
+        also compacts the jellied tiles and melds"""
+        def pinged(result):
+            """like DeferredBlock does for local tables"""
+            user.pinged()
+            return result
+        user = self.__user(userName)
+        if not user:
+            return None
+        if args[0] == 'move' and user.moveCodec:
+            result = self.server.callRemote(user, 'compactMove',
+                user.moveCodec.encode(args[1], Message.defined[args[2]], kwargs))
+        else:
+            result = self.server.callRemoteJellied(user, args, kwargs)
+        if result:
+            result.addCallback(pinged)
+        return result
+
+    def remote_gameStarted(self, tableid):
+        """the worker started the game"""
+        table = self.server.tables.get(tableid)
+        if table:
+            table.running = True
+            self.server.gameStarted(table)
+
+    def remote_tableRemoved(self, tableid, reason, message, args):
+        """the worker ended or aborted a game"""
+        table = self.server.tables.get(tableid)
+        if table and table.shard is self:
+            self.tables.discard(tableid)
+            table.shard = None
+            self.server.removeTable(table, reason, message, *args)
+
+class Shards(pb.Root):
+    """the game server starts the workers and gives each of them its Shard"""
+
+    def __init__(self, server, count, options):
+        self.server = server
+        self.count = count
+        self.shards = []
+        self.processes = []
+        self.secret = binascii.hexlify(os.urandom(16))
+        factory = pb.PBServerFactory(self)
+        if os.name == 'nt':
+            self.tmpdir = None
+            self.port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+            address = str(self.port.getHost().port)
+        else:
+            # only we may connect
+            self.tmpdir = mkdtemp(prefix='kajongg')
+            address = os.path.join(self.tmpdir, 'shards')
+            self.port = reactor.listenUNIX(address, factory)
+        args = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'kajonggserver.py'),
+            '--shardof=%s' % address, '--db=%s' % Internal.db.path,
+            '--handcache=%d' % Options.handCacheSize]
+        if options.debug:
+            args.append('--debug=%s' % options.debug)
+        if options.profile:
+            args.append('--profile=%s' % options.profile)
+        for idx in range(1, count + 1):
+            if options.metrics:
+                # worker idx serves its metrics on the next port or socket
+                if options.metrics.isdigit():
+                    workerArgs = args + ['--metrics=%d' % (int(options.metrics) + idx)]
+                else:
+                    workerArgs = args + ['--metrics=%s.%d' % (options.metrics, idx)]
+            else:
+                workerArgs = args
+            process = subprocess.Popen(workerArgs, stdin=subprocess.PIPE)
+            process.stdin.write(self.secret + '\n')
+            process.stdin.close()
+            self.processes.append(process)
+
+    def remote_register(self, secret, remote):
+        """a worker is ready. Returns its Shard"""
+        if secret != self.secret or len(self.shards) == self.count:
+            raise pb.Error('refusing to register a worker')
+        shard = Shard(self.server, remote)
+        self.shards.append(shard)
+        remote.notifyOnDisconnect(self.__lost)
+        if Debug.connections:
+            logDebug('worker %d of %d is ready' % (len(self.shards), self.count))
+        if len(self.shards) == self.count:
+            self.port.stopListening()
+            if self.tmpdir:
+                shutil.rmtree(self.tmpdir, ignore_errors=True)
+        return shard
+
+    def __lost(self, remote):
+        """abort the tables of a worker which went away"""
+        for shard in self.shards[:]:
+            if shard.remote is remote:
+                self.shards.remove(shard)
+                for tableid in shard.tables:
+                    table = self.server.tables.get(tableid)
+                    if table:
+                        table.shard = None
+                        table.abort(m18nE('The game server lost its worker for table %1'), tableid)
+
+    def place(self, table, user):
+        """let the least busy worker play table. False if we have none"""
+        if table.shard:
+            return True
+        if not self.shards:
+            return False
+        min(self.shards, key=lambda x: len(x.tables)).startTable(table, user)
+        return True
+
+class ShardUser(User):
+    """a user as seen by a worker. All calls go through the game server"""
+    def __init__(self, name, dbIdent, voiceId, maxGameId): # pylint: disable=super-init-not-called
+        self.name = name
+        self.mind = None
+        self.server = None
+        self.dbIdent = dbIdent
+        self.voiceId = voiceId
+        self.maxGameId = maxGameId
+        self.moveCodec = None
+        self.lastPing = None
+        self.pinged()
+
+class ShardServer(pb.Referenceable):
+    """the worker process. For its ServerTables, it is the MJServer"""
+
+    def __init__(self):
+        self.front = None # our Shard in the game server
+        self.tables = {}
+        self.shards = None
+        Players.load()
+
+    @property
+    def srvUsers(self):
+        """the users of our tables. All others are out of our reach,
+        the game server tells them"""
+        result = []
+        for table in self.tables.values():
+            result.extend(x for x in table.users if x.name not in list(y.name for y in result))
+        return result
+
+    @staticmethod
+    def connect(address):
+        """connect to the game server and play the tables it sends"""
+        secret = sys.stdin.readline().strip()
+        server = ShardServer()
+        def registered(front):
+            """from now on we talk to our Shard"""
+            server.front = front
+        def connected(root):
+            """register with the game server, stop if it goes away"""
+            root.notifyOnDisconnect(lambda dummy: reactor.stop())
+            return root.callRemote('register', secret, server).addCallback(registered)
+        factory = pb.PBClientFactory()
+        if address.isdigit():
+            reactor.connectTCP('127.0.0.1', int(address), factory)
+        else:
+            reactor.connectUNIX(address, factory)
+        factory.getRootObject().addCallback(connected).addErrback(lambda dummy: reactor.stop())
+
+    def remote_startTable(self, tableid, ruleset, suspendedAt, playOpen, autoPlay, wantedGame,
+            gameid, ownerName, userName, users):
+        """play this table"""
+        # pylint: disable=too-many-arguments
+        users = list(ShardUser(*x) for x in users) # pylint: disable=star-args
+        byName = dict((x.name, x) for x in users)
+        table = ServerTable(self, byName.get(ownerName), ruleset, suspendedAt,
+            playOpen, autoPlay, wantedGame, tableid)
+        table.users = users
+        if gameid:
+            table.game = ServerGame.loadFromDB(gameid)
+        table.readyForGameStart(byName[userName])
+
+    def remote_userLeft(self, tableid, userName):
+        """the game server already told the others"""
+        table = self.tables.get(tableid)
+        if table:
+            table.running = False
+            table.users = list(x for x in table.users if x.name != userName)
+
+    def remote_removeTable(self, tableid):
+        """the game server removed the table"""
+        table = self.tables.pop(tableid, None)
+        if table:
+            table.running = False
+            if table.game:
+                table.game.close()
+
+    def callRemote(self, user, *args, **kwargs):
+        """like MJServer.callRemote"""
+        return self.callRemoteJellied(user, *Message.jellyAll(args, kwargs))
+
+    def callRemoteJellied(self, user, args, kwargs):
+        """the game server calls user for us"""
+        return self.front.callRemote('relay', user.name, args, kwargs)
+
+    def gameStarted(self, table):
+        """the game server adapts the other tables"""
+        self.front.callRemote('gameStarted', table.tableid)
+
+    def removeTable(self, table, reason, message=None, *args):
+        """the game server tells the users"""
+        if self.tables.pop(table.tableid, None):
+            table.running = False
+            self.front.callRemote('tableRemoved', table.tableid, reason, message or '', list(args))
+        if table.game:
+            table.game.close()
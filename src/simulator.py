@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2014 Wolfgang Rohdewald <wolfgang@rohdewald.de>
+
+Kajongg is free software you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+Play complete games with robot players in this process: no game server,
+no clients, no network, no reactor and no database. The Simulator is the
+game server and all four clients at the same time, it drives one ServerGame
+synchronously along the same steps as ServerTable does.
+
+This is meant for mass testing the AI variants, see kajonggtest.py.
+Started as a program, this is a worker playing the games it is asked for
+on stdin, see work().
+"""
+
+from __future__ import print_function
+
+import os, sys, csv, traceback
+
+from twisted.internet.defer import succeed
+
+from common import Options, Debug, IntDict, WINDS
+from log import logException, m18n, m18nE
+from message import Message
+from meld import Meld
+from tile import Tile
+from wall import WallEmpty
+from rule import Ruleset, PredefinedRuleset
+from game import ServerGame
+from hand import HandCache
+
+import intelligence, altint
+import predefined # pylint: disable=unused-import
+
+class SimulatedGame(ServerGame):
+    """a game played by the Simulator. All players see everything,
+    and nothing is written into the database"""
+
+    def addCsvTag(self, tag, forAllPlayers=False):
+        """the Simulator also is the human client writing the csv row"""
+        ServerGame.addCsvTag(self, tag, forAllPlayers=True)
+
+    def __init__(self, *args, **kwargs):
+        self.__eastWins = IntDict()
+        ServerGame.__init__(self, *args, **kwargs)
+
+    def _saveScores(self):
+        """there is no database, only count what eastWins needs"""
+        if self.winner and self.winner.wind == 'E':
+            self.__eastWins[(self.winner.name, WINDS[self.roundsFinished % 4])] += 1
+        self._tagLimitHands()
+        return succeed(None)
+
+    def eastWins(self):
+        """see Game.eastWins"""
+        return self.__eastWins[(self.players['E'].name, WINDS[self.roundsFinished % 4])]
+
+class Simulator(object):
+    """plays games for a ruleset. The player Tester uses the AI variant aiName,
+    the three robot players use AIDefault"""
+
+    names = ['Tester', 'Robot 1', 'Robot 2', 'Robot 3']
+    name = None # like the Client of the game server
+
+    def __init__(self, ruleset, aiName='Default'):
+        if not isinstance(ruleset, Ruleset):
+            ruleset = self.__findRuleset(ruleset)
+        self.ruleset = ruleset
+        self.aiName = aiName
+        self.aiClass = self.__findAI(aiName)
+
+    @staticmethod
+    def __findRuleset(name):
+        """find a predefined ruleset by name"""
+        for ruleset in PredefinedRuleset.rulesets():
+            if ruleset.name == name:
+                return ruleset
+        logException('ruleset %s is undefined' % name)
+
+    @staticmethod
+    def __findAI(aiName):
+        """the AI class for aiName"""
+        for module in (intelligence, altint):
+            result = getattr(module, 'AI' + aiName, None)
+            if result:
+                return result
+        logException('intelligence %s is undefined' % aiName)
+
+    @staticmethod
+    def isRobotClient():
+        """avoid using isinstance, see Client"""
+        return False
+
+    @staticmethod
+    def isHumanClient():
+        """avoid using isinstance, see Client"""
+        return False
+
+    @staticmethod
+    def isServerClient():
+        """avoid using isinstance, see Client"""
+        return True
+
+    @staticmethod
+    def logout(dummyResult=None):
+        """there is nothing to log out from"""
+        return succeed(None)
+
+    def play(self, seed):
+        """play a complete game, returns the row for the csv file"""
+        game = SimulatedGame(self.names, self.ruleset, wantedGame=str(seed),
+            client=self, playOpen=True)
+        tester = game.playerByName('Tester')
+        tester.intelligence = self.aiClass(tester)
+        game.nameWallTiles()
+        while not game.finished():
+            self.playHand(game)
+            game.maybeRotateWinds()
+        return game.csvRow(self.aiName)
+
+    def run(self, seeds):
+        """yields the csv row for each seed"""
+        for seed in seeds:
+            yield self.play(seed)
+
+    def playHand(self, game):
+        """play one hand until somebody says Mah Jongg or the wall is empty.
+        Every step returns the next step like the callbacks in ServerTable,
+        so the stack does not grow with the number of moves"""
+        game.prepareHand()
+        game.initHand()
+        step = (self.pickTile,)
+        while step:
+            step = step[0](game, *step[1:])
+        game.saveHand()
+
+    @staticmethod
+    def __tell(game, player, command, **kwargs):
+        """remember the move like DeferredBlock.tell does and return it"""
+        kwargs['token'] = None
+        game.appendMove(player, command, kwargs)
+        return game.moves[-1]
+
+    @staticmethod
+    def __ask(player, move, answers):
+        """like Client.ask but without delaying Chow: prioritize
+        does what the waiting robot would find out"""
+        player.computeSayable(move, answers)
+        return player.intelligence.selectAnswer(answers)
+
+    def __askOthers(self, game, player, move, answers):
+        """returns the prioritized claims of all players but player"""
+        requests = list((x, ) + self.__ask(x, move, answers) for x in player.others())
+        return self.prioritize(game, requests)
+
+    def pickTile(self, game, deadEnd=False):
+        """the active player gets a tile from wall"""
+        player = game.activePlayer
+        try:
+            tile = player.pickedTile(deadEnd)
+        except WallEmpty:
+            return None
+        game.lastDiscard = None
+        move = self.__tell(game, player, Message.PickedTile, tile=tile, deadEnd=deadEnd)
+        if tile.isBonus:
+            return (self.pickTile, )
+        return self.myAction, player, move
+
+    def myAction(self, game, player, move):
+        """player got a tile and must discard, may declare Kong or say Mah Jongg"""
+        answers = [Message.Discard, Message.Kong, Message.MahJongg]
+        if not player.discarded:
+            answers.append(Message.OriginalCall)
+        answer, parameter = self.__ask(player, move, answers)
+        if answer == Message.MahJongg:
+            return self.claimMahJongg, player, parameter
+        elif answer == Message.Kong:
+            return self.declareKong, player, parameter
+        return self.discarded, player, answer, parameter
+
+    def discarded(self, game, player, answer, tile):
+        """player discarded tile. See ServerTable.clientDiscarded"""
+        tile = Tile(tile)
+        if tile not in player.concealedTiles:
+            logException('player %s discarded %s but does not have it' % (player, tile))
+        txt = game.dangerousFor(player, tile)
+        mustPlayDangerous = player.mustPlayDangerous()
+        violates = player.violatesOriginalCall(tile)
+        game.hasDiscarded(player, tile)
+        self.__tell(game, player, Message.Discard, tile=tile)
+        if violates:
+            player.mayWin = False
+        if game.ruleset.mustDeclareCallingHand and not player.isCalling:
+            if player.hand.callingHands:
+                player.isCalling = True
+        if txt:
+            if mustPlayDangerous and player.lastSource not in 'dZ':
+                player.claimedNoChoice = True
+            else:
+                player.playedDangerous = True
+        if answer == Message.OriginalCall:
+            player.isCalling = True
+            player.originalCall = True
+            player.originalCallingHand = player.hand
+            game.addCsvTag('originalCall')
+        return (self.askForClaims, )
+
+    def askForClaims(self, game):
+        """ask all other players if they want to claim the discarded tile"""
+        player = game.activePlayer
+        move = self.__tell(game, player, Message.AskForClaims)
+        answers = self.__askOthers(game, player, move,
+            [Message.NoClaim, Message.Chow, Message.Pung, Message.Kong, Message.MahJongg])
+        if not answers:
+            game.nextTurn()
+            return (self.pickTile, )
+        claimer, answer, parameter = answers[0]
+        if answer == Message.MahJongg:
+            return self.claimMahJongg, claimer, parameter
+        return self.claimTile, claimer, answer, parameter
+
+    @staticmethod
+    def prioritize(game, requests):
+        """requests are tuples (player, answer, parameter). Returns
+        only requests we want to execute, see ServerTable.prioritize"""
+        answers = [x for x in requests if x[1] not in [Message.NoClaim, Message.OK, None]]
+        if len(answers) > 1:
+            claims = [Message.MahJongg, Message.Kong, Message.Pung, Message.Chow]
+            for claim in claims:
+                if claim in [x[1] for x in answers]:
+                    # ignore claims with lower priority:
+                    answers = [x for x in answers if x[1] == claim or x[1] not in claims]
+                    break
+        mjAnswers = [x for x in answers if x[1] == Message.MahJongg]
+        if len(mjAnswers) > 1:
+            mjPlayers = [x[0] for x in mjAnswers]
+            nextPlayer = game.nextPlayer()
+            while nextPlayer not in mjPlayers:
+                nextPlayer = game.nextPlayer(nextPlayer)
+            answers = [x for x in answers if x[0] == nextPlayer or x[1] != Message.MahJongg]
+        return answers
+
+    def claimTile(self, game, player, claim, meldTiles):
+        """player claims the discarded tile for pung, kong or chow.
+        See ServerTable.claimTile"""
+        lastDiscard = game.lastDiscard
+        discardingPlayer = game.activePlayer
+        hasTiles = Meld(meldTiles[:]).without(lastDiscard)
+        meld = Meld(meldTiles)
+        if len(meld) != 4 and not (meld.isPair or meld.isPungKong or meld.isChow):
+            logException(m18n(m18nE('%1 wrongly said %2 for meld %3'), player.name, claim.name, str(meld)))
+        if not player.hasConcealedTiles(hasTiles):
+            logException(m18n(m18nE('%1 wrongly said %2: claims to have concealed tiles %3 but only has %4'),
+                player.name, claim.name, ' '.join(hasTiles), ''.join(player.concealedTiles)))
+        game.discardedTiles[lastDiscard.exposed] -= 1
+        game.activePlayer = player
+        player.lastTile = lastDiscard.exposed
+        player.lastSource = 'd'
+        player.exposeMeld(hasTiles, lastDiscard)
+        game.lastDiscard = None
+        if (claim != Message.Kong
+                and game.dangerousFor(discardingPlayer, lastDiscard)
+                and discardingPlayer.playedDangerous):
+            player.usedDangerousFrom = discardingPlayer
+        move = self.__tell(game, player, claim, meld=meld)
+        if claim == Message.Kong:
+            return self.pickTile, True
+        return self.myAction, player, move
+
+    def declareKong(self, game, player, meldTiles):
+        """player declares a Kong, the others may rob it. See ServerTable.declareKong"""
+        kongMeld = Meld(meldTiles)
+        if not player.hasConcealedTiles(kongMeld) and kongMeld[0].exposed.pung not in player.exposedMelds:
+            logException(m18n(m18nE('declareKong:%1 wrongly said Kong for meld %2'), player.name, str(kongMeld)))
+        player.exposeMeld(kongMeld)
+        move = self.__tell(game, player, Message.DeclaredKong, meld=kongMeld)
+        answers = self.__askOthers(game, player, move, [Message.NoClaim, Message.MahJongg])
+        if answers and answers[0][1] == Message.MahJongg:
+            return self.claimMahJongg, answers[0][0], answers[0][2]
+        return self.pickTile, True
+
+    def claimMahJongg(self, game, player, parameter):
+        """player says Mah Jongg, check it. See ServerTable.claimMahJongg"""
+        concealedMelds, withDiscard, lastMeld = parameter
+        if game.ruleset.mustDeclareCallingHand:
+            assert player.isCalling, '%s %s: concmelds:%s withdiscard:%s lastmeld:%s' % (
+                game.handId, player, concealedMelds, withDiscard, lastMeld)
+        discardingPlayer = game.activePlayer
+        lastMove = game.lastMoves(withoutNotifications=True).next()
+        if lastMove.message == Message.DeclaredKong:
+            player.lastSource = 'k'
+            withDiscard = lastMove.meld[0].concealed
+            lastMove.player.robTile(withDiscard)
+            game.addCsvTag('robbedKong%s' % lastMove.meld[1])
+        msgArgs = player.showConcealedMelds(concealedMelds, withDiscard)
+        if msgArgs:
+            logException(m18n(*msgArgs)) # pylint: disable=star-args
+        player.declaredMahJongg(concealedMelds, withDiscard, player.lastTile, lastMeld)
+        if not player.hand.won:
+            logException(m18n(m18nE('%1 claiming MahJongg: This is not a winning hand: %2'),
+                player.name, player.hand.string))
+        if (player.lastSource == 'd'
+                and game.dangerousFor(discardingPlayer, player.lastTile)
+                and discardingPlayer.playedDangerous):
+            player.usedDangerousFrom = discardingPlayer
+        self.__tell(game, player, Message.MahJongg, melds=concealedMelds, lastTile=player.lastTile,
+            lastMeld=lastMeld, withDiscardTile=withDiscard)
+        return None
+
+def work(jobFile, resultFile):
+    """play the games asked for in jobFile: one line per game with seed,
+    ruleset name and AI variant, separated by ';'. For every game write
+    one line to resultFile: OK followed by the csv row of the game, or
+    ERROR followed by seed, ruleset name, AI variant and the error message.
+    The engine and the evaluated hands stay loaded from game to game."""
+    simulators = {}
+    writer = csv.writer(resultFile, delimiter=';')
+    # readline does not read ahead, so we never wait for more jobs than we got
+    for seed, rulesetName, aiName in csv.reader(iter(jobFile.readline, ''), delimiter=';'):
+        try:
+            key = (rulesetName, aiName)
+            if key not in simulators:
+                simulators[key] = Simulator(rulesetName, aiName)
+            row = ['OK'] + simulators[key].play(int(seed))
+        except Exception as exc: # pylint: disable=broad-except
+            traceback.print_exc()
+            row = ['ERROR', seed, rulesetName, aiName, str(exc)]
+        writer.writerow(row)
+        resultFile.flush()
+
+def parseArgs():
+    """as the name says"""
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option('', '--rounds', dest='rounds',
+        help='play only # ROUNDS per game', metavar='ROUNDS')
+    parser.add_option('', '--debug', dest='debug',
+        help=Debug.help())
+    parser.add_option('', '--handcache', dest='handCacheSize',
+        help='cache up to HANDCACHESIZE evaluated hands (%d)' % Options.handCacheSize,
+        type=int, default=Options.handCacheSize)
+    (options, args) = parser.parse_args()
+    if args and ''.join(args):
+        print('unrecognized arguments:', ' '.join(args), file=sys.stderr)
+        sys.exit(2)
+    Options.rounds = options.rounds
+    Options.handCacheSize = options.handCacheSize
+    msg = HandCache.checkSize(options.handCacheSize) or Debug.setOptions(options.debug)
+    if msg:
+        print(msg, file=sys.stderr)
+        sys.exit(2)
+    Options.fixed = True # may not be changed anymore
+
+if __name__ == '__main__':
+    parseArgs()
+    RESULTS = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    # whatever else is written to stdout must not get mixed with the results
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    work(sys.stdin, RESULTS)
@@ -107,6 +107,7 @@ class Tile(str):
             result.isReal = result.value in Tile.numbers
         result.isMajor = result.isHonor or result.isTerminal
         result.isMinor = not result.isMajor
+        result.code = TileCounts.codeOf(result.lowerGroup, result.value)
         try:
             result.key = 1 + result.hashTable.index(result) // 2
         except ValueError:
@@ -219,6 +220,10 @@ class TileList(list):
         """sort(TileList) would not keep TileList type"""
         return TileList(sorted(self))
 
+    def counts(self):
+        """the compact representation, see TileCounts"""
+        return TileCounts(self)
+
     def hasChows(self, tile):
         """returns my chows with tileName"""
         if tile not in self:
@@ -240,6 +245,106 @@ class TileList(list):
         """the content"""
         return str(''.join(self))
 
+class TileCounts(tuple):
+    """a compact representation of tiles: one count per Tile.code.
+    Exposed and concealed tiles share the same code, so this is what
+    rules want if they only ask which tiles a hand holds but not how
+    they are grouped into melds.
+
+    codes are 0..26 for stones, bamboos and characters 1..9, 27..30
+    for winds, 31..33 for dragons, 34..41 for flowers and seasons
+    and 42 for the unknown tile. Tiles only used by the AI like
+    Tile('b0') have no code, TileCounts counts them as unknown tiles."""
+
+    size = 43
+    unknownCode = 42
+    tileOf = [None] * size  # code -> exposed Tile, see fillTables
+    # frozensets of codes, see fillTables:
+    winds = dragons = honors = terminals = majors = minors = greenHandTiles = frozenset()
+
+    def __new__(cls, tiles=()):
+        counts = [0] * cls.size
+        for tile in tiles:
+            code = tile.code
+            counts[cls.unknownCode if code is None else code] += 1
+        return tuple.__new__(cls, counts)
+
+    @staticmethod
+    def codeOf(lowerGroup, value):
+        """the code for a tile or None"""
+        # pylint: disable=too-many-return-statements
+        if lowerGroup in Tile.colors:
+            if value in Tile.numbers:
+                return Tile.colors.index(lowerGroup) * 9 + value - 1
+            return None
+        if lowerGroup == Tile.wind:
+            return 27 + Tile.winds.index(value)
+        if lowerGroup == Tile.dragon:
+            return 31 + Tile.dragons.index(value)
+        if lowerGroup == Tile.flower:
+            return 34 + Tile.winds.index(value)
+        if lowerGroup == Tile.season:
+            return 38 + Tile.winds.index(value)
+        return TileCounts.unknownCode
+
+    @staticmethod
+    def fillTables():
+        """define the code tables. Needs elements"""
+        TileCounts.tileOf[Tile.unknown.code] = Tile.unknown
+        for tile in elements.occurrence:
+            TileCounts.tileOf[tile.code] = tile
+        for attrName in ('winds', 'dragons', 'honors', 'terminals', 'majors', 'minors', 'greenHandTiles'):
+            setattr(TileCounts, attrName, frozenset(x.code for x in getattr(elements, attrName)))
+
+    def codes(self):
+        """a frozenset with the codes of all tiles we hold"""
+        return frozenset(idx for idx, count in enumerate(self) if count)
+
+    def anyOf(self, codes):
+        """True if we hold at least one tile with a code out of codes"""
+        return any(self[x] for x in codes)
+
+    def only(self, codes):
+        """True if all our tiles have a code out of codes"""
+        return sum(self[x] for x in codes) == sum(self)
+
+    def added(self, code, count=1):
+        """a copy with count more tiles of code"""
+        result = list(self)
+        result[code] += count
+        return tuple.__new__(TileCounts, result)
+
+    def groupValues(self, group):
+        """a sorted tuple with the values of all our tiles of suit group,
+        in the form Hand.values has"""
+        offset = Tile.colors.index(group.lower()) * 9
+        result = []
+        for value in Tile.numbers:
+            result.extend([value] * self[offset + value - 1])
+        return tuple(result)
+
+    def tiles(self):
+        """a sorted TileList with the exposed form of all our tiles"""
+        result = TileList()
+        for code, count in enumerate(self):
+            if count:
+                list.extend(result, [self.tileOf[code]] * count)
+        return result.sorted()
+
+    def __add__(self, other):
+        """add the counts"""
+        return tuple.__new__(TileCounts, (x + y for x, y in zip(self, other)))
+
+    def __sub__(self, other):
+        """subtract the counts"""
+        return tuple.__new__(TileCounts, (x - y for x, y in zip(self, other)))
+
+    def __str__(self):
+        return str(self.tiles())
+
+    def __repr__(self):
+        return 'TileCounts(%s)' % str(self)
+
 class Elements(object):
     """represents all elements"""
     # pylint: disable=too-many-instance-attributes
@@ -281,3 +386,5 @@ class Elements(object):
 Tile.unknown = Tile('Xy') # must come first
 elements = Elements()  # pylint: disable=invalid-name
 assert not Tile.unknown.isKnown
+
+TileCounts.fillTables()
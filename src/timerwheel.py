@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2014 Wolfgang Rohdewald <wolfgang@rohdewald.de>
+
+Kajongg is free software you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+"""
+
+from twisted.internet.defer import Deferred
+from twisted.python import log
+
+from common import Internal
+
+class WheelTimer(object):
+    """a call waiting in a TimerWheel"""
+    __slots__ = ('wheel', 'when', 'due', 'func', 'args', 'kwargs')
+
+    def __init__(self, wheel, when, due, func, args, kwargs):
+        self.wheel = wheel
+        self.when = when
+        self.due = due
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def active(self):
+        """has it neither been called nor cancelled?"""
+        return self.func is not None
+
+    def cancel(self):
+        """it will not be called"""
+        if self.func is not None:
+            self.wheel.remove(self)
+
+class TimerWheel(object):
+    """a hashed timer wheel: all calls with a due time in the same tick
+    hang in the same slot. Only one reactor call is pending, for the next
+    tick having a timer, and only while we have timers. A tick only looks
+    at the timers in its slot. The resolution is one tick, calls are never
+    early. Like with reactor.callLater, timers due in the same tick are
+    called in the order of their due time, and in the order they were
+    added if that is the same."""
+
+    __default = None
+    epsilon = 1e-6
+
+    def __init__(self, tick=0.1, slots=512, reactor=None):
+        self.tick = tick
+        self.reactor = reactor or Internal.reactor
+        self.slots = list([] for _ in range(slots))
+        self.count = 0
+        self.current = None # the next tick to be processed
+        self.__call = None
+        self.__wakeTick = None
+
+    @classmethod
+    def default(cls):
+        """the timer wheel of this process"""
+        if cls.__default is None:
+            cls.__default = TimerWheel()
+        return cls.__default
+
+    def __tickOf(self, seconds, roundUp=True):
+        """the tick number for a point in time. Allow for rounding errors,
+        a tick reached by __schedule must never look like the tick before"""
+        if roundUp:
+            return -int((self.epsilon - seconds) // self.tick)
+        return int((seconds + self.epsilon) // self.tick)
+
+    def callLater(self, delay, func, *args, **kwargs):
+        """like reactor.callLater"""
+        now = self.reactor.seconds()
+        if not self.count:
+            self.current = self.__tickOf(now)
+        due = max(self.__tickOf(now + delay), self.current)
+        timer = WheelTimer(self, now + delay, due, func, args, kwargs)
+        self.slots[due % len(self.slots)].append(timer)
+        self.count += 1
+        if self.__call is None:
+            self.__schedule()
+        elif due < self.__wakeTick:
+            self.__call.cancel()
+            self.__schedule()
+        return timer
+
+    def deferLater(self, delay, func, *args, **kwargs):
+        """like twisted.internet.task.deferLater but the Deferred cannot be cancelled"""
+        result = Deferred()
+        self.callLater(delay, result.callback, None)
+        return result.addCallback(lambda dummy: func(*args, **kwargs))
+
+    def remove(self, timer):
+        """timer will not be called. It stays in its slot until
+        __advance passes by"""
+        timer.func = None
+        if timer.due is None:
+            # expired, __advance is calling the expired timers
+            return
+        self.count -= 1
+        if not self.count:
+            for slot in self.slots:
+                del slot[:]
+            if self.__call is not None:
+                self.__call.cancel()
+                self.__call = None
+
+    def __nextDue(self):
+        """the first tick having a timer. Timers in the slot of a tick
+        may also be due one or more turns of the wheel later"""
+        size = len(self.slots)
+        for tick in range(self.current, self.current + size):
+            for timer in self.slots[tick % size]:
+                if timer.due == tick and timer.func is not None:
+                    return tick
+        return min(x.due for slot in self.slots for x in slot if x.func is not None)
+
+    def __schedule(self):
+        """wake us up for the next tick having a timer"""
+        self.__wakeTick = self.__nextDue()
+        delay = max(0, self.__wakeTick * self.tick - self.reactor.seconds())
+        self.__call = self.reactor.callLater(delay, self.__advance)
+
+    def __advance(self):
+        """call all timers which are due by now"""
+        self.__call = None
+        now = self.__tickOf(self.reactor.seconds(), roundUp=False)
+        # no timer is due before __wakeTick
+        self.current = max(self.current, self.__wakeTick)
+        expired = []
+        while self.count > len(expired) and self.current <= now:
+            slot = self.slots[self.current % len(self.slots)]
+            expired.extend(x for x in slot if x.due <= self.current and x.func is not None)
+            slot[:] = list(x for x in slot if x.due > self.current and x.func is not None)
+            self.current += 1
+        self.count -= len(expired)
+        for timer in expired:
+            timer.due = None
+        if self.count:
+            self.__schedule()
+        expired.sort(key=lambda x: x.when)
+        for timer in expired:
+            func = timer.func
+            if func is None:
+                # cancelled by a timer called before it
+                continue
+            timer.func = None
+            try:
+                func(*timer.args, **timer.kwargs)
+            except Exception: # pylint: disable=broad-except
+                log.err()